@@ -1,8 +1,15 @@
-import importlib
+import time
+
+# Started before the remaining imports so that the logged startup time covers them too
+app_init_start_time = time.perf_counter()
+
 import os
-from chalice import Chalice, Blueprint
+from chalice import Chalice
 
-from chalicelib.common import init_support
+from chalicelib.apis.cms_api import cms_api
+from chalicelib.apis.health_check_api import health_check_api
+from chalicelib.apis.ingest_job_worker import ingest_job_worker
+from chalicelib.common import log_support
 
 env = os.environ["ENV"]
 
@@ -12,11 +19,9 @@ app.experimental_feature_flags.update(['BLUEPRINTS'])
 
 app.api.binary_types.append('multipart/form-data')
 
-api_dir = os.path.join(os.path.dirname(__file__), 'chalicelib/apis')
-for file_name in os.listdir(api_dir):
-    if file_name.endswith('.py') and file_name != '__init__.py':
-        module = importlib.import_module(f'chalicelib.apis.{file_name.replace(".py", "")}')
-        for name in dir(module):
-            obj = getattr(module, name)
-            if isinstance(obj, Blueprint):
-                app.register_blueprint(obj)
+# Blueprints are registered from a static list rather than by scanning chalicelib/apis on every cold start
+blueprints = [health_check_api, cms_api, ingest_job_worker]
+for blueprint in blueprints:
+    app.register_blueprint(blueprint)
+
+log_support.console_log(f"App initialised in {(time.perf_counter() - app_init_start_time) * 1e3:.1f} ms")
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the CSV transform stage of the upload API, without MongoDB.
+
+    python -m benchmarks.bench_csv_transform --rows 100000
+"""
+import argparse
+import ast
+import json
+import time
+from io import BytesIO
+
+import pandas as pd
+
+from benchmarks.synthetic_movies import generate_movies_csv
+from chalicelib.support import csv_upload_support
+
+
+def transform_with_inferred_dtypes(raw_body, chunk_size):
+    """
+    Transform stage as it was before the declared schema: inferred dtypes and a literal_eval call per row.
+    """
+    for df in pd.read_csv(BytesIO(raw_body), encoding='utf-8', chunksize=chunk_size):
+        df['release_year'] = pd.to_datetime(df['release_date'], errors='coerce').dt.year
+        df['languages'] = df['languages'].apply(lambda x: ast.literal_eval(x) if pd.notna(x) else [])
+        df.to_dict(orient='records')
+
+
+def transform_with_schema(raw_body, chunk_size, engine):
+    for df in csv_upload_support.read_csv_chunks(raw_body, chunk_size, engine):
+        csv_upload_support.transform_csv_chunk(df)
+
+
+def measure_rows_per_second(transform, raw_body, row_count, repeat):
+    best_duration = min(timed(transform, raw_body) for _ in range(repeat))
+    return round(row_count / best_duration)
+
+
+def timed(transform, raw_body):
+    start_time = time.perf_counter()
+    transform(raw_body)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rows per second of the CSV transform stage.")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of synthetic rows.")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Rows per chunk.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, the best one is reported.")
+    args = parser.parse_args()
+
+    raw_body = generate_movies_csv(args.rows)
+    variants = {
+        "inferred_dtypes_literal_eval": lambda body: transform_with_inferred_dtypes(body, args.chunk_size),
+        "schema_c_parser": lambda body: transform_with_schema(body, args.chunk_size, "c"),
+    }
+    if csv_upload_support.pyarrow is not None:
+        variants["schema_pyarrow_parser"] = lambda body: transform_with_schema(body, args.chunk_size, "pyarrow")
+
+    for name, transform in variants.items():
+        rows_per_second = measure_rows_per_second(transform, raw_body, args.rows, args.repeat)
+        print(json.dumps({"variant": name, "rows": args.rows, "rows_per_second": rows_per_second}))
+
+
+if __name__ == "__main__":
+    main()
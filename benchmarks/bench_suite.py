@@ -0,0 +1,246 @@
+"""
+Reproducible benchmark suite of the ingest and fetch hot paths.
+
+For every dataset size, synthetic movies are generated, ingested through upload_csv_data and queried
+through fetch_movies. Each size runs in its own process so that its peak RSS is not inflated by the
+previous ones. The results are compared with a stored JSON baseline when there is one, and a regression
+beyond the threshold fails the run.
+
+    python -m benchmarks.bench_suite --sizes 10k 1m               # against MONGO_CONNECTION_STRING
+    python -m benchmarks.bench_suite --sizes 10k --in-process     # against mongomock, if installed
+    python -m benchmarks.bench_suite --sizes 10k --save-baseline  # record a new baseline
+
+The memory of the ingest is read from /proc, the suite runs on Linux.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BENCHMARKS_DIR, "data")
+BASELINES_DIR = os.path.join(BENCHMARKS_DIR, "baselines")
+
+DATASET_SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+
+# Query shapes measured for each dataset, deep pages are measured both with skip/limit and with a cursor
+QUERY_SHAPES = {
+    "language_by_rating": {"filter_params": {"languages": "English"}, "sort_params": {"vote_average": -1}},
+    "year_by_release_date": {"filter_params": {"release_year": 2000}, "sort_params": {"release_date": -1}},
+    "all_by_rating": {"filter_params": {}, "sort_params": {"vote_average": -1}},
+    "language_and_year_by_rating_and_date": {"filter_params": {"languages": "Français", "release_year": 2010},
+                                             "sort_params": {"vote_average": -1, "release_date": -1}},
+}
+PAGE_SIZE = 20
+# The deep page of a shape is its last full page, capped so that the large datasets are measured at the same depth
+MAX_DEEP_PAGE = 500
+
+# Direction in which each metric regresses
+HIGHER_IS_BETTER = {"ingest_rows_per_second"}
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process to its current RSS, so that the next peak is the one of the following stage.
+    """
+    with open("/proc/self/clear_refs", "w") as clear_refs_file:
+        clear_refs_file.write("5")
+
+
+def get_rss_in_mb(field="VmRSS"):
+    """
+    :param field: VmRSS for the current RSS of the process, VmHWM for its peak since the last reset_peak_rss
+    """
+    with open("/proc/self/status") as status_file:
+        for line in status_file:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    raise LookupError(f"{field} is missing from /proc/self/status")
+
+
+def get_deep_page(cms_api_support, shape):
+    """
+    :return: Last full page of the records matching the shape, at most MAX_DEEP_PAGE, so that the deep page
+    timings measure a deep scan rather than the error of a page past the last one
+    """
+    total_count = cms_api_support.fetch_movies(shape["filter_params"], shape["sort_params"], 1, 1,
+                                               include_total=True)["total_count"]
+    return max(1, min(MAX_DEEP_PAGE, total_count // PAGE_SIZE))
+
+
+def run_dataset(size_name, in_process, iterations, workers):
+    """
+    Generate, ingest and query one dataset, run in a fresh process.
+
+    Returns:
+        dict: Metrics of the dataset.
+    """
+    # The benchmark works on its own database and bypasses the fetch cache
+    os.environ.setdefault("MONGO_DB_NAME", "imdb_benchmark")
+    os.environ["FETCH_CACHE_MAX_ENTRIES"] = "0"
+
+    from benchmarks.synthetic_movies import write_movies_csv
+    from chalicelib.common import init_support
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION, Mongo
+    from chalicelib.support import cms_api_support, csv_upload_support, index_planner_support
+
+    if in_process:
+        import mongomock
+        Mongo.get_client = lambda self: mongomock.MongoClient()
+        workers = 1  # mongomock does not accept pre-encoded BSON documents
+
+    row_count = DATASET_SIZES[size_name]
+    file_path = os.path.join(DATA_DIR, f"movies_{size_name}.csv")
+    if not os.path.exists(file_path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        write_movies_csv(file_path, row_count)
+
+    mongo = init_support.mongo
+    mongo.get_collection(MOVIES_DATA_COLLECTION).drop()
+    indexes_to_create = index_planner_support.plan_indexes()[0]
+    if in_process:
+        indexes_to_create = []  # mongomock only keeps the _id index
+    else:
+        init_support.init_mongo_collection(indexes_to_create, index_options=index_planner_support.INDEX_OPTIONS)
+
+    with open(file_path, "rb") as csv_file:
+        raw_body = csv_file.read()
+    # The memory of the ingest is measured from after the file was read, the raw body is the request's and not its own
+    reset_peak_rss()
+    rss_before_ingest = get_rss_in_mb()
+    start_time = time.perf_counter()
+    csv_upload_support.upload_csv_data(raw_body, "insert", workers=workers)
+    ingest_duration = time.perf_counter() - start_time
+    ingest_peak_rss = get_rss_in_mb("VmHWM") - rss_before_ingest
+    del raw_body
+
+    # Indexes written on each insert, the throughput of the ingest depends on them
+    write_cost = index_planner_support.get_write_cost(indexes_to_create)
+    metrics = {
+        "ingest_rows_per_second": round(row_count / ingest_duration),
+        "ingest_peak_rss_in_mb": round(ingest_peak_rss, 1),
+        "ingest_index_count": write_cost["index_count"],
+        "ingest_multikey_index_count": write_cost["multikey_index_count"]
+    }
+    for shape_name, shape in QUERY_SHAPES.items():
+        deep_page = get_deep_page(cms_api_support, shape)
+        metrics[f"{shape_name}_deep_page"] = deep_page
+        for page_name, page_num in (("first_page", 1), ("deep_page", deep_page)):
+            latencies = measure_fetch_latencies(cms_api_support, shape, page_num, iterations)
+            metrics[f"{shape_name}_{page_name}_p50_in_ms"] = percentile(latencies, 50)
+            metrics[f"{shape_name}_{page_name}_p99_in_ms"] = percentile(latencies, 99)
+
+        # Walk to the deep page once with cursors, then time fetching it
+        cursor = None
+        for _ in range(deep_page - 1):
+            cursor = cms_api_support.fetch_movies(shape["filter_params"], shape["sort_params"], 1, PAGE_SIZE,
+                                                  cursor)["next_cursor"]
+            if cursor is None:
+                break
+        if cursor:
+            latencies = measure_fetch_latencies(cms_api_support, shape, 1, iterations, cursor)
+            metrics[f"{shape_name}_deep_cursor_p50_in_ms"] = percentile(latencies, 50)
+            metrics[f"{shape_name}_deep_cursor_p99_in_ms"] = percentile(latencies, 99)
+    return metrics
+
+
+def measure_fetch_latencies(cms_api_support, shape, page_num, iterations, cursor=None):
+    latencies = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        try:
+            cms_api_support.fetch_movies(shape["filter_params"], shape["sort_params"], page_num, PAGE_SIZE, cursor)
+        except Exception:
+            pass  # pages beyond the last one still cost a query
+        latencies.append((time.perf_counter() - start_time) * 1e3)
+    return latencies
+
+
+def percentile(values, percent):
+    ordered_values = sorted(values)
+    return round(ordered_values[min(len(ordered_values) - 1, int(len(ordered_values) * percent / 100))], 3)
+
+
+def compare_with_baseline(results, baseline, threshold, require_baseline=False):
+    """
+    Returns:
+        list: Description of every metric that regressed beyond the threshold, and of every dataset size missing
+        from the baseline if require_baseline is set. Otherwise these sizes are skipped.
+    """
+    regressions = []
+    for size_name, metrics in results.items():
+        if size_name not in baseline:
+            if require_baseline:
+                regressions.append(f"{size_name}: no baseline, run with --save-baseline to record one")
+            else:
+                print(f"{size_name}: no baseline, comparison skipped")
+            continue
+        for metric, value in metrics.items():
+            baseline_value = baseline[size_name].get(metric)
+            if not baseline_value or metric.endswith("_deep_page"):
+                continue  # the deep page numbers are the pages measured, not measurements
+            change = (value - baseline_value) / baseline_value
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append(f"{size_name}.{metric}: {baseline_value} -> {value} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest and fetch benchmark suite.")
+    parser.add_argument("--sizes", nargs="+", choices=list(DATASET_SIZES), default=["10k"],
+                        help="Dataset sizes to run.")
+    parser.add_argument("--in-process", action="store_true", help="Use mongomock instead of a local mongod.")
+    parser.add_argument("--iterations", type=int, default=50, help="Fetches per query shape.")
+    parser.add_argument("--workers", type=int, default=1, help="Parsing processes used for the ingest.")
+    parser.add_argument("--baseline", default="baseline.json", help="Baseline file in benchmarks/baselines.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--require-baseline", action="store_true",
+                        help="Fail the run when there is no baseline for a size, e.g. in CI.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative regression that fails the run, 0.2 is 20%%.")
+    parser.add_argument("--run-dataset", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_dataset:
+        print(json.dumps(run_dataset(args.run_dataset, args.in_process, args.iterations, args.workers)))
+        return
+
+    results = {}
+    for size_name in args.sizes:
+        command = [sys.executable, "-m", "benchmarks.bench_suite", "--run-dataset", size_name,
+                   "--iterations", str(args.iterations), "--workers", str(args.workers)]
+        if args.in_process:
+            command.append("--in-process")
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results[size_name] = json.loads(output.strip().splitlines()[-1])
+        print(json.dumps({"dataset": size_name, **results[size_name]}))
+
+    baseline_path = os.path.join(BASELINES_DIR, args.baseline)
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True)
+        print(f"Baseline saved to {baseline_path}")
+        return
+
+    if not os.path.exists(baseline_path):
+        # Baselines depend on the machine and are not committed, a CI job keeping one passes --require-baseline
+        if args.require_baseline:
+            sys.exit(f"No baseline at {baseline_path}, run with --save-baseline to record one")
+        print(f"No baseline at {baseline_path}, comparison skipped. Run with --save-baseline to record one")
+        return
+    with open(baseline_path) as baseline_file:
+        regressions = compare_with_baseline(results, json.load(baseline_file), args.threshold,
+                                            args.require_baseline)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
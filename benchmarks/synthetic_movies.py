@@ -0,0 +1,75 @@
+import csv
+import io
+import random
+from datetime import date, timedelta
+
+CSV_HEADERS = [
+    "budget", "homepage", "original_language", "original_title", "overview", "release_date", "revenue", "runtime",
+    "status", "title", "vote_average", "vote_count", "production_company_id", "genre_id", "languages"
+]
+
+# Spoken languages with a skewed distribution, most movies are in English like in the IMDB dataset
+LANGUAGES = ["English", "Français", "Español", "Deutsch", "Italiano", "日本語", "Pусский", "हिन्दी", "普通话", "한국어"]
+LANGUAGE_WEIGHTS = [60, 8, 7, 6, 5, 4, 3, 3, 2, 2]
+
+WORDS = ["love", "war", "family", "secret", "journey", "city", "night", "friend", "dream", "storm", "king", "river",
+         "lost", "last", "game", "heart", "shadow", "fire", "home", "story"]
+
+
+def generate_movie_rows(row_count, seed=42):
+    """
+    Generate synthetic movie rows with the CSV headers expected by the upload API.
+
+    Parameters:
+        row_count (int): Number of rows to generate.
+        seed (int): Seed of the random generator, the same seed always gives the same rows.
+
+    Yields:
+        list: Values of one row, in the order of CSV_HEADERS.
+    """
+    rng = random.Random(seed)
+    first_release_date = date(1920, 1, 1)
+    for row_num in range(row_count):
+        title = " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 4))) + f" {row_num}"
+        languages = rng.choices(LANGUAGES, weights=LANGUAGE_WEIGHTS, k=rng.choice([1, 1, 1, 2, 3]))
+        # Recent years are more frequent, like in the real catalog
+        release_date = first_release_date + timedelta(days=int(36500 * rng.random() ** 0.5))
+        has_budget = rng.random() < 0.7
+        yield [
+            f"{rng.randint(1, 300) * 1e6:.1f}" if has_budget else "",
+            f"http://www.example.com/{row_num}" if rng.random() < 0.3 else "",
+            "en" if languages[0] == "English" else "xx",
+            title,
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 60))).capitalize() + ".",
+            release_date.isoformat(),
+            f"{rng.randint(0, 1000) * 1e6:.1f}" if has_budget else "0.0",
+            rng.randint(60, 200),
+            "Released",
+            title,
+            round(rng.uniform(1, 10), 1),
+            f"{rng.randint(0, 15000)}.0",
+            rng.randint(1, 5000),
+            rng.randint(1, 40),
+            str(list(dict.fromkeys(languages)))
+        ]
+
+
+def generate_movies_csv(row_count, seed=42):
+    """
+    :return: Synthetic movies CSV as bytes, in the format of the upload API.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADERS)
+    writer.writerows(generate_movie_rows(row_count, seed))
+    return buffer.getvalue().encode("utf-8")
+
+
+def write_movies_csv(file_path, row_count, seed=42):
+    """
+    Write a synthetic movies CSV to file_path, one row at a time so that large datasets never sit in memory.
+    """
+    with open(file_path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_HEADERS)
+        writer.writerows(generate_movie_rows(row_count, seed))
@@ -2,8 +2,8 @@ import json
 import os
 
 from chalice import Blueprint, Response
-from chalicelib.common import cors_support, log_support
-from chalicelib.support import cms_api_support
+from chalicelib.common import cors_support, log_support, response_support, trace_support
+from chalicelib.support import cms_api_support, export_support, facet_support, ingest_job_support
 
 
 cms_api = Blueprint(__name__)
@@ -16,43 +16,159 @@ no_api_key = False
 def upload_csv():
     """
         API to upload a csv file containing movies data.
+        With ?mode=merge, rows are upserted by title and release date and unchanged rows are skipped.
+        With ?async=true, the file is processed in the background and a job id is returned right away.
     """
+    trace_support.start_request_trace("upload_csv")
     try:
-        body = cms_api.current_request.raw_body
+        with trace_support.span("body_decode"):
+            body = cms_api.current_request.raw_body
 
-        if not body:
-            raise Exception("No file uploaded")
-        max_size = int(os.getenv("MAX_CSV_FILE_SIZE_IN_MB", 1e2))  # 100 mb by default
-        if len(body) > (max_size*1e6):
-            raise Exception(f"File size should be less than {max_size}MB")
+            if not body:
+                raise Exception("No file uploaded")
+            max_size = int(os.getenv("MAX_CSV_FILE_SIZE_IN_MB", 1e2))  # 100 mb by default
+            if len(body) > (max_size*1e6):
+                raise Exception(f"File size should be less than {max_size}MB")
 
-        response_message = cms_api_support.upload_csv_data(body)
+            query_params = cms_api.current_request.query_params or {}
+            upload_mode = query_params.get('mode', 'insert')
 
-        return Response(status_code=200, body={"message": response_message})
+        if query_params.get('async', 'false').lower() == 'true':
+            job_id = ingest_job_support.submit_upload_job(body, upload_mode)
+            return Response(status_code=202, body={"message": "Upload job submitted", "job_id": job_id,
+                                                   "status_url": f"/api/upload/jobs/{job_id}"},
+                            headers=trace_support.finish_request_trace(202))
+
+        # Imported here so that pandas is only loaded by the upload API and not on every cold start
+        from chalicelib.support import csv_upload_support
+        upload_summary = csv_upload_support.upload_csv_data(body, upload_mode)
+
+        with trace_support.span("serialization"):
+            response_body = json.dumps(upload_summary)
+        return Response(status_code=200, body=response_body,
+                        headers={"Content-Type": "application/json", **trace_support.finish_request_trace()})
     except Exception as err:
         log_support.console_log(f"Exception @upload_csv: {str(err)}")
-        return Response(status_code=502, body={"error": f"Exception @upload_csv: {str(err)}"})
+        # An upload that stopped midway reports the rows written before the error, see PartialUploadError
+        upload_counts = getattr(err, "upload_counts", None)
+        error_body = {"error": f"Exception @upload_csv: {str(err)}"}
+        if upload_counts is not None:
+            error_body.update({"partial": True, **upload_counts})
+        return Response(status_code=502, body=error_body, headers=trace_support.finish_request_trace(502))
+
+
+@cms_api.route('/api/upload/jobs/{job_id}', methods=['GET'], cors=cors_support.cors_config)
+def upload_job_status(job_id):
+    """
+        API to get the progress of an async upload: rows processed, throughput, errors and completion.
+    """
+    try:
+        job_status = ingest_job_support.get_job_status(job_id)
+        if job_status is None:
+            return Response(status_code=404, body={"error": f"Upload job {job_id} not found"})
+
+        return Response(status_code=200, body=job_status)
+    except Exception as err:
+        log_support.console_log(f"Exception @upload_job_status: {str(err)}")
+        return Response(status_code=502, body={"error": f"Exception @upload_job_status: {str(err)}"})
 
 
 @cms_api.route('/api/fetch/movies', methods=['POST'], cors=cors_support.cors_config)
 def fetch_movies():
     """
     API to get a list of movies with pagination, filtering, and sorting.
+    Pages can be requested by page number, or by passing the next_cursor of the previous page as cursor.
+    Records only contain the title, release year, rating and languages unless other fields are requested.
+    Missing values are returned as null.
     """
+    trace_support.start_request_trace("fetch_movies")
     try:
-        request_payload = json.loads(cms_api.current_request.raw_body.decode())
-        filter_params = request_payload.get('filter_params', {})
-        sort_params = request_payload.get('sort_params', {})
-        page_num = request_payload.get('page', 1)
-        size_param = request_payload.get('size', 20)
+        with trace_support.span("body_decode"):
+            request_payload = json.loads(cms_api.current_request.raw_body.decode())
 
         # Fetch movies using the utility function
-        result = cms_api_support.fetch_movies(filter_params, sort_params, page_num, size_param)
-        message = "Data fetched successfully" if len(result) > 0 else "No movie data found with the applied filter"
-        response_body = ({"message": message, "data": result})
+        response_body = cms_api_support.fetch_movies_from_spec(request_payload)
 
-        return Response(status_code=200, body=response_body)
+        # NaN values, dates and numpy values are encoded in a single pass
+        with trace_support.span("serialization"):
+            response = response_support.build_json_response(response_body)
+        response.headers.update(trace_support.finish_request_trace())
+        return response
     except Exception as err:
         log_support.console_log(f"Exception @fetch_movies: {str(err)}")
-        return Response(status_code=502, body={"error": f"Exception @fetch_movies: {str(err)}"})
+        return Response(status_code=502, body={"error": f"Exception @fetch_movies: {str(err)}"},
+                        headers=trace_support.finish_request_trace(502))
+
+
+@cms_api.route('/api/fetch/movies/batch', methods=['POST'], cors=cors_support.cors_config)
+def fetch_movies_batch():
+    """
+    API to run several fetches in one request, e.g. every list of a dashboard.
+    The body holds a list of queries in the format of the fetch API, which run concurrently.
+    Results are returned in the same order, a failed query gets an error without failing the others.
+    """
+    trace_support.start_request_trace("fetch_movies_batch")
+    try:
+        with trace_support.span("body_decode"):
+            request_payload = json.loads(cms_api.current_request.raw_body.decode())
 
+        results = cms_api_support.fetch_movies_batch(request_payload.get('queries'))
+        failed_count = sum(1 for result in results if "error" in result)
+        message = (f"{len(results) - failed_count} of {len(results)} queries fetched successfully"
+                   if failed_count else "Data fetched successfully")
+
+        with trace_support.span("serialization"):
+            response = response_support.build_json_response({"message": message, "results": results})
+        response.headers.update(trace_support.finish_request_trace())
+        return response
+    except Exception as err:
+        log_support.console_log(f"Exception @fetch_movies_batch: {str(err)}")
+        return Response(status_code=502, body={"error": f"Exception @fetch_movies_batch: {str(err)}"},
+                        headers=trace_support.finish_request_trace(502))
+
+
+@cms_api.route('/api/fetch/movies/facets', methods=['GET'], cors=cors_support.cors_config)
+def fetch_movie_facets():
+    """
+    API to get the number of movies per language and release year, and the top rated movies per language,
+    e.g. to build filter menus. They are read from a summary collection kept up to date by the uploads.
+    """
+    trace_support.start_request_trace("fetch_movie_facets")
+    try:
+        facets = facet_support.get_facets()
+
+        with trace_support.span("serialization"):
+            response = response_support.build_json_response({"message": "Facets fetched successfully", **facets})
+        response.headers.update(trace_support.finish_request_trace())
+        return response
+    except Exception as err:
+        log_support.console_log(f"Exception @fetch_movie_facets: {str(err)}")
+        return Response(status_code=502, body={"error": f"Exception @fetch_movie_facets: {str(err)}"},
+                        headers=trace_support.finish_request_trace(502))
+
+
+@cms_api.route('/api/export/movies', methods=['POST'], cors=cors_support.cors_config)
+def export_movies():
+    """
+    API to export the movies matching a filter as NDJSON (default) or CSV, with the filter and sort of the fetch API.
+    At most EXPORT_MAX_ROWS_PER_REQUEST records and EXPORT_MAX_RESPONSE_SIZE_IN_MB are returned per request,
+    the X-Next-Cursor header is then set and passing it as cursor returns the following records.
+    """
+    trace_support.start_request_trace("export_movies")
+    try:
+        with trace_support.span("body_decode"):
+            request_payload = json.loads(cms_api.current_request.raw_body.decode())
+
+        with trace_support.span("export"):
+            body, content_type, next_cursor = export_support.export_movies(
+                request_payload.get('filter_params', {}), request_payload.get('sort_params', {}),
+                request_payload.get('format', 'ndjson'), request_payload.get('fields'), request_payload.get('cursor'))
+
+        headers = {"Content-Type": content_type}
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        return Response(status_code=200, body=body, headers={**headers, **trace_support.finish_request_trace()})
+    except Exception as err:
+        log_support.console_log(f"Exception @export_movies: {str(err)}")
+        return Response(status_code=502, body={"error": f"Exception @export_movies: {str(err)}"},
+                        headers=trace_support.finish_request_trace(502))
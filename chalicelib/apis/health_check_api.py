@@ -1,11 +1,16 @@
 from chalice import Blueprint, Response
 
+from chalicelib.common import cache_support
+from chalicelib.common.init_support import mongo
+
 health_check_api = Blueprint(__name__)
 
 
 @health_check_api.route('/api/health_check', methods=['GET'])
 def health_check():
     """
-        API to ensure that the service is running.
+        API to ensure that the service is running, along with the fetch cache and Mongo connection pool counters.
     """
-    return Response(status_code=200, body={"status": "RUNNING"})
+    return Response(status_code=200, body={"status": "RUNNING",
+                                           "fetch_cache": cache_support.fetch_movies_cache.stats(),
+                                           "mongo_pool": mongo.get_pool_stats()})
@@ -0,0 +1,16 @@
+from chalice import Blueprint
+
+from chalicelib.support import ingest_job_support
+
+ingest_job_worker = Blueprint(__name__)
+
+
+# Registered on the stages with an INGEST_JOB_QUEUE only, chalice local runs the jobs on a thread pool
+if ingest_job_support.get_job_queue():
+    @ingest_job_worker.on_sqs_message(queue=ingest_job_support.get_job_queue(), batch_size=1)
+    def process_upload_job(event):
+        """
+            Worker Lambda of the async uploads, running the job of each SQS message.
+        """
+        for record in event:
+            ingest_job_support.process_upload_job_message(record.body)
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_entries, ttl_in_seconds):
+        """
+        In-process least recently used cache whose entries also expire after a fixed time.
+
+        :param max_entries: Maximum number of entries kept, the least recently used one is evicted first.
+        A value of 0 disables the cache.
+        :param ttl_in_seconds: Time after which an entry is considered stale.
+        """
+        self.max_entries = max_entries
+        self.ttl_in_seconds = ttl_in_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        :param key: Cache key
+        :param default: Value returned when the key is missing or expired
+        :return: Cached value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        :param key: Cache key
+        :param value: Value to cache, it is shared with every caller and must not be mutated
+        """
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_in_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: Counters used to size the cache.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_in_seconds": self.ttl_in_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+
+def get_dataset_generation():
+    """
+    :return: Generation number of the movies dataset, it changes whenever new data is uploaded.
+    """
+    return dataset_generation
+
+
+def bump_dataset_generation():
+    """
+    Mark the movies dataset as changed, invalidating every cached fetch result of this process.
+    Other processes only see the change once their entries expire.
+    """
+    global dataset_generation, dataset_changed_at
+    with generation_lock:
+        dataset_generation += 1
+        dataset_changed_at = time.monotonic()
+    fetch_movies_cache.clear()
+
+
+def is_dataset_recently_changed():
+    """
+    Secondaries may not have replicated the data this process just wrote. Results read from them during a cache TTL
+    after the change would be cached under the new generation while still holding the previous data.
+
+    :return: True during a cache TTL after this process changed the dataset
+    """
+    return dataset_changed_at is not None and time.monotonic() - dataset_changed_at < fetch_movies_cache.ttl_in_seconds
+
+
+dataset_generation = 0
+dataset_changed_at = None
+generation_lock = threading.Lock()
+fetch_movies_cache = LRUCache(max_entries=int(os.getenv("FETCH_CACHE_MAX_ENTRIES", 256)),
+                              ttl_in_seconds=float(os.getenv("FETCH_CACHE_TTL_IN_SECONDS", 60)))
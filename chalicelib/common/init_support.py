@@ -1,43 +1,67 @@
-from pymongo import ASCENDING, DESCENDING
-
 from chalicelib.common import log_support
 from chalicelib.common.mongo_collections import Mongo, DB_NAME, MOVIES_DATA_COLLECTION
 
 
-def init_mongo_collection():
-    try:
-        indexes_to_create = [
-            # ([("release_date", DESCENDING)], "release_date_index"),
-            # ([("vote_average", DESCENDING)], "ratings_index"),
-            # ([("languages", ASCENDING), ("release_date", DESCENDING)], "language_release_date_index"),
-            ([("release_year", DESCENDING)], "release_year_index"),
-            ([("languages", ASCENDING)], "languages_index"),
-            ([("languages", ASCENDING), ("vote_average", DESCENDING)], "language_ratings_index"),
-            ([("languages", ASCENDING), ("release_date", DESCENDING), ("vote_average", DESCENDING)], "language_release_date_ratings_index"),
-        ]
+def get_index_fields(index):
+    """
+    :param index: Index as listed by list_indexes
+    :return: Index fields as (key, direction) tuples. A text index is listed with internal keys and its
+    text fields as weights, they are turned back into (field, "text") tuples.
+    """
+    if "weights" not in index:
+        return list(index["key"].items())
+    prefix_fields = [(key, direction) for key, direction in index["key"].items() if key not in ("_fts", "_ftsx")]
+    return normalise_index_fields(prefix_fields + [(field, "text") for field in index["weights"]])
+
+
+def normalise_index_fields(index_fields):
+    """
+    :return: Index fields with the text fields sorted, as their order does not matter in a text index
+    """
+    text_fields = sorted(field for field in index_fields if field[1] == "text")
+    return [field for field in index_fields if field[1] != "text"] + text_fields
+
 
+def init_mongo_collection(indexes_to_create, drop_unplanned=False, index_options=None):
+    """
+    Create the indexes of the movies collection that do not exist yet. It is safe to run repeatedly and
+    is meant to be run as a setup or deploy step through `python manage.py init-indexes`.
+
+    :param indexes_to_create: List of (index fields, index name) tuples, see index_planner_support.plan_indexes
+    :param drop_unplanned: Drop the existing indexes that are not part of indexes_to_create
+    :param index_options: create_index options by index name, e.g. the weights of a text index
+    """
+    try:
         existing_indexes = list(mongo.get_indexes(MOVIES_DATA_COLLECTION))
 
-        for index_fields, index_name in indexes_to_create:
-            index_key = dict(index_fields)
+        if drop_unplanned:
+            planned_keys = [normalise_index_fields(index_fields) for index_fields, _ in indexes_to_create]
+            for existing_index in existing_indexes:
+                if existing_index["name"] != "_id_" and get_index_fields(existing_index) not in planned_keys:
+                    mongo.drop_index(MOVIES_DATA_COLLECTION, existing_index["name"])
+                    log_support.console_log(f"Index '{existing_index['name']}' is not planned, dropped it.")
+            existing_indexes = list(mongo.get_indexes(MOVIES_DATA_COLLECTION))
 
-            # Checking if the index already exists
+        for index_fields, index_name in indexes_to_create:
+            # Checking if the index already exists, the order of the fields matters for a compound index
             index_exists = False
             for existing_index in existing_indexes:
-                if existing_index["key"] == index_key and existing_index.get("name") == index_name:
+                if get_index_fields(existing_index) == normalise_index_fields(index_fields):
                     index_exists = True
-                    log_support.console_log(f"Index '{index_name}' with fields {index_fields} already exists.")
+                    log_support.console_log(f"Index '{existing_index['name']}' with fields {index_fields} "
+                                            f"already exists.")
                     break
 
             # If the index does not exist, create it
             if not index_exists:
                 log_support.console_log(f"Index '{index_name}' with fields {index_fields} does not exist.")
-                created_index = mongo.create_index(MOVIES_DATA_COLLECTION, fields=index_fields, name=index_name)
+                created_index = mongo.create_index(MOVIES_DATA_COLLECTION, fields=index_fields, name=index_name,
+                                                   **(index_options or {}).get(index_name, {}))
                 log_support.console_log(f"Index '{created_index}' created.")
 
     except Exception as err:
         log_support.console_log(f"Exception while initialising mongodb: {str(err)}")
+        raise
 
 
 mongo = Mongo(DB_NAME)
-init_mongo_collection()
@@ -1,10 +1,38 @@
 import json
-from datetime import datetime
+import os
+import random
+import time
 
 
-def console_log(message):
+def get_log_timestamp():
+    """
+    :return: Current UTC time formatted to the second, formatted again only once per second.
+    """
+    global cached_timestamp
+    current_second = int(time.time())
+    # A single tuple is swapped in so that concurrent threads never see a second and a timestamp that do not match
+    timestamp_second, timestamp = cached_timestamp
+    if timestamp_second != current_second:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(current_second))
+        cached_timestamp = (current_second, timestamp)
+    return timestamp
+
+
+def console_log(message, sampled=False, **fields):
+    """
+    :param message: Message to log
+    :param sampled: Only log a LOG_SAMPLE_RATE share of the calls, for logs emitted on every request
+    :param fields: Structured fields added to the log line
+    """
+    if sampled and random.random() >= log_sample_rate:
+        return
     log_json = {
         "message": message,
-        "log_timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        "log_timestamp": get_log_timestamp(),
+        **fields
     }
-    print(json.dumps(log_json))
+    print(json.dumps(log_json, default=str))
+
+
+cached_timestamp = (None, None)
+log_sample_rate = float(os.getenv("LOG_SAMPLE_RATE", 1))
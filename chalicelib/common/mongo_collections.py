@@ -1,10 +1,132 @@
 import os
+import threading
+import time
 import urllib.parse
-from pymongo import MongoClient
+from bson.son import SON
+from pymongo import MongoClient, ReadPreference, WriteConcern, monitoring
 
+from chalicelib.common import cache_support, trace_support
 
-DB_NAME = 'imdb'
+
+DB_NAME = os.getenv("MONGO_DB_NAME", 'imdb')
 MOVIES_DATA_COLLECTION = "movies_data"
+INGEST_JOBS_COLLECTION = "ingest_jobs"
+MOVIES_FACETS_COLLECTION = "movies_facets"
+DATASET_VERSIONS_COLLECTION = "dataset_versions"
+
+# Read preferences accepted by the MONGO_FETCH_READ_PREFERENCE env variable
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+def get_client_options():
+    """
+    :return: MongoClient keyword arguments for the pool size, timeouts and wire compression, read from env variables.
+    """
+    client_options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", 0)),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000)),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 20000)),
+        # Compression is only used when the server supports it as well, otherwise messages are sent uncompressed
+        "compressors": os.getenv("MONGO_COMPRESSORS", "zlib"),
+        "zlibCompressionLevel": int(os.getenv("MONGO_ZLIB_COMPRESSION_LEVEL", -1)),
+    }
+    # Without a socket timeout, operations wait for the server as long as it takes
+    if os.getenv("MONGO_SOCKET_TIMEOUT_MS"):
+        client_options["socketTimeoutMS"] = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS"))
+    return client_options
+
+
+def get_read_preference(name):
+    """
+    :param name: Read preference mode, as set in the MONGO_FETCH_READ_PREFERENCE env variable
+    :return: ReadPreference
+    :raises ValueError: If the mode is not one of READ_PREFERENCES
+    """
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"Invalid MONGO_FETCH_READ_PREFERENCE {name}. Expected one of: {', '.join(READ_PREFERENCES)}")
+    return READ_PREFERENCES[name]
+
+
+def get_write_concern(w):
+    """
+    :param w: Number of members that must acknowledge a write, or a tag such as "majority"
+    :return: WriteConcern
+    """
+    return WriteConcern(w=int(w) if str(w).isdigit() else w)
+
+
+class ConnectionPoolStats(monitoring.ConnectionPoolListener):
+    """
+    Counters of the connection pools of a client, exposed through the health check.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.check_out_started_at = threading.local()
+        self.counters = {
+            "open_connections": 0,
+            "connections_in_use": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "check_outs": 0,
+            "check_out_failures": 0,
+            "pools_cleared": 0,
+            "max_check_out_wait_in_ms": 0.0,
+        }
+
+    def increment(self, **counts):
+        with self.lock:
+            for counter, count in counts.items():
+                self.counters[counter] += count
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.increment(pools_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment(open_connections=1, connections_created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment(open_connections=-1, connections_closed=1)
+
+    def connection_check_out_started(self, event):
+        self.check_out_started_at.time = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self.increment(check_out_failures=1)
+
+    def connection_checked_out(self, event):
+        wait_in_ms = (time.perf_counter() - getattr(self.check_out_started_at, "time", time.perf_counter())) * 1e3
+        with self.lock:
+            self.counters["check_outs"] += 1
+            self.counters["connections_in_use"] += 1
+            self.counters["max_check_out_wait_in_ms"] = max(self.counters["max_check_out_wait_in_ms"],
+                                                            round(wait_in_ms, 3))
+
+    def connection_checked_in(self, event):
+        self.increment(connections_in_use=-1)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
 
 
 class Mongo:
@@ -17,23 +139,70 @@ class Mongo:
         self.db_name = db_name
         self.mongo_connection_string = os.getenv("MONGO_CONNECTION_STRING")
         self.mongo_password = os.getenv("MONGODB_PASSWORD")
-        self.client = self.get_client()
-        self.http_timeout = 60
+        self.client_options = get_client_options()
+        # Read-only fetch traffic can be sent to secondaries, while ingestion writes only wait for the primary
+        self.fetch_read_preference = get_read_preference(os.getenv("MONGO_FETCH_READ_PREFERENCE", "primary"))
+        self.ingest_write_concern = get_write_concern(os.getenv("MONGO_INGEST_WRITE_CONCERN", 1))
+        self.pool_stats = ConnectionPoolStats()
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        :return: MongoClient, created on first use so that importing the app does not open connections.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.get_client()
+        return self._client
 
     def get_client(self):
         # Provide the mongodb atlas url to connect python to mongodb using pymongo
         CONNECTION_STRING = str(self.mongo_connection_string).replace("{password}",
                                                                       urllib.parse.quote(self.mongo_password))
-        client = MongoClient(CONNECTION_STRING)
+        # Command timings are recorded on the trace of the current request, see trace_support
+        client = MongoClient(CONNECTION_STRING, event_listeners=[trace_support.command_listener, self.pool_stats],
+                             **self.client_options)
         return client
 
-    def get_collection(self, collection_name):
+    def get_fetch_read_preference(self):
+        """
+        Results of the fetch APIs are cached under the current dataset generation. Right after an upload handled by
+        this process they are read from the primary, so that a lagging secondary cannot cache the previous data.
+
+        :return: Read preference of the cached fetch reads
+        """
+        if cache_support.is_dataset_recently_changed():
+            return ReadPreference.PRIMARY
+        return self.fetch_read_preference
+
+    def get_collection(self, collection_name, read_preference=None, write_concern=None):
         """
         :param collection_name: returns the collection
+        :param read_preference: Read preference of the operations on the returned collection, primary by default
+        :param write_concern: Write concern of the operations on the returned collection, the client's by default
         :return:
         """
         client = self.client
-        return client[self.db_name][collection_name]
+        collection = client[self.db_name][collection_name]
+        if read_preference is not None or write_concern is not None:
+            collection = collection.with_options(read_preference=read_preference, write_concern=write_concern)
+        return collection
+
+    def get_pool_stats(self):
+        """
+        :return: Connection pool settings and counters, without creating the client if it does not exist yet.
+        """
+        return {
+            "client_created": self._client is not None,
+            "max_pool_size": self.client_options["maxPoolSize"],
+            "min_pool_size": self.client_options["minPoolSize"],
+            "compressors": self.client_options["compressors"],
+            "fetch_read_preference": self.fetch_read_preference.mongos_mode,
+            **self.pool_stats.stats()
+        }
 
     def get_indexes(self, collection_name):
         """
@@ -45,26 +214,62 @@ class Mongo:
 
         return indexes
 
-    def create_index(self, collection_name, fields, name):
+    def create_index(self, collection_name, fields, name, **options):
         """
         :param collection_name: The name of the collection in which the index will be created
         :param fields: Index fields that will be created
         :param name: Name of the index that will be created
+        :param options: Additional create_index options, e.g. the weights of a text index
         desc: create indexes on collections to improve the performance of queries.
         :return: index name
         """
         collection = self.get_collection(collection_name)
-        category_index = collection.create_index(fields, name=name)
+        category_index = collection.create_index(fields, name=name, **options)
         return category_index
 
-    def insert_many_document(self, collection_name, documents):
+    def drop_index(self, collection_name, name):
+        """
+        :param collection_name: The name of the collection from which the index will be dropped
+        :param name: Name of the index that will be dropped
+        """
+        collection = self.get_collection(collection_name)
+        collection.drop_index(name)
+
+    def set_validator(self, collection_name, validator, validation_level="moderate"):
+        """
+        :param collection_name: The name of the collection, created if it does not exist yet
+        :param validator: Validator the written documents must match, e.g. a $jsonSchema
+        :param validation_level: "moderate" leaves the updates of existing invalid documents unchecked,
+        "strict" checks every write
+        desc: declare the schema of a collection in MongoDB, so that writes not following it are rejected.
+        """
+        database = self.client[self.db_name]
+        if collection_name in database.list_collection_names(filter={"name": collection_name}):
+            database.command("collMod", collection_name, validator=validator, validationLevel=validation_level)
+        else:
+            database.create_collection(collection_name, validator=validator, validationLevel=validation_level)
+
+    def insert_many_document(self, collection_name, documents, ordered=True, write_concern=None):
         """
         :param collection_name: The name of the collection in which the document will be inserted
         :param documents: Document that will be inserted in the collection
+        :param ordered: If False, the server keeps inserting the remaining documents after a failed one
+        :param write_concern: Write concern of the insert, e.g. ingest_write_concern for bulk ingestion
         :return: Generic PyMongo response for "insert_many"
         """
-        collection = self.get_collection(collection_name)
-        return collection.insert_many(documents)
+        collection = self.get_collection(collection_name, write_concern=write_concern)
+        return collection.insert_many(documents, ordered=ordered)
+
+    def bulk_write(self, collection_name, operations, ordered=True, write_concern=None):
+        """
+        :param collection_name: The name of the collection in which the operations will be applied
+        :param operations: List of pymongo write operations, e.g. ReplaceOne or UpdateOne
+        :param ordered: If False, the server keeps applying the remaining operations after a failed one
+        :param write_concern: Write concern of the operations, e.g. ingest_write_concern for bulk ingestion
+        :return: Generic PyMongo response for "bulk_write"
+        """
+        collection = self.get_collection(collection_name, write_concern=write_concern)
+        return collection.bulk_write(operations, ordered=ordered)
 
     def insert_document(self, collection_name, document):
         """
@@ -75,8 +280,29 @@ class Mongo:
         collection = self.get_collection(collection_name)
         return collection.insert_one(document)
 
+    def update_document(self, collection_name, filter_params, update_query, upsert=False):
+        """
+        :param collection_name: The name of the collection in which the document will be updated
+        :param filter_params: Filter matching the document to update
+        :param update_query: Update operators to apply, e.g. {"$set": {...}}
+        :param upsert: Insert the document when none matches the filter
+        :return: Generic PyMongo response for "update_one"
+        """
+        collection = self.get_collection(collection_name)
+        return collection.update_one(filter_params, update_query, upsert=upsert)
+
+    def fetch_document(self, collection_name, filter_params, projection_query=None):
+        """
+        :param collection_name:
+        :param filter_params:
+        :param projection_query:
+        :return: First document matching the filter, None if there is none.
+        """
+        collection = self.get_collection(collection_name)
+        return collection.find_one(filter_params, projection=projection_query)
+
     def fetch_records_with_query(self, collection_name, filter_params=None, sort_params=None, start_index=None,
-                                 size=None, projection_query=None):
+                                 size=None, projection_query=None, read_preference=None):
         """
         :param collection_name:
         :param filter_params:
@@ -84,11 +310,12 @@ class Mongo:
         :param start_index:
         :param size:
         :param projection_query:
+        :param read_preference: Read preference of the query, e.g. fetch_read_preference for the fetch API
         :return: List of records filtered through pagination i.e.e skip and limit with fields mentioned in projection query.
         """
         if projection_query is None:
             projection_query = {}
-        collection = self.get_collection(collection_name)
+        collection = self.get_collection(collection_name, read_preference=read_preference)
         args = []
         kwargs = {}
         if filter_params:
@@ -96,15 +323,103 @@ class Mongo:
         if projection_query:
             kwargs.update(projection=projection_query)
 
-        query_result = collection.find(*args, **kwargs)
+        with trace_support.span("find"):
+            query_result = collection.find(*args, **kwargs)
+            if sort_params:
+                query_result = query_result.sort(sort_params)
+            if start_index:
+                query_result = query_result.skip(start_index)
+            if size:
+                query_result = query_result.limit(size)
+        # The query is only sent once the cursor is iterated
+        with trace_support.span("cursor_iteration"):
+            records = list(query_result)
+        return records
+
+    def iterate_records_with_query(self, collection_name, filter_params=None, sort_params=None, size=None,
+                                   projection_query=None, batch_size=None, read_preference=None):
+        """
+        :param collection_name:
+        :param filter_params:
+        :param sort_params:
+        :param size: Maximum number of records, all the matching ones by default
+        :param projection_query:
+        :param batch_size: Number of records the server returns per round trip
+        :param read_preference: Read preference of the query
+        :return: Server cursor iterating over the records, without loading them all in memory.
+        """
+        collection = self.get_collection(collection_name, read_preference=read_preference)
+        query_result = collection.find(filter_params or {}, projection=projection_query or None)
         if sort_params:
             query_result = query_result.sort(sort_params)
-        if start_index:
-            query_result = query_result.skip(start_index)
         if size:
             query_result = query_result.limit(size)
-        records = list(query_result)
-        return records
+        if batch_size:
+            query_result = query_result.batch_size(batch_size)
+        return query_result
+
+    def fetch_records_with_total(self, collection_name, filter_params=None, sort_params=None, start_index=None,
+                                 size=None, projection_query=None, page_filter_params=None, read_preference=None):
+        """
+        :param collection_name:
+        :param filter_params:
+        :param sort_params:
+        :param start_index:
+        :param size:
+        :param projection_query:
+        :param page_filter_params: Additional filter applied to the page only, e.g. a keyset cursor condition
+        :param read_preference: Read preference of the query, e.g. fetch_read_preference for the fetch API
+        :return: Tuple of the requested page of records and the number of records matching filter_params,
+        both computed by a single $facet aggregation. Its output is one document, so the page has to fit in 16MB.
+        """
+        collection = self.get_collection(collection_name, read_preference=read_preference)
+        pipeline = []
+        if filter_params:
+            pipeline.append({"$match": filter_params})
+        if sort_params:
+            # Sorting before $facet lets the server use an index for it
+            pipeline.append({"$sort": SON(sort_params)})
+
+        page_pipeline = []
+        if page_filter_params:
+            page_pipeline.append({"$match": page_filter_params})
+        page_pipeline.append({"$skip": start_index or 0})
+        if size:
+            page_pipeline.append({"$limit": size})
+        if projection_query:
+            page_pipeline.append({"$project": projection_query})
+
+        pipeline.append({"$facet": {"records": page_pipeline, "total": [{"$count": "count"}]}})
+        with trace_support.span("count_and_find"):
+            result = next(collection.aggregate(pipeline), {})
+        total = result.get("total") or [{"count": 0}]
+        return result.get("records", []), total[0]["count"]
+
+    def aggregate(self, collection_name, pipeline, read_preference=None):
+        """
+        :param collection_name:
+        :param pipeline: List of aggregation stages
+        :param read_preference: Read preference of the aggregation
+        :return: List of the documents output by the pipeline
+        """
+        collection = self.get_collection(collection_name, read_preference=read_preference)
+        return list(collection.aggregate(pipeline, allowDiskUse=True))
+
+    def explain_query(self, collection_name, filter_params=None, sort_params=None, size=None):
+        """
+        :param collection_name:
+        :param filter_params:
+        :param sort_params:
+        :param size:
+        :return: Output of the explain command for the find query, used to check which plan the server picks.
+        """
+        collection = self.get_collection(collection_name)
+        query_result = collection.find(filter_params or {})
+        if sort_params:
+            query_result = query_result.sort(sort_params)
+        if size:
+            query_result = query_result.limit(size)
+        return query_result.explain()
 
     def count_documents_by_filter(self, collection_name, query):
         """
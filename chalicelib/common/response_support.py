@@ -0,0 +1,75 @@
+import json
+import math
+from datetime import date, datetime
+from bson import ObjectId
+from chalice import Response
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard json module is used without it
+    orjson = None
+
+
+def default_encoder(value):
+    """
+    Encode the values the JSON encoder does not support natively.
+
+    :param value: Value found in the response body
+    :return: JSON compatible version of the value
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    # numpy scalars and arrays, matched by their methods so that numpy is not imported by the fetch API
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def replace_non_finite_floats(value):
+    """
+    :return: Copy of value in which NaN and infinite floats, e.g. a missing budget, are replaced by None
+    """
+    if isinstance(value, dict):
+        return {key: replace_non_finite_floats(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [replace_non_finite_floats(item) for item in value]
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if hasattr(value, "tolist") and not isinstance(value, (str, bytes)):
+        return replace_non_finite_floats(value.tolist())
+    return value
+
+
+def encode_json(body):
+    """
+    Serialise a response body to standard JSON in which NaN is written as null.
+
+    :param body: Response body
+    :return: JSON encoded body
+    """
+    if orjson is not None:
+        # orjson writes NaN as null and encodes dates and numpy values itself, in a single pass
+        return orjson.dumps(body, default=default_encoder, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    try:
+        return json.dumps(body, default=default_encoder, allow_nan=False, separators=(',', ':'))
+    except ValueError:
+        # Only pages holding a NaN pay for the second pass
+        return json.dumps(replace_non_finite_floats(body), default=default_encoder, allow_nan=False,
+                          separators=(',', ':'))
+
+
+def build_json_response(body, status_code=200, headers=None):
+    """
+    Serialise the body with encode_json rather than letting Chalice run the standard json module over it.
+    Responses are gzipped by API Gateway when the client accepts it, see minimum_compression_size
+    in .chalice/config.json.
+
+    :param body: Response body
+    :param status_code: Status code of the response
+    :param headers: Additional response headers
+    :return: Chalice Response
+    """
+    return Response(status_code=status_code, body=encode_json(body),
+                    headers={"Content-Type": "application/json", **(headers or {})})
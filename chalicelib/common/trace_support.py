@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+
+from chalicelib.common import log_support
+
+# Fields of a command sent by the driver rather than by the application, left out of explain and the logs
+DRIVER_COMMAND_FIELDS = {"lsid", "$clusterTime", "$db", "$readPreference", "txnNumber", "signature", "apiVersion"}
+
+# Commands that read documents, the only ones checked against the slow query threshold
+QUERY_COMMANDS = {"find", "aggregate", "count", "getMore"}
+
+
+class RequestTrace:
+    def __init__(self, route):
+        """
+        Timings of a single request, collected on the thread handling it.
+
+        :param route: Name of the route handling the request
+        """
+        self.route = route
+        self.start_time = time.perf_counter()
+        self.spans = dict()
+        self.mongo_commands = dict()
+        self.slow_queries = []
+        # A request may run work on other threads, e.g. the queries of a batch fetch, see run_with_trace
+        self.lock = threading.Lock()
+
+    def add_span(self, name, duration_in_ms):
+        # Spans entered several times in a request, e.g. once per CSV chunk, add up
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0) + duration_in_ms
+
+    def add_mongo_command(self, command_name, duration_in_ms, docs_returned):
+        with self.lock:
+            command_stats = self.mongo_commands.setdefault(command_name,
+                                                           {"count": 0, "duration_in_ms": 0, "docs_returned": 0})
+            command_stats["count"] += 1
+            command_stats["duration_in_ms"] += duration_in_ms
+            command_stats["docs_returned"] += docs_returned
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Record the duration and the documents returned of every command on the trace of the current request,
+    and log the queries slower than SLOW_QUERY_THRESHOLD_IN_MS with their filter and sort shape.
+    The callbacks run on the thread executing the command, so they must stay cheap and must not send commands.
+    """
+
+    def __init__(self):
+        self.pending_commands = dict()
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in QUERY_COMMANDS:
+            command = {key: value for key, value in event.command.items() if key not in DRIVER_COMMAND_FIELDS}
+            with self.lock:
+                self.pending_commands[event.request_id] = command
+
+    def succeeded(self, event):
+        with self.lock:
+            command = self.pending_commands.pop(event.request_id, None)
+        duration_in_ms = event.duration_micros / 1e3
+        docs_returned = get_docs_returned(event.reply)
+
+        trace = get_current_trace()
+        if trace is not None:
+            trace.add_mongo_command(event.command_name, duration_in_ms, docs_returned)
+
+        if command is not None and duration_in_ms >= slow_query_threshold_in_ms:
+            slow_query = {
+                "command": event.command_name,
+                "database": event.database_name,
+                "duration_in_ms": round(duration_in_ms, 3),
+                "docs_returned": docs_returned,
+                **get_query_shape(event.command_name, command)
+            }
+            if trace is not None and is_slow_query_explain_enabled():
+                # Explained once the request is done, a listener must not send commands itself
+                trace.slow_queries.append((slow_query, command))
+            else:
+                log_support.console_log("Slow query", **slow_query)
+
+    def failed(self, event):
+        with self.lock:
+            self.pending_commands.pop(event.request_id, None)
+        trace = get_current_trace()
+        if trace is not None:
+            trace.add_mongo_command(f"{event.command_name}_failed", event.duration_micros / 1e3, 0)
+
+
+def is_slow_query_explain_enabled():
+    """
+    Explaining a slow query adds the documents examined to its log, at the cost of running it once more.
+    """
+    return os.getenv("SLOW_QUERY_EXPLAIN_ENABLED", "False").lower() == "true"
+
+
+def get_docs_returned(reply):
+    """
+    :param reply: Reply of a command
+    :return: Number of documents in the batch returned by a query, or written by a write command
+    """
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    return reply.get("n", 0)
+
+
+def get_query_shape(command_name, command):
+    """
+    :param command_name: Name of the query command
+    :param command: The command, without the fields added by the driver
+    :return: Collection, filter and sort of the query, with every filter value replaced by "?"
+    """
+    if command_name == "aggregate":
+        pipeline = command.get("pipeline", [])
+        filter_params = next((stage["$match"] for stage in pipeline if "$match" in stage), {})
+        sort_params = next((stage["$sort"] for stage in pipeline if "$sort" in stage), None)
+    else:
+        filter_params = command.get("filter", command.get("query", {}))
+        sort_params = command.get("sort")
+    return {
+        "collection": command.get(command_name),
+        "filter_shape": mask_filter_values(filter_params),
+        "sort": dict(sort_params) if sort_params else None
+    }
+
+
+def mask_filter_values(value):
+    """
+    :return: The filter with the same fields and operators, and "?" in place of every value
+    """
+    if isinstance(value, dict):
+        return {key: mask_filter_values(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [mask_filter_values(item) for item in value]
+    return "?"
+
+
+def find_stat(explain_output, stat_name):
+    """
+    :return: First value of stat_name found in the explain output, its location differs between find and aggregate
+    """
+    if isinstance(explain_output, dict):
+        if stat_name in explain_output:
+            return explain_output[stat_name]
+        items = explain_output.values()
+    elif isinstance(explain_output, list):
+        items = explain_output
+    else:
+        return None
+    for item in items:
+        value = find_stat(item, stat_name)
+        if value is not None:
+            return value
+    return None
+
+
+def explain_slow_query(slow_query, command):
+    """
+    :return: The slow query log fields, with the documents examined reported by explain
+    """
+    from chalicelib.common.init_support import mongo
+
+    try:
+        explain_output = mongo.client[slow_query["database"]].command(
+            {"explain": command, "verbosity": "executionStats"})
+        slow_query["docs_examined"] = find_stat(explain_output, "totalDocsExamined")
+    except Exception as err:
+        slow_query["explain_error"] = str(err)
+    return slow_query
+
+
+def get_current_trace():
+    """
+    :return: Trace of the request handled by the current thread, None outside a request
+    """
+    return getattr(request_context, "trace", None)
+
+
+def start_request_trace(route):
+    """
+    :param route: Name of the route handling the request
+    :return: Trace collecting the spans and the Mongo commands of the request
+    """
+    request_context.trace = RequestTrace(route)
+    return request_context.trace
+
+
+def run_with_trace(trace, function, *args):
+    """
+    Run function on the current thread, e.g. a pool thread, recording its spans and Mongo commands on trace.
+    Spans of work running concurrently add up, so they can exceed the duration of the request.
+    """
+    request_context.trace = trace
+    try:
+        return function(*args)
+    finally:
+        request_context.trace = None
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed block as a span of the current request, does nothing outside a request.
+    """
+    trace = get_current_trace()
+    if trace is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, (time.perf_counter() - start_time) * 1e3)
+
+
+def finish_request_trace(status_code=200):
+    """
+    Log the trace of the current request, sampled with LOG_SAMPLE_RATE, along with its slow queries.
+
+    :param status_code: Status code of the response
+    :return: Headers exposing the spans to the client as a Server-Timing header
+    """
+    trace = get_current_trace()
+    if trace is None:
+        return {}
+    request_context.trace = None
+
+    for slow_query, command in trace.slow_queries:
+        log_support.console_log("Slow query", route=trace.route, **explain_slow_query(slow_query, command))
+
+    duration_in_ms = (time.perf_counter() - trace.start_time) * 1e3
+    spans = {name: round(span_duration, 3) for name, span_duration in trace.spans.items()}
+    mongo_commands = {command_name: {**command_stats, "duration_in_ms": round(command_stats["duration_in_ms"], 3)}
+                      for command_name, command_stats in trace.mongo_commands.items()}
+    log_support.console_log("Request trace", sampled=True, route=trace.route, status_code=status_code,
+                            duration_in_ms=round(duration_in_ms, 3), spans=spans,
+                            mongo_commands=mongo_commands)
+
+    server_timing = [f"{name};dur={span_duration}" for name, span_duration in spans.items()]
+    server_timing.append(f"total;dur={round(duration_in_ms, 3)}")
+    return {"Server-Timing": ", ".join(server_timing)}
+
+
+request_context = threading.local()
+command_listener = MongoCommandListener()
+slow_query_threshold_in_ms = float(os.getenv("SLOW_QUERY_THRESHOLD_IN_MS", 100))
@@ -1,77 +1,112 @@
-import ast
-import pandas as pd
-from io import StringIO
+import base64
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bson import json_util
 from chalice import BadRequestError
 
-from chalicelib.common import log_support
+from chalicelib.common import cache_support, log_support, trace_support
 from chalicelib.common.init_support import mongo
 from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
 
 
-def upload_csv_data(raw_body):
+# Keys of the movies collection that fetch_movies can filter and sort on, see index_planner_support
+FILTER_KEYS_TO_KEEP = ("languages", "release_year")
+SORT_KEYS_TO_KEEP = ("vote_average", "release_date", "release_year")
+
+# Fields fetch_movies can return, and the compact set returned to list views when no fields are requested.
+# The list view trims the response, not the reads: title and the multikey languages are in no planned index, so
+# a list query still fetches each document of the page.
+FIELDS_TO_KEEP = (
+    "budget", "homepage", "original_language", "original_title",
+    "overview", "release_date", "release_year", "revenue", "runtime",
+    "status", "title", "vote_average", "vote_count",
+    "production_company_id", "genre_id", "languages"
+)
+LIST_VIEW_FIELDS = ("title", "release_year", "vote_average", "languages")
+
+# Search terms are matched against the text index over title, original_title and overview, see index_planner_support
+MAX_SEARCH_LENGTH = 200
+SEARCH_SORT_ORDER_PARAMS = [("score", {"$meta": "textScore"}), ("_id", 1)]
+
+
+def is_equality_filter(value):
+    """
+    :param value: Value of a filter param
+    :return: True if the filter matches a single value rather than using a query operator.
     """
-    Process the raw CSV data from the request body,
-    validate headers, and insert data into MongoDB.
+    return not isinstance(value, (dict, list))
+
+
+def encode_cursor(sort_order_params, last_record):
+    """
+    Build the opaque cursor token pointing right after the last record of a page.
 
     Parameters:
-        raw_body (bytes): The raw body of the CSV request.
+        :param sort_order_params: List of (key, direction) tuples the page was sorted with, ending with _id
+        :param last_record: Last record of the page, it must still contain the sort keys and _id
 
     Returns:
-        str: Success message after processing the data.
-
-    Raises:
-        BadRequestError: If headers are invalid or if any other issue occurs.
+        str: URL safe base64 token.
     """
-    expected_headers = {
-        "budget", "homepage", "original_language", "original_title",
-        "overview", "release_date", "revenue", "runtime",
-        "status", "title", "vote_average", "vote_count",
-        "production_company_id", "genre_id", "languages"
+    cursor_payload = {
+        "sort": [[key, direction] for key, direction in sort_order_params],
+        "values": [last_record.get(key) for key, _ in sort_order_params]
     }
-    try:
+    return base64.urlsafe_b64encode(json_util.dumps(cursor_payload).encode()).decode()
 
-        # Decode raw body
-        body = raw_body.decode('utf-8')
 
-        # Read CSV into a DataFrame
-        df = pd.read_csv(StringIO(body))
+def decode_cursor(cursor, sort_order_params):
+    """
+    Decode a cursor token and ensure it was issued for the same sort order.
 
-        # Validate headers
-        if set(df.columns) != expected_headers:
-            raise BadRequestError(f"Invalid CSV headers. Expected: {str(expected_headers)}")
+    Returns:
+        list: Sort key values of the last record of the previous page.
 
-        if 'release_date' in df.columns:
-            df['release_year'] = pd.to_datetime(df['release_date'], errors='coerce').dt.year
+    Raises:
+        BadRequestError: If the token is malformed or was issued for a different sort order.
+    """
+    try:
+        cursor_payload = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        cursor_sort = [(key, direction) for key, direction in cursor_payload["sort"]]
+        cursor_values = cursor_payload["values"]
+    except Exception:
+        raise BadRequestError("Invalid cursor, please use the next_cursor returned by the previous page")
+    if cursor_sort != sort_order_params or len(cursor_values) != len(sort_order_params):
+        raise BadRequestError("Cursor does not match the requested sort params")
+    return cursor_values
 
-        # Converting languages column to array type
-        if 'languages' in df.columns:
-            df['languages'] = df['languages'].apply(lambda x: ast.literal_eval(x) if pd.notna(x) else [])
 
-        # Convert DataFrame to a list of dictionaries
-        documents = df.to_dict(orient='records')  # Convert to list of dicts for MongoDB
+def build_keyset_filter(sort_order_params, cursor_values):
+    """
+    Build the filter selecting the records sorted after the cursor position, i.e.
+    (k1 > v1) or (k1 = v1 and k2 > v2) or ... with the comparison flipped for descending keys.
 
-        # Perform bulk insert, using insert_many to ensure atomic operation
-        if documents:
-            mongo.insert_many_document(MOVIES_DATA_COLLECTION, documents)
-        else:
-            raise pd.errors.EmptyDataError(f"No data found in the CSV")
+    Null or missing values sort before every other value, so they are placed accordingly.
 
-        return "Data uploaded successfully"
+    Returns:
+        list: Branches of the $or query, empty if nothing can come after the cursor.
+    """
+    branches = []
+    for position, (key, direction) in enumerate(sort_order_params):
+        value = cursor_values[position]
+        if direction == 1:
+            after_condition = {"$ne": None} if value is None else {"$gt": value}
+        elif value is None:
+            # Nothing sorts after null in descending order
+            continue
+        else:
+            # Matches smaller values as well as null or missing ones
+            after_condition = {"$not": {"$gte": value}}
 
-    except UnicodeDecodeError:
-        raise BadRequestError("Error parsing the file. Please ensure it is well-formed CSV file.")
-    except pd.errors.EmptyDataError:
-        raise BadRequestError("No data found in the CSV.")
-    except pd.errors.ParserError:
-        raise BadRequestError("Error parsing the file. Please ensure it is well-formed CSV file.")
-    except BadRequestError as err:
-        raise BadRequestError(str(err))
-    except Exception as err:
-        raise Exception(f"{str(err)}")
-    return False
+        branch = {prev_key: cursor_values[prev_position]
+                  for prev_position, (prev_key, _) in enumerate(sort_order_params[:position])}
+        branch[key] = after_condition
+        branches.append(branch)
+    return branches
 
 
-def validate_fetch_params(filter_params, sort_params, page_num, size_param):
+def validate_fetch_params(filter_params, sort_params, page_num, size_param, cursor=None, search=None):
     """
         Validate and parse the payload to filter data,
         and fetch data from MongoDB.
@@ -81,36 +116,93 @@ def validate_fetch_params(filter_params, sort_params, page_num, size_param):
             :param sort_params: Sort data based on these parameters
             :param page_num: Page number
             :param size_param: Size of each page
+            :param cursor: Cursor token returned by the previous page, replaces page_num when provided
+            :param search: Search terms, the results are then ranked by relevance
 
         Returns:
             tuple: Parsed payload params.
     """
-    filter_keys_to_keep = {"languages", "release_year"}
-    sort_keys_to_keep = {"ratings", "vote_average", "release_date", "release_year"}
+    restricted_filter_params = {key: filter_params[key] for key in FILTER_KEYS_TO_KEEP if key in filter_params}
 
-    restricted_sort_params = {key: sort_params[key] for key in sort_keys_to_keep if key in sort_params}
+    # Keeping the order of the requested sort keys, the first key is the primary sort key
+    restricted_sort_params = {key: value for key, value in sort_params.items() if key in SORT_KEYS_TO_KEEP}
     for key, value in restricted_sort_params.items():
         if value not in {-1, 1}:
             raise BadRequestError("Sort params only accept -1 (descending) or 1 (ascending) as value")
-    sort_order_params = [(key, value) for key, value in restricted_sort_params.items()]
 
-    restricted_filter_params = {key: filter_params[key] for key in filter_keys_to_keep if key in filter_params}
+    # A key filtered on a single value is constant across the results, sorting on it is a no-op
+    sort_keys = [key for key in SORT_KEYS_TO_KEEP
+                 if not (key in restricted_filter_params and is_equality_filter(restricted_filter_params[key]))]
+    sort_order_params = [(key, value) for key, value in restricted_sort_params.items() if key in sort_keys]
+
+    # Ties are broken by the other sort keys, in a fixed order, before _id. A sort and the longer sorts it is a
+    # prefix of then share one index, see index_planner_support. Unsorted requests list the top rated movies
+    # first, and mixed directions are left as requested.
+    if len({direction for _, direction in sort_order_params}) <= 1:
+        direction = sort_order_params[-1][1] if sort_order_params else -1
+        sort_order_params += [(key, direction) for key in sort_keys if key not in restricted_sort_params]
 
-    total_doc_count = mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, restricted_filter_params)
-    if total_doc_count == 0:
-        raise LookupError("No data found in mongodb collection")
-    max_page = (total_doc_count + size_param - 1) // size_param  # Calculate maximum number of pages
+    # _id breaks ties between equal sort keys so that the page boundaries are deterministic
+    sort_order_params.append(("_id", sort_order_params[-1][1] if sort_order_params else 1))
 
-    # Ensuring page_num does not exceed max_page
-    if page_num > max_page or page_num <= 0:
-        raise BadRequestError(f"Requested page {page_num} doesn't exist. "
-                              f"Please enter page number between 1 and maximum available pages {max_page}")
+    if search is not None:
+        if not isinstance(search, str) or not search.strip() or len(search) > MAX_SEARCH_LENGTH:
+            raise BadRequestError(f"Search should be a non empty text of at most {MAX_SEARCH_LENGTH} characters")
+        if restricted_sort_params:
+            raise BadRequestError("Search results are ranked by relevance, sort params cannot be used with search")
+        if cursor:
+            raise BadRequestError("Search results are paginated by page number, cursor cannot be used with search")
+        # Served by the text index, a search never scans the collection or runs a regex
+        restricted_filter_params["$text"] = {"$search": search}
+        sort_order_params = list(SEARCH_SORT_ORDER_PARAMS)
+
+    if not isinstance(size_param, int) or size_param <= 0:
+        raise BadRequestError("Page size should be a positive integer")
+
+    if cursor:
+        # Keyset pagination, the next page starts right after the last record of the previous one
+        cursor_values = decode_cursor(cursor, sort_order_params)
+        keyset_filter_params = {"$or": build_keyset_filter(sort_order_params, cursor_values)}
+        if not keyset_filter_params["$or"]:
+            raise LookupError("No data found in mongodb collection")
+        return restricted_filter_params, sort_order_params, 0, keyset_filter_params
+
+    # Pages beyond the last one are detected from an empty result, so no count is needed here
+    if not isinstance(page_num, int) or page_num <= 0:
+        raise BadRequestError(f"Requested page {page_num} doesn't exist. Please enter a page number starting from 1")
     start_index = (page_num - 1) * size_param
 
-    return restricted_filter_params, sort_order_params, start_index
+    return restricted_filter_params, sort_order_params, start_index, None
+
 
+def validate_fields(fields):
+    """
+    Validate the fields requested by the client.
+
+    Parameters:
+        :param fields: List of field names, None for the compact list view
 
-def fetch_movies(filter_params, sort_params, page_num, size_param):
+    Returns:
+        list: Field names to return.
+    """
+    if fields is None:
+        return list(LIST_VIEW_FIELDS)
+    if not isinstance(fields, list) or not fields or not set(fields).issubset(FIELDS_TO_KEEP):
+        raise BadRequestError(f"Fields should be a non empty list of: {', '.join(FIELDS_TO_KEEP)}")
+    return fields
+
+
+def is_snapshot_enabled():
+    """
+    Fetch queries are answered from an in-process copy of the collection when FETCH_SNAPSHOT_ENABLED is set, see
+    snapshot_support. It holds the whole collection in every process, which suits a catalog of tens of thousands
+    of movies. Mongo answers the searches and the queries the snapshot cannot.
+    """
+    return os.getenv("FETCH_SNAPSHOT_ENABLED", "False").lower() == "true"
+
+
+def fetch_movies(filter_params, sort_params, page_num, size_param, cursor=None, include_total=False, fields=None,
+                 search=None):
     """
     Process the payload from the request body to filter data,
     and fetch data from MongoDB.
@@ -120,25 +212,157 @@ def fetch_movies(filter_params, sort_params, page_num, size_param):
         :param sort_params: Sort data based on these parameters
         :param page_num: Page number
         :param size_param: Size of each page
+        :param cursor: Cursor token returned by the previous page, replaces page_num when provided
+        :param include_total: Also return the number of records matching the filter
+        :param fields: Fields of each record to return, defaults to the compact list view
+        :param search: Search terms matched against the title and overview, ranking the records by relevance
 
     Returns:
-        list: Movies data from MongoDB.
+        dict: Movies data from MongoDB, the cursor of the next page and the total count if requested.
     """
     try:
 
-        filter_params, sort_params, start_index = validate_fetch_params(filter_params, sort_params,
-                                                                        page_num, size_param)
+        with trace_support.span("validation"):
+            filter_params, sort_params, start_index, keyset_filter_params = validate_fetch_params(
+                filter_params, sort_params, page_num, size_param, cursor, search)
+            fields = validate_fields(fields)
+            # The page and the total are returned in a single $facet document, limited to 16MB by MongoDB
+            max_page_size_with_total = int(os.getenv("MAX_PAGE_SIZE_WITH_TOTAL", 1000))
+            if include_total and size_param > max_page_size_with_total:
+                raise BadRequestError(f"Pages requested with include_total hold at most {max_page_size_with_total} "
+                                      f"records")
+
+        # Sort keys and _id are fetched too as the next cursor is built from them, they are removed afterwards.
+        # A relevance sort key is a {"$meta": ...} expression, projected as is.
+        projection_query = {field: True for field in fields}
+        projection_query.update({key: direction if isinstance(direction, dict) else True
+                                 for key, direction in sort_params})
+        fields_to_remove = set(projection_query).union({"_id"}).difference(fields)
 
-        records = mongo.fetch_records_with_query(MOVIES_DATA_COLLECTION, filter_params=filter_params,
-                                                 sort_params=sort_params, start_index=start_index,
-                                                 size=size_param, projection_query={'_id': False})
-        log_support.console_log("Fetched required records")
-        return records
+        # Cache key built from the normalised params and the dataset generation they were read from
+        cache_key = json_util.dumps([cache_support.get_dataset_generation(), filter_params, sort_params,
+                                     keyset_filter_params, start_index, size_param, bool(include_total),
+                                     sorted(fields)], sort_keys=True)
+        with trace_support.span("cache_lookup"):
+            cached_result = cache_support.fetch_movies_cache.get(cache_key)
+        if cached_result is not None:
+            return cached_result
+
+        read_preference = mongo.get_fetch_read_preference()
+        result = dict()
+        snapshot_result = None
+        if search is None and is_snapshot_enabled():
+            # Imported here so that numpy is only loaded when the snapshot is enabled
+            from chalicelib.support import snapshot_support
+            snapshot_result = snapshot_support.fetch_records(
+                filter_params, sort_params, decode_cursor(cursor, sort_params) if cursor else None, start_index,
+                size_param, list(projection_query))
+
+        if snapshot_result is not None:
+            records, total_count = snapshot_result
+            if include_total:
+                result["total_count"] = total_count
+        elif include_total:
+            # Page and total are computed by a single $facet aggregation
+            records, total_count = mongo.fetch_records_with_total(MOVIES_DATA_COLLECTION,
+                                                                  filter_params=filter_params,
+                                                                  sort_params=sort_params,
+                                                                  start_index=start_index, size=size_param,
+                                                                  projection_query=projection_query,
+                                                                  page_filter_params=keyset_filter_params,
+                                                                  read_preference=read_preference)
+            result["total_count"] = total_count
+        else:
+            records = mongo.fetch_records_with_query(MOVIES_DATA_COLLECTION,
+                                                     filter_params={**filter_params, **(keyset_filter_params or {})},
+                                                     sort_params=sort_params, start_index=start_index,
+                                                     size=size_param, projection_query=projection_query,
+                                                     read_preference=read_preference)
+
+        if not records and not cursor and page_num > 1:
+            message = f"Requested page {page_num} doesn't exist."
+            if include_total:
+                max_page = (result["total_count"] + size_param - 1) // size_param
+                message += f" Please enter page number between 1 and maximum available pages {max_page}"
+            raise BadRequestError(message)
+
+        # A full page means there may be more records after it, search results are only paginated by page number
+        next_cursor = (encode_cursor(sort_params, records[-1])
+                       if len(records) == size_param and search is None else None)
+        for record in records:
+            for field in fields_to_remove:
+                record.pop(field, None)
+            # Missing values are left out of the stored movies and returned as null
+            for field in fields:
+                record.setdefault(field, None)
+        log_support.console_log("Fetched required records", sampled=True)
+        result = {"data": records, "next_cursor": next_cursor, **result}
+        cache_support.fetch_movies_cache.set(cache_key, result)
+        return result
     except LookupError as err:
         if err == "No data found in mongodb collection":
-            return list()
+            return {"data": list(), "next_cursor": None}
     except BadRequestError as err:
         raise BadRequestError(str(err))
     except Exception as err:
         raise Exception(f"An error occurred while fetching filtered movies data: {str(err)}")
-    return list()
+    return {"data": list(), "next_cursor": None}
+
+
+def fetch_movies_from_spec(fetch_spec):
+    """
+    :param fetch_spec: Payload of a fetch request, with the same keys and defaults as the fetch API
+    :return: Result of fetch_movies with a message describing it
+    """
+    if not isinstance(fetch_spec, dict):
+        raise BadRequestError("Each query should be an object with the fetch API parameters")
+    result = fetch_movies(fetch_spec.get('filter_params', {}), fetch_spec.get('sort_params', {}),
+                          fetch_spec.get('page', 1), fetch_spec.get('size', 20), fetch_spec.get('cursor'),
+                          fetch_spec.get('include_total', False), fetch_spec.get('fields'),
+                          fetch_spec.get('search'))
+    message = "Data fetched successfully" if len(result["data"]) > 0 else "No movie data found with the applied filter"
+    return {"message": message, **result}
+
+
+def get_batch_executor():
+    """
+    :return: Thread pool running the queries of batch fetches, created on first use.
+    """
+    global batch_executor
+    with batch_executor_lock:
+        if batch_executor is None:
+            batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("FETCH_BATCH_WORKERS", 8)),
+                                                thread_name_prefix="fetch-batch")
+    return batch_executor
+
+
+def fetch_movies_batch(fetch_specs):
+    """
+    Run several fetches concurrently over the shared Mongo client, so that one request replaces many.
+
+    Parameters:
+        :param fetch_specs: List of fetch request payloads, see fetch_movies_from_spec
+
+    Returns:
+        list: Result of each fetch in the requested order, or the error it failed with.
+    """
+    max_queries = int(os.getenv("MAX_FETCH_BATCH_QUERIES", 10))
+    if not isinstance(fetch_specs, list) or not fetch_specs:
+        raise BadRequestError("queries should be a non empty list of fetch parameters")
+    if len(fetch_specs) > max_queries:
+        raise BadRequestError(f"A batch can hold at most {max_queries} queries, got {len(fetch_specs)}")
+
+    trace = trace_support.get_current_trace()
+    futures = [get_batch_executor().submit(trace_support.run_with_trace, trace, fetch_movies_from_spec, fetch_spec)
+               for fetch_spec in fetch_specs]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as err:
+            results.append({"error": str(err)})
+    return results
+
+
+batch_executor = None
+batch_executor_lock = threading.Lock()
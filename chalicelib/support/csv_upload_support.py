@@ -0,0 +1,590 @@
+import ast
+import hashlib
+import multiprocessing
+import os
+import bson
+import numpy as np
+import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from io import BytesIO
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from chalice import BadRequestError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from chalicelib.common import cache_support, log_support, trace_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+from chalicelib.support import facet_support, snapshot_support
+from chalicelib.support.schema_support import MOVIE_STORAGE_SCHEMA
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:  # pyarrow is optional, pandas' own C parser is used without it
+    pyarrow = pyarrow_csv = None
+
+
+# Fields computed from the other columns rather than read from the CSV file
+DERIVED_FIELDS = ("release_year",)
+
+# Expected CSV headers, every field of MOVIE_STORAGE_SCHEMA but the derived ones. Every column is parsed as text,
+# the numeric ones are converted by transform_csv_chunk row by row so that a bad cell only rejects its own row.
+CSV_COLUMNS = [column for column in MOVIE_STORAGE_SCHEMA if column not in DERIVED_FIELDS]
+
+NUMERIC_COLUMNS = [column for column in CSV_COLUMNS if MOVIE_STORAGE_SCHEMA[column] in ("int", "double")]
+
+# Numeric columns stored as integers, their values may be written like "81.0"
+WHOLE_NUMBER_COLUMNS = [column for column in NUMERIC_COLUMNS if MOVIE_STORAGE_SCHEMA[column] == "int"]
+
+# Matches list literals of plain single quoted strings, e.g. "['English', 'Français']"
+SIMPLE_LANGUAGES_PATTERN = r"\[\s*(?:'[^'\\]*'\s*(?:,\s*'[^'\\]*'\s*)*)?\]"
+LANGUAGE_ITEM_PATTERN = r"'([^'\\]*)'"
+
+# Fields identifying the same movie across uploads in merge mode
+NATURAL_KEY_FIELDS = ("original_title", "release_date")
+
+# DataFrame.attrs key of the number of records with fewer fields than the header, skipped by the parser
+SHORT_RECORD_COUNT = "short_record_count"
+
+# Rough size of a CSV row, used to turn the chunk size in rows into a block size in bytes for pyarrow
+AVERAGE_CSV_ROW_SIZE_IN_BYTES = 512
+
+
+def read_csv_chunks(raw_body, chunk_size, engine=None):
+    """
+    Parse the CSV body into DataFrames of roughly chunk_size rows, with every column read as text.
+    A record with more fields than the header fails the upload with both engines. A record with fewer fields is
+    rejected on its own row: the C parser fills its missing fields, which leaves the last column empty and is
+    rejected by transform_csv_chunk, and pyarrow's parser skips it and counts it in the chunk's SHORT_RECORD_COUNT.
+
+    Parameters:
+        raw_body (bytes): The raw body of the CSV request.
+        chunk_size (int): Number of rows per chunk.
+        engine (str): "pyarrow" or "c", defaults to pyarrow's columnar parser when it is installed.
+
+    Yields:
+        DataFrame: One chunk of rows, a header only CSV yields a single empty chunk.
+
+    Raises:
+        ParserError: If a record has more fields than the header.
+    """
+    if engine is None:
+        engine = "c" if pyarrow is None else "pyarrow"
+
+    if engine == "c":
+        for df in pd.read_csv(BytesIO(raw_body), encoding='utf-8', chunksize=chunk_size,
+                              dtype={column: "string" for column in CSV_COLUMNS}):
+            # The C parser reports extra fields on every line but the first one, which it reads as an index instead
+            if not isinstance(df.index, pd.RangeIndex):
+                raise pd.errors.ParserError(f"Expected {len(df.columns)} fields in line 2, "
+                                            f"saw {len(df.columns) + df.index.nlevels}")
+            yield df
+        return
+
+    short_records = []
+
+    def handle_invalid_row(row):
+        if row.actual_columns < row.expected_columns:
+            short_records.append(row.number)
+            return "skip"
+        return "error"
+
+    column_types = {column: pyarrow.string() for column in CSV_COLUMNS}
+    try:
+        reader = pyarrow_csv.open_csv(
+            BytesIO(raw_body),
+            read_options=pyarrow_csv.ReadOptions(block_size=chunk_size * AVERAGE_CSV_ROW_SIZE_IN_BYTES),
+            # Quoted values such as an overview can span several lines, and so cross a block boundary
+            parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=handle_invalid_row),
+            convert_options=pyarrow_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+        )
+    except pyarrow.ArrowInvalid as err:
+        if "Empty CSV file" in str(err):
+            raise pd.errors.EmptyDataError(str(err))
+        raise pd.errors.ParserError(str(err))
+
+    chunk_count = 0
+    counted_short_records = 0
+    while True:
+        try:
+            batch = reader.read_next_batch()
+        except StopIteration:
+            break
+        except pyarrow.ArrowInvalid as err:
+            raise pd.errors.ParserError(str(err))
+        chunk_count += 1
+        df = batch.to_pandas(types_mapper={pyarrow.string(): pd.StringDtype()}.get)
+        # Blocks may be parsed ahead of the batch being read, the remaining records are counted by the last chunk
+        df.attrs[SHORT_RECORD_COUNT] = len(short_records) - counted_short_records
+        counted_short_records = len(short_records)
+        yield df
+    if chunk_count == 0 or counted_short_records < len(short_records):
+        df = reader.schema.empty_table().to_pandas()
+        df.attrs[SHORT_RECORD_COUNT] = len(short_records) - counted_short_records
+        yield df
+
+
+def parse_languages(value):
+    """
+    Parse the list literal stored in the languages column, e.g. "['English', 'Français']".
+
+    Returns:
+        list: Parsed languages, an empty list for empty cells or None if the value is malformed.
+    """
+    if pd.isna(value):
+        return []
+    try:
+        languages = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return None
+    return languages if isinstance(languages, list) else None
+
+
+def parse_languages_column(languages):
+    """
+    Vectorised version of parse_languages for a whole column. Plain lists of single quoted strings are
+    parsed with regular expressions, only the remaining values go through ast.literal_eval.
+
+    Parameters:
+        languages (Series): The languages column.
+
+    Returns:
+        Series: Parsed languages, None for malformed values.
+    """
+    parsed_languages = pd.Series([[] for _ in range(len(languages))], index=languages.index, dtype=object)
+    is_simple = languages.str.fullmatch(SIMPLE_LANGUAGES_PATTERN).fillna(False).astype(bool)
+    parsed_languages[is_simple] = languages[is_simple].str.findall(LANGUAGE_ITEM_PATTERN)
+
+    needs_literal_eval = ~is_simple & languages.notna()
+    if needs_literal_eval.any():
+        parsed_languages[needs_literal_eval] = languages[needs_literal_eval].map(parse_languages)
+    return parsed_languages
+
+
+def to_documents(df):
+    """
+    Column-wise replacement of df.to_dict(orient='records'), which boxes every value one at a time.
+    Values get the types of MOVIE_STORAGE_SCHEMA and missing values are left out of the documents.
+
+    Returns:
+        list: One dict per row.
+    """
+    columns = list(df.columns)
+    column_values = []
+    missing_rows_by_column = []
+    for column in columns:
+        values = df[column]
+        missing_rows = np.flatnonzero(values.isna().to_numpy()).tolist()
+        if missing_rows:
+            missing_rows_by_column.append((column, missing_rows))
+        if pd.api.types.is_datetime64_any_dtype(values.dtype):
+            column_values.append(values.dt.to_pydatetime().tolist())
+        elif pd.api.types.is_extension_array_dtype(values.dtype):
+            column_values.append(values.astype(object).tolist())
+        else:
+            column_values.append(values.tolist())
+
+    documents = [dict(zip(columns, row)) for row in zip(*column_values)]
+    # Missing values are a minority of the cells, so they are removed afterwards rather than skipped on every cell
+    for column, missing_rows in missing_rows_by_column:
+        for row in missing_rows:
+            del documents[row][column]
+    return documents
+
+
+def transform_csv_chunk(df):
+    """
+    Convert a chunk of the uploaded CSV into documents for MongoDB, with the types of MOVIE_STORAGE_SCHEMA.
+
+    Parameters:
+        df (DataFrame): A chunk of rows read from the CSV.
+
+    Returns:
+        tuple: List of documents and number of rows rejected during transformation.
+    """
+    # A record with fewer fields than the header is read with an empty last column by the C parser, which cannot
+    # tell it from an empty cell, so an empty last column rejects its row with both engines
+    valid_rows = df[df.columns[-1]].notna()
+    short_record_count = df.attrs.get(SHORT_RECORD_COUNT, 0)
+
+    release_dates = pd.to_datetime(df['release_date'], errors='coerce', format='ISO8601')
+    valid_rows &= release_dates.notna() | df['release_date'].isna()
+    df['release_date'] = release_dates
+    df['release_year'] = release_dates.dt.year.astype("Int64")
+
+    # Converting languages column to array type
+    df['languages'] = parse_languages_column(df['languages'])
+    valid_rows &= df['languages'].notna()
+
+    # Numbers are read as text, a value that is not a number rejects its row rather than the whole upload
+    for column in NUMERIC_COLUMNS:
+        values = pd.to_numeric(df[column], errors='coerce').astype("float64")
+        valid_rows &= values.notna() | df[column].isna()
+        df[column] = values
+
+    # Counts and amounts may be written as floats, e.g. "81.0", and are stored as integers
+    for column in WHOLE_NUMBER_COLUMNS:
+        valid_rows &= df[column].isna() | (df[column] % 1 == 0)
+
+    # Rows with a missing last field, a malformed list, a date that cannot be parsed, a malformed number or a
+    # fractional count are rejected
+    rejected_count = int((~valid_rows).sum()) + short_record_count
+    df = df[valid_rows].astype({column: "Int64" for column in WHOLE_NUMBER_COLUMNS})
+
+    return to_documents(df), rejected_count
+
+
+def insert_csv_chunk(documents):
+    """
+    Insert one chunk of documents with an unordered insert_many so a bad document does not stop the batch.
+
+    Returns:
+        dict: Number of inserted and failed documents.
+    """
+    try:
+        mongo.insert_many_document(MOVIES_DATA_COLLECTION, documents, ordered=False,
+                                  write_concern=mongo.ingest_write_concern)
+        facet_support.update_facets(documents)
+        return {"inserted_count": len(documents)}
+    except BulkWriteError as err:
+        failed_indexes = {write_error["index"] for write_error in err.details.get("writeErrors", [])}
+        facet_support.update_facets([document for index, document in enumerate(documents)
+                                     if index not in failed_indexes])
+        inserted_count = err.details.get("nInserted", 0)
+        return {"inserted_count": inserted_count, "failed_count": len(documents) - inserted_count}
+
+
+def get_natural_key(document):
+    """
+    :return: Key identifying the same movie across uploads
+    """
+    return tuple(document.get(key) for key in NATURAL_KEY_FIELDS)
+
+
+def get_content_hash(document):
+    """
+    :return: Hash of every field of the document, used to skip rows that did not change since the last merge
+    """
+    # BSON keeps the types apart, e.g. 81 and 81.0, and is encoded about three times faster than extended JSON.
+    # An 8 byte digest is stored as a 64-bit integer rather than a 32 character hex string.
+    digest = hashlib.blake2b(bson.encode(dict(sorted(document.items()))), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def is_unchanged(document, content_hash, existing_record):
+    """
+    :return: True if the stored movie has the fields of the document. Movies written in insert mode carry no hash
+    and are compared field by field.
+    """
+    if existing_record is None:
+        return False
+    if "content_hash" in existing_record:
+        return existing_record["content_hash"] == content_hash
+    return {field: value for field, value in existing_record.items() if field != "_id"} == document
+
+
+def merge_csv_chunk(documents):
+    """
+    Upsert one chunk of documents by their natural key, writing only the rows that are new or changed
+    through an unordered bulk write.
+
+    Returns:
+        dict: Number of inserted, updated, unchanged, duplicate and failed documents.
+    """
+    # The last row wins when a key is repeated within the chunk, the previous ones are counted as duplicates
+    documents_by_key = {}
+    for document in documents:
+        documents_by_key[get_natural_key(document)] = document
+    duplicate_count = len(documents) - len(documents_by_key)
+    unchanged_count = 0
+
+    # Read from the primary, a lagging secondary could miss rows that were just written.
+    # The faceted fields of the existing rows are read too, to take them out of the facets when they are replaced.
+    existing_records = mongo.fetch_records_with_query(
+        MOVIES_DATA_COLLECTION,
+        filter_params={"original_title": {"$in": list({key[0] for key in documents_by_key})}},
+        projection_query={field: True
+                          for field in NATURAL_KEY_FIELDS + ("content_hash",) + facet_support.FACETED_FIELDS}
+    )
+    # Only the movies without a hash are read whole, to be compared field by field
+    unhashed_ids = [record["_id"] for record in existing_records if "content_hash" not in record]
+    if unhashed_ids:
+        unhashed_records = {record["_id"]: record for record in mongo.fetch_records_with_query(
+            MOVIES_DATA_COLLECTION, filter_params={"_id": {"$in": unhashed_ids}})}
+        existing_records = [unhashed_records.get(record["_id"], record) for record in existing_records]
+    existing_records_by_key = {get_natural_key(record): record for record in existing_records}
+
+    operations = []
+    written_documents = []
+    for natural_key, document in documents_by_key.items():
+        existing_record = existing_records_by_key.get(natural_key)
+        content_hash = get_content_hash(document)
+        if is_unchanged(document, content_hash, existing_record):
+            unchanged_count += 1
+        else:
+            document["content_hash"] = content_hash
+            operations.append(ReplaceOne(dict(zip(NATURAL_KEY_FIELDS, natural_key)), document, upsert=True))
+            written_documents.append((document, existing_record))
+    if not operations:
+        return {"unchanged_count": unchanged_count, "duplicate_count": duplicate_count}
+
+    def update_facets(failed_indexes=()):
+        written = [written_document for index, written_document in enumerate(written_documents)
+                   if index not in failed_indexes]
+        facet_support.update_facets([document for document, _ in written],
+                                    [existing_record for _, existing_record in written if existing_record is not None])
+
+    try:
+        result = mongo.bulk_write(MOVIES_DATA_COLLECTION, operations, ordered=False,
+                                  write_concern=mongo.ingest_write_concern)
+        update_facets()
+        return {"inserted_count": result.upserted_count, "updated_count": result.modified_count,
+                "unchanged_count": unchanged_count, "duplicate_count": duplicate_count}
+    except BulkWriteError as err:
+        update_facets({write_error["index"] for write_error in err.details.get("writeErrors", [])})
+        return {"inserted_count": err.details.get("nUpserted", 0), "updated_count": err.details.get("nModified", 0),
+                "unchanged_count": unchanged_count, "duplicate_count": duplicate_count,
+                "failed_count": len(err.details.get("writeErrors", []))}
+
+
+class PartialUploadError(Exception):
+    """
+    Raised when an upload stops after some of its chunks were written, the chunks are not rolled back.
+    Carries the counts written so far, so that the client can tell a partial upload from a failed one.
+    """
+
+    def __init__(self, message, upload_counts):
+        super().__init__(f"{message} The upload stopped midway, the counted rows were written.")
+        self.upload_counts = dict(upload_counts)
+
+
+def get_upload_error(message, upload_counts, error_class=BadRequestError):
+    """
+    :return: PartialUploadError if rows were written before the error, error_class otherwise
+    """
+    if upload_counts["inserted_count"] or upload_counts["updated_count"]:
+        return PartialUploadError(message, upload_counts)
+    return error_class(message)
+
+
+# Writers of the upload modes, see upload_csv_data
+CHUNK_WRITERS = {"insert": insert_csv_chunk, "merge": merge_csv_chunk}
+
+
+def validate_csv_headers(columns):
+    """
+    Raises:
+        BadRequestError: If the CSV does not have exactly the expected headers.
+    """
+    expected_headers = set(CSV_COLUMNS)
+    if set(columns) != expected_headers:
+        raise BadRequestError(f"Invalid CSV headers. Expected: {str(expected_headers)}")
+
+
+def process_csv_serially(raw_body, mode, chunk_size):
+    """
+    Parse, transform and write the CSV one chunk at a time in the current process.
+
+    Yields:
+        dict: Counts of each processed chunk.
+    """
+    # Read the body lazily, only one chunk of rows is held as a DataFrame at a time
+    for chunk_num, df in enumerate(read_csv_chunks(raw_body, chunk_size)):
+        if chunk_num == 0:
+            validate_csv_headers(df.columns)
+
+        with trace_support.span("transform"):
+            documents, rejected_count = transform_csv_chunk(df)
+        with trace_support.span("write"):
+            chunk_counts = CHUNK_WRITERS[mode](documents) if documents else {}
+        chunk_counts["failed_count"] = chunk_counts.get("failed_count", 0) + rejected_count
+        yield chunk_counts
+
+
+def find_record_end(raw_body, position, in_quotes=False):
+    """
+    Find the end of the CSV record containing position. Newlines inside a quoted field, such as a
+    multi-line overview, do not end a record. Escaped quotes ("") leave the quoting state unchanged.
+
+    Parameters:
+        raw_body (bytes): The raw CSV.
+        position (int): Position to search from.
+        in_quotes (bool): Whether position is inside a quoted field.
+
+    Returns:
+        int: Position right after the newline ending the record, or the length of the body.
+    """
+    while True:
+        newline_position = raw_body.find(b"\n", position)
+        if newline_position == -1:
+            return len(raw_body)
+        if raw_body.count(b'"', position, newline_position) % 2:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            return newline_position + 1
+        position = newline_position + 1
+
+
+def split_csv_body(raw_body, part_size):
+    """
+    Split the CSV into byte ranges of roughly part_size bytes that start and end on record boundaries.
+
+    Returns:
+        tuple: The header line and the list of (start, end) byte ranges of the records.
+    """
+    header_end = find_record_end(raw_body, 0)
+    byte_ranges = []
+    start = header_end
+    while start < len(raw_body):
+        # The quoting state at the candidate position follows from the quotes since the last record boundary
+        candidate = min(start + part_size, len(raw_body))
+        end = find_record_end(raw_body, candidate, in_quotes=bool(raw_body.count(b'"', start, candidate) % 2))
+        byte_ranges.append((start, end))
+        start = end
+    return raw_body[:header_end], byte_ranges
+
+
+def transform_csv_part(header, raw_part, mode, chunk_size):
+    """
+    Parse and transform one byte range of the CSV, run in a worker process.
+    For inserts, the documents are also BSON encoded in the worker.
+
+    Returns:
+        tuple: List of documents and number of rows rejected during transformation.
+    """
+    documents = []
+    rejected_count = 0
+    for df in read_csv_chunks(header + raw_part, chunk_size):
+        chunk_documents, chunk_rejected_count = transform_csv_chunk(df)
+        documents.extend(chunk_documents)
+        rejected_count += chunk_rejected_count
+
+    if mode == "insert":
+        documents = [bson.encode({"_id": ObjectId(), **document}) for document in documents]
+    return documents, rejected_count
+
+
+def process_csv_in_parallel(raw_body, mode, chunk_size, workers):
+    """
+    Parse and transform record aligned byte ranges of the CSV on a process pool, and write the
+    transformed ranges concurrently over the shared MongoClient. Meant for batch imports of very
+    large files through `python manage.py import-csv`, not for the Lambda. In merge mode, ranges
+    sharing a natural key are written one after the other, as the serial path does.
+
+    Yields:
+        dict: Counts of each written byte range.
+    """
+    part_size = int(os.getenv("CSV_PART_SIZE_IN_MB", 8)) * 2 ** 20
+    header, byte_ranges = split_csv_body(raw_body, part_size)
+    validate_csv_headers(next(read_csv_chunks(header, 1)).columns)
+
+    def write_part(documents, rejected_count):
+        if mode == "insert":
+            documents = [RawBSONDocument(document) for document in documents]
+        part_counts = CHUNK_WRITERS[mode](documents) if documents else {}
+        part_counts["failed_count"] = part_counts.get("failed_count", 0) + rejected_count
+        return part_counts
+
+    # spawn rather than fork, forking a process that holds a MongoClient is not safe
+    transform_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    write_pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # At most two ranges per worker are being transformed or written at a time, which bounds the memory used
+        pending_ranges = list(reversed(byte_ranges))
+        transforms = set()
+        # Natural keys upserted by each running write, and the transformed ranges waiting for their write
+        writes = dict()
+        waiting_parts = []
+        while pending_ranges or transforms or writes or waiting_parts:
+            while pending_ranges and len(transforms) + len(writes) + len(waiting_parts) < 2 * workers:
+                start, end = pending_ranges.pop()
+                transforms.add(transform_pool.submit(transform_csv_part, header, raw_body[start:end], mode,
+                                                     chunk_size))
+
+            done, _ = wait(transforms | writes.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in transforms:
+                    transforms.remove(future)
+                    documents, rejected_count = future.result()
+                    natural_keys = {get_natural_key(document) for document in documents} if mode == "merge" else set()
+                    waiting_parts.append((documents, rejected_count, natural_keys))
+                else:
+                    del writes[future]
+                    yield future.result()
+
+            # Two concurrent upserts of the same natural key would both insert it, so a range repeating a key of
+            # a range being written, or of an earlier waiting one, waits for it. It then updates the written row.
+            blocked_keys = set().union(*writes.values())
+            for part in list(waiting_parts):
+                documents, rejected_count, natural_keys = part
+                if natural_keys.isdisjoint(blocked_keys):
+                    waiting_parts.remove(part)
+                    writes[write_pool.submit(write_part, documents, rejected_count)] = natural_keys
+                blocked_keys |= natural_keys
+    finally:
+        transform_pool.shutdown(cancel_futures=True)
+        write_pool.shutdown(cancel_futures=True)
+
+
+def upload_csv_data(raw_body, mode="insert", progress_callback=None, workers=1):
+    """
+    Process the raw CSV data from the request body in chunks,
+    validate headers, and write each chunk into MongoDB.
+
+    Parameters:
+        raw_body (bytes): The raw body of the CSV request.
+        mode (str): "insert" adds every row, "merge" upserts rows by their natural key
+            (original_title and release_date) and skips the rows whose content did not change.
+        progress_callback (callable): Called with the counts so far after each chunk, used by ingest jobs.
+        workers (int): Number of processes parsing the CSV, more than one switches to the parallel path.
+
+    Returns:
+        dict: Success message along with the number of inserted, updated, unchanged, duplicate and failed rows.
+
+    Raises:
+        BadRequestError: If headers are invalid or if any other issue occurs before a row is written.
+        PartialUploadError: If the upload stops after some chunks were written, with the counts written so far.
+    """
+    chunk_size = int(os.getenv("CSV_CHUNK_SIZE_IN_ROWS", 5000))
+    upload_counts = {"inserted_count": 0, "updated_count": 0, "unchanged_count": 0, "duplicate_count": 0,
+                     "failed_count": 0}
+    try:
+        if mode not in CHUNK_WRITERS:
+            raise BadRequestError(f"Invalid upload mode {mode}. Expected one of: {', '.join(CHUNK_WRITERS)}")
+
+        if workers > 1:
+            processed_chunks = process_csv_in_parallel(raw_body, mode, chunk_size, workers)
+        else:
+            processed_chunks = process_csv_serially(raw_body, mode, chunk_size)
+
+        for chunk_num, chunk_counts in enumerate(processed_chunks):
+            for key, count in chunk_counts.items():
+                upload_counts[key] += count
+            log_support.console_log(f"Processed CSV chunk {chunk_num + 1}, counts so far: {upload_counts}")
+            if progress_callback:
+                progress_callback(upload_counts)
+
+        if not any(upload_counts.values()):
+            raise pd.errors.EmptyDataError(f"No data found in the CSV")
+
+        return {"message": "Data uploaded successfully", **upload_counts}
+
+    # Chunks are written as they are parsed, an error past the first write is reported with the counts so far
+    except UnicodeDecodeError:
+        raise get_upload_error("Error parsing the file. Please ensure it is well-formed CSV file.", upload_counts)
+    except pd.errors.EmptyDataError:
+        raise get_upload_error("No data found in the CSV.", upload_counts)
+    except pd.errors.ParserError as err:
+        raise get_upload_error(f"Error parsing the file. Please ensure it is well-formed CSV file: {str(err)}",
+                               upload_counts)
+    except BadRequestError as err:
+        raise get_upload_error(str(err), upload_counts)
+    except Exception as err:
+        raise get_upload_error(f"{str(err)}", upload_counts, error_class=Exception)
+    finally:
+        # Cached fetch results no longer reflect the collection, even if the upload stopped midway
+        if upload_counts["inserted_count"] or upload_counts["updated_count"]:
+            cache_support.bump_dataset_generation()
+            snapshot_support.bump_stored_version()
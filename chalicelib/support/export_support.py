@@ -0,0 +1,154 @@
+import csv
+import io
+import math
+import os
+from datetime import datetime
+from chalice import BadRequestError
+
+from chalicelib.common import response_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+from chalicelib.support.cms_api_support import FIELDS_TO_KEEP, encode_cursor, validate_fetch_params
+
+# Content type of each export format
+EXPORT_CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Columns of a CSV export by default, the headers of the upload API so that an export can be uploaded again.
+# release_year is left out as the upload derives it from release_date.
+CSV_EXPORT_FIELDS = tuple(field for field in FIELDS_TO_KEEP if field != "release_year")
+
+
+def validate_export_params(export_format, fields):
+    """
+    Parameters:
+        :param export_format: "ndjson" or "csv"
+        :param fields: Fields of each record to export, every field by default, or the upload headers for a CSV
+
+    Returns:
+        list: Field names to export.
+    """
+    if export_format not in EXPORT_CONTENT_TYPES:
+        raise BadRequestError(f"Invalid export format {export_format}. "
+                              f"Expected one of: {', '.join(EXPORT_CONTENT_TYPES)}")
+    if fields is None:
+        return list(CSV_EXPORT_FIELDS if export_format == "csv" else FIELDS_TO_KEEP)
+    if not isinstance(fields, list) or not fields or not set(fields).issubset(FIELDS_TO_KEEP):
+        raise BadRequestError(f"Fields should be a non empty list of: {', '.join(FIELDS_TO_KEEP)}")
+    return fields
+
+
+def to_csv_value(value):
+    """
+    :return: Value written in the format of the uploaded CSV files, so that an export can be uploaded again
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, list):
+        return str(value)  # languages, e.g. ['English', 'Français']
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")  # release dates are stored at midnight UTC
+    return value
+
+
+def iter_export_chunks(filter_params, sort_params, export_format="ndjson", fields=None, cursor=None, max_rows=None,
+                       export_summary=None, max_bytes=None):
+    """
+    Stream the records matching the filter from a server cursor, one batch at a time, so that only a
+    batch of records is held in memory whatever the number of matching records.
+
+    Parameters:
+        :param filter_params: Filter data based on these parameters, as in fetch_movies
+        :param sort_params: Sort data based on these parameters, as in fetch_movies
+        :param export_format: "ndjson" or "csv"
+        :param fields: Fields of each record to export, every field by default, or the upload headers for a CSV
+        :param cursor: Cursor token returned by the previous export, to resume right after it
+        :param max_rows: Maximum number of records to export, all of them by default
+        :param export_summary: Dict filled with the number of exported records, and the cursor of the
+        following records when max_rows or max_bytes was reached, once the export is done
+        :param max_bytes: Maximum size of the UTF-8 encoded export, the record that would exceed it is left for
+        the next export. At least one record is exported.
+
+    Yields:
+        str: Encoded lines of a batch of records, starting with the header line for a CSV.
+    """
+    fields = validate_export_params(export_format, fields)
+    if export_summary is None:
+        export_summary = dict()
+    export_summary.update(exported_count=0, next_cursor=None)
+
+    buffer = io.StringIO()
+    # Rows are written to their own buffer first, so that their encoded size is known before they are exported
+    row_buffer = io.StringIO()
+    csv_writer = csv.writer(row_buffer, lineterminator="\n")
+    if export_format == "csv":
+        csv_writer.writerow(fields)
+        buffer.write(row_buffer.getvalue())
+    exported_bytes = len(buffer.getvalue().encode())
+
+    try:
+        filter_params, sort_order_params, _, keyset_filter_params = validate_fetch_params(
+            filter_params, sort_params, 1, max_rows or 1, cursor)
+    except LookupError:
+        # The cursor points after the last record
+        yield buffer.getvalue()
+        return
+
+    # Sort keys and _id are fetched too as the cursor is built from them
+    projection_query = {field: True for field in fields + [key for key, _ in sort_order_params]}
+    batch_size = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+    records = mongo.iterate_records_with_query(MOVIES_DATA_COLLECTION,
+                                               filter_params={**filter_params, **(keyset_filter_params or {})},
+                                               sort_params=sort_order_params, size=max_rows,
+                                               projection_query=projection_query, batch_size=batch_size,
+                                               read_preference=mongo.fetch_read_preference)
+
+    exported_count = 0
+    last_record = None
+    is_truncated = False
+    for record in records:
+        if export_format == "csv":
+            row_buffer.seek(0)
+            row_buffer.truncate()
+            csv_writer.writerow([to_csv_value(record.get(field)) for field in fields])
+            line = row_buffer.getvalue()
+        else:
+            line = response_support.encode_json({field: record.get(field) for field in fields}) + "\n"
+        if max_bytes:
+            line_size = len(line.encode())
+            if exported_count and exported_bytes + line_size > max_bytes:
+                is_truncated = True
+                records.close()
+                break
+            exported_bytes += line_size
+
+        buffer.write(line)
+        exported_count += 1
+        last_record = record
+        if exported_count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+    export_summary["exported_count"] = exported_count
+    if is_truncated or (max_rows and exported_count == max_rows):
+        export_summary["next_cursor"] = encode_cursor(sort_order_params, last_record)
+
+
+def export_movies(filter_params, sort_params, export_format="ndjson", fields=None, cursor=None):
+    """
+    Export up to EXPORT_MAX_ROWS_PER_REQUEST records in a single response, as the Lambda cannot stream a
+    response body and is limited to a 6 MB payload. The body is also kept under EXPORT_MAX_RESPONSE_SIZE_IN_MB,
+    5 MB by default, which leaves room for the headers. Larger exports resume from the returned cursor, or run
+    through `python manage.py export-movies`, which streams every record without a limit.
+
+    Returns:
+        tuple: Encoded records, their content type, and the cursor of the next records if there are more.
+    """
+    max_rows = int(os.getenv("EXPORT_MAX_ROWS_PER_REQUEST", 10000))
+    max_bytes = int(float(os.getenv("EXPORT_MAX_RESPONSE_SIZE_IN_MB", 5)) * 2 ** 20)
+    export_summary = dict()
+    body = "".join(iter_export_chunks(filter_params, sort_params, export_format, fields, cursor, max_rows,
+                                      export_summary, max_bytes))
+    return body, EXPORT_CONTENT_TYPES[export_format], export_summary["next_cursor"]
@@ -0,0 +1,182 @@
+import heapq
+import json
+import math
+import os
+from collections import Counter, defaultdict
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+
+from chalicelib.common import cache_support, log_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION, MOVIES_FACETS_COLLECTION
+
+# Fields of the movies kept in the top rated list of each language
+TOP_RATED_FIELDS = ("title", "original_title", "release_date", "release_year", "vote_average")
+
+# Fields of a movie the facets are computed from
+FACETED_FIELDS = ("languages",) + TOP_RATED_FIELDS
+
+
+def get_top_rated_size():
+    """
+    :return: Number of movies kept in the top rated list of each language
+    """
+    return int(os.getenv("FACETS_TOP_RATED_SIZE", 10))
+
+
+def get_movie_key(document):
+    """
+    :return: Key identifying a movie within a top rated list, built from its natural key
+    """
+    # Release dates are stored as dates, which are written with str
+    return json.dumps([document.get("original_title"), document.get("release_date")], default=str)
+
+
+def get_top_rated_entry(document):
+    """
+    :return: Entry of the movie in a top rated list, None if it has no valid rating
+    """
+    vote_average = document.get("vote_average")
+    if vote_average is None or not math.isfinite(vote_average):
+        return None
+    return {"key": get_movie_key(document), **{field: document.get(field) for field in TOP_RATED_FIELDS}}
+
+
+def build_facet_operations(added_documents, removed_documents=()):
+    """
+    Turn a batch of written movies into increments of the summary collection, e.g. every movie adds one to
+    the count of each of its languages and of its release year.
+
+    Parameters:
+        :param added_documents: Movies inserted by the batch, or the new version of the movies it replaced
+        :param removed_documents: Previous version of the movies replaced by the batch
+
+    Returns:
+        tuple: Operations removing the replaced movies from the top rated lists, and operations adding the batch.
+    """
+    counts = Counter()
+    for documents, increment in ((added_documents, 1), (removed_documents, -1)):
+        for document in documents:
+            for language in document.get("languages") or []:
+                counts[("language", language)] += increment
+            if document.get("release_year") is not None:
+                counts[("release_year", document["release_year"])] += increment
+
+    # Only the best movies of the batch can enter a top rated list, they are merged into it by $push $sort $slice
+    top_rated_size = get_top_rated_size()
+    entries_by_language = defaultdict(list)
+    for document in added_documents:
+        entry = get_top_rated_entry(document)
+        if entry is not None:
+            for language in document.get("languages") or []:
+                entries_by_language[language].append(entry)
+
+    push_operations = []
+    for (facet, value), count in counts.items():
+        update_query = {"$inc": {"count": count}, "$setOnInsert": {"facet": facet, "value": value}}
+        if facet == "language" and entries_by_language.get(value):
+            top_entries = heapq.nlargest(top_rated_size, entries_by_language[value],
+                                         key=lambda entry: entry["vote_average"])
+            update_query["$push"] = {"top_rated": {"$each": top_entries, "$sort": {"vote_average": -1},
+                                                   "$slice": top_rated_size}}
+        elif count == 0:
+            continue  # a replaced movie kept this value
+        push_operations.append(UpdateOne({"_id": f"{facet}:{value}"}, update_query, upsert=True))
+
+    # Replaced movies leave the top rated lists first, so that their new version is not listed twice
+    removed_keys_by_language = defaultdict(set)
+    for document in removed_documents:
+        for language in document.get("languages") or []:
+            removed_keys_by_language[language].add(get_movie_key(document))
+    pull_operations = [UpdateOne({"_id": f"language:{language}"},
+                                 {"$pull": {"top_rated": {"key": {"$in": sorted(keys)}}}})
+                       for language, keys in removed_keys_by_language.items()]
+    return pull_operations, push_operations
+
+
+def update_facets(added_documents, removed_documents=()):
+    """
+    Apply the increments of a written batch to the summary collection. A movie replaced by a lower rated
+    version leaves a top rated list shorter until the next rebuild, which recomputes it from scratch.
+
+    Parameters:
+        :param added_documents: Movies inserted by the batch, or the new version of the movies it replaced
+        :param removed_documents: Previous version of the movies replaced by the batch
+    """
+    try:
+        for operations in build_facet_operations(added_documents, removed_documents):
+            if operations:
+                mongo.bulk_write(MOVIES_FACETS_COLLECTION, operations, ordered=False)
+    except Exception as err:
+        # The movies are written already, failing the upload would only make the client retry them
+        log_support.console_log(f"Exception while updating the movie facets, rebuild them: {str(err)}")
+
+
+def rebuild_facets():
+    """
+    Recompute the summary collection from the whole movies collection, through `python manage.py rebuild-facets`.
+
+    Returns:
+        dict: Number of language and release year facets written.
+    """
+    language_counts = mongo.aggregate(MOVIES_DATA_COLLECTION, [
+        {"$unwind": "$languages"},
+        {"$group": {"_id": "$languages", "count": {"$sum": 1}}}
+    ])
+    year_counts = mongo.aggregate(MOVIES_DATA_COLLECTION, [
+        {"$match": {"release_year": {"$ne": None}}},
+        {"$group": {"_id": "$release_year", "count": {"$sum": 1}}}
+    ])
+
+    operations = []
+    facet_ids = []
+    for language_count in language_counts:
+        language = language_count["_id"]
+        # Served by the languages and vote_average index of the fetch API
+        top_rated = mongo.fetch_records_with_query(
+            MOVIES_DATA_COLLECTION, filter_params={"languages": language, "vote_average": {"$ne": None}},
+            sort_params=[("vote_average", -1), ("_id", -1)], size=get_top_rated_size(),
+            projection_query={field: True for field in TOP_RATED_FIELDS})
+        top_rated_entries = [entry for entry in map(get_top_rated_entry, top_rated) if entry is not None]
+        facet_ids.append(f"language:{language}")
+        operations.append(ReplaceOne({"_id": facet_ids[-1]},
+                                     {"facet": "language", "value": language, "count": language_count["count"],
+                                      "top_rated": top_rated_entries}, upsert=True))
+    for year_count in year_counts:
+        facet_ids.append(f"release_year:{year_count['_id']}")
+        operations.append(ReplaceOne({"_id": facet_ids[-1]},
+                                     {"facet": "release_year", "value": year_count["_id"],
+                                      "count": year_count["count"]}, upsert=True))
+
+    # Facets of values that no longer exist are removed
+    operations.append(DeleteMany({"_id": {"$nin": facet_ids}}))
+    mongo.bulk_write(MOVIES_FACETS_COLLECTION, operations, ordered=False)
+    cache_support.bump_dataset_generation()
+    return {"language_facets": len(language_counts), "release_year_facets": len(year_counts)}
+
+
+def get_facets():
+    """
+    Read the whole summary collection in a single query, instead of counting over the movies collection.
+
+    Returns:
+        dict: Movie count of each language and release year, most common first, and top rated movies per language.
+    """
+    cache_key = json.dumps(["facets", cache_support.get_dataset_generation()])
+    cached_facets = cache_support.fetch_movies_cache.get(cache_key)
+    if cached_facets is not None:
+        return cached_facets
+
+    read_preference = mongo.get_fetch_read_preference()
+    facets = {"languages": [], "release_years": []}
+    for facet in mongo.fetch_records_with_query(MOVIES_FACETS_COLLECTION, filter_params={"count": {"$gt": 0}},
+                                                sort_params=[("count", -1), ("value", 1)],
+                                                read_preference=read_preference):
+        if facet["facet"] == "language":
+            top_rated = [{field: entry.get(field) for field in TOP_RATED_FIELDS}
+                         for entry in facet.get("top_rated", [])]
+            facets["languages"].append({"value": facet["value"], "count": facet["count"], "top_rated": top_rated})
+        else:
+            facets["release_years"].append({"value": facet["value"], "count": facet["count"]})
+
+    cache_support.fetch_movies_cache.set(cache_key, facets)
+    return facets
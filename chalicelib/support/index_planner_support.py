@@ -0,0 +1,215 @@
+import itertools
+import os
+from pymongo import ASCENDING, DESCENDING, TEXT
+
+from chalicelib.common import log_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+from chalicelib.support.cms_api_support import FILTER_KEYS_TO_KEEP, SORT_KEYS_TO_KEEP, validate_fetch_params
+
+# Sample values used to build the filter of each query shape, the query planner only cares about the fields
+SAMPLE_FILTER_VALUES = {"languages": "English", "release_year": 2000}
+SAMPLE_SEARCH = "toy story"
+
+# Indexes needed by other queries than the fetch_movies shapes
+ADDITIONAL_INDEXES = [
+    # Lookup of existing rows by their natural key when uploading in merge mode
+    ([("original_title", ASCENDING), ("release_date", ASCENDING)], "natural_key_index"),
+    # Relevance ranked search of the fetch API
+    ([("title", TEXT), ("original_title", TEXT), ("overview", TEXT)], "movies_text_index"),
+]
+
+# Options of the indexes that are not plain ascending or descending ones, passed to create_index
+INDEX_OPTIONS = {
+    # A match in the title counts more than a match in the overview
+    "movies_text_index": {"weights": {"title": 10, "original_title": 5, "overview": 1}},
+}
+
+# Stages of a winning plan that mean the query is not served by an index alone
+UNINDEXED_STAGES = {"COLLSCAN", "SORT"}
+
+# Array fields, an index on one of them is multikey and stores a key for every element of the array
+MULTIKEY_FIELDS = {"languages"}
+
+# Every planned index is written on each insert and update of a movie. The default cap covers every filter, unsorted
+# or with a single sort key, along with the longer sorts they are a prefix of. The other sorts are done in memory.
+DEFAULT_MAX_MOVIES_INDEXES = 8
+
+
+def enumerate_query_shapes():
+    """
+    Enumerate every filter and sort combination accepted by fetch_movies,
+    normalised the same way validate_fetch_params normalises a request. A sort is extended with the
+    remaining sort keys, so the sorts that are a prefix of a longer one are merged into its shape.
+
+    Returns:
+        list: Unique (filter_params, sort_order_params) tuples, simplest shapes first.
+    """
+    shapes = dict()
+    requested_sort_counts = dict()
+    for filter_count in range(len(FILTER_KEYS_TO_KEEP) + 1):
+        for filter_keys in itertools.combinations(FILTER_KEYS_TO_KEEP, filter_count):
+            filter_params = {key: SAMPLE_FILTER_VALUES[key] for key in filter_keys}
+            for sort_count in range(len(SORT_KEYS_TO_KEEP) + 1):
+                for sort_keys in itertools.permutations(SORT_KEYS_TO_KEEP, sort_count):
+                    for directions in itertools.product((DESCENDING, ASCENDING), repeat=sort_count):
+                        restricted_filter_params, sort_order_params, _, _ = validate_fetch_params(
+                            filter_params, dict(zip(sort_keys, directions)), 1, 1)
+                        shape_key = (tuple(restricted_filter_params), tuple(sort_order_params))
+                        shapes.setdefault(shape_key, (restricted_filter_params, sort_order_params))
+                        requested_sort_counts.setdefault(shape_key, sort_count)
+
+    # Shapes requested with fewer sort keys and with more filters are the most common ones, they get indexes first
+    return [shapes[shape_key] for shape_key in sorted(shapes, key=lambda shape_key: (requested_sort_counts[shape_key],
+                                                                                     -len(shape_key[0])))]
+
+
+def index_fields_for_shape(filter_params, sort_order_params):
+    """
+    Equality filters first, followed by the sort keys, so that the index serves both the filter and the sort.
+
+    Returns:
+        list: Index fields as (key, direction) tuples.
+    """
+    sort_fields = list(sort_order_params)
+    # An index can be walked in both directions, storing the first sort key descending keeps one index per shape
+    if sort_fields[0][1] == ASCENDING:
+        sort_fields = [(key, -direction) for key, direction in sort_fields]
+    return [(key, ASCENDING) for key in filter_params] + sort_fields
+
+
+def index_serves_shape(index_fields, filter_params, sort_order_params):
+    """
+    :return: True if the index can find the records of the shape and return them in order without a SORT stage.
+    """
+    equality_count = len(filter_params)
+    if {key for key, _ in index_fields[:equality_count]} != set(filter_params):
+        return False
+    sort_fields = index_fields[equality_count:equality_count + len(sort_order_params)]
+    reversed_sort_fields = [(key, -direction) for key, direction in sort_fields]
+    return list(sort_order_params) in (sort_fields, reversed_sort_fields)
+
+
+def has_mixed_sort_directions(sort_order_params):
+    """
+    :return: True if the sort keys do not all go in the same direction, the _id tie breaker aside
+    """
+    return len({direction for key, direction in sort_order_params if key != "_id"}) > 1
+
+
+def index_name(index_fields):
+    """
+    :return: Name of the index in the format MongoDB uses by default, e.g. languages_1_vote_average_-1
+    """
+    return "_".join(f"{key}_{direction}" for key, direction in index_fields)
+
+
+def plan_indexes(max_indexes=None):
+    """
+    Derive the minimal set of compound indexes serving every query shape. If it does not fit in
+    max_indexes, the indexes serving the most common shapes are kept and the others are left out.
+    Shapes sorting on several keys in mixed directions are rare and would each need an index of their
+    own, they are left out and sorted in memory.
+
+    Parameters:
+        :param max_indexes: Maximum number of planned indexes, defaults to the MAX_MOVIES_INDEXES env variable
+
+    Returns:
+        tuple: List of (index fields, index name) tuples and the list of shapes left without an index.
+    """
+    if max_indexes is None:
+        max_indexes = int(os.getenv("MAX_MOVIES_INDEXES", DEFAULT_MAX_MOVIES_INDEXES))
+    shapes = enumerate_query_shapes()
+
+    # Longest indexes first, so shorter shapes reuse their prefix instead of getting an index of their own.
+    # Among equally long ones sorted shapes go first, as equality fields can be matched in any direction.
+    candidates = []
+    for filter_params, sort_order_params in sorted(shapes, key=lambda shape: (-len(shape[0]) - len(shape[1]),
+                                                                              -len(shape[1]))):
+        if sort_order_params[0][0] == "_id" and not filter_params:
+            continue  # served by the default _id index
+        if has_mixed_sort_directions(sort_order_params):
+            continue
+        if not any(index_serves_shape(fields, filter_params, sort_order_params) for fields in candidates):
+            candidates.append(index_fields_for_shape(filter_params, sort_order_params))
+
+    # Rank the candidates by the most common shape they serve
+    def candidate_rank(fields):
+        return min(position for position, (filter_params, sort_order_params) in enumerate(shapes)
+                   if index_serves_shape(fields, filter_params, sort_order_params))
+
+    planned_fields = sorted(candidates, key=candidate_rank)[:max_indexes]
+    unplanned_shapes = [(filter_params, sort_order_params) for filter_params, sort_order_params in shapes
+                        if not (sort_order_params[0][0] == "_id" and not filter_params)
+                        and not any(index_serves_shape(fields, filter_params, sort_order_params)
+                                    for fields in planned_fields)]
+
+    indexes_to_create = [(fields, index_name(fields)) for fields in planned_fields] + ADDITIONAL_INDEXES
+    return indexes_to_create, unplanned_shapes
+
+
+def get_write_cost(indexes_to_create):
+    """
+    :param indexes_to_create: List of (index fields, index name) tuples, as returned by plan_indexes
+    :return: Number of indexes written on each insert of a movie, the _id index included, and how many of them are
+    multikey and write a key for every language of the movie. The text index writes a key per distinct word.
+    """
+    multikey_index_count = sum(1 for index_fields, _ in indexes_to_create
+                               if MULTIKEY_FIELDS.intersection(key for key, _ in index_fields))
+    return {"index_count": len(indexes_to_create) + 1, "multikey_index_count": multikey_index_count}
+
+
+def get_plan_stages(plan):
+    """
+    :param plan: Winning plan from the explain output
+    :return: Names of all the stages of the plan, from the root down
+    """
+    plan = plan.get("queryPlan", plan)  # plans of the slot based engine are wrapped in queryPlan
+    stages = [plan.get("stage")]
+    for input_plan in plan.get("inputStages", []) + ([plan["inputStage"]] if "inputStage" in plan else []):
+        stages.extend(get_plan_stages(input_plan))
+    return stages
+
+
+def enumerate_search_shapes():
+    """
+    Enumerate the search queries of fetch_movies, with every combination of filters. They are served
+    by the text index and are left out of the planning of the compound indexes.
+
+    Returns:
+        list: (filter_params, sort_order_params) tuples.
+    """
+    shapes = []
+    for filter_count in range(len(FILTER_KEYS_TO_KEEP) + 1):
+        for filter_keys in itertools.combinations(FILTER_KEYS_TO_KEEP, filter_count):
+            filter_params = {key: SAMPLE_FILTER_VALUES[key] for key in filter_keys}
+            restricted_filter_params, sort_order_params, _, _ = validate_fetch_params(
+                filter_params, {}, 1, 1, search=SAMPLE_SEARCH)
+            shapes.append((restricted_filter_params, sort_order_params))
+    return shapes
+
+
+def verify_query_shapes():
+    """
+    Run explain() for every query shape and report the ones that are not backed by an index.
+
+    Returns:
+        list: A report for each shape, with the stages of the winning plan and whether it is index backed.
+    """
+    report = []
+    for filter_params, sort_order_params in enumerate_query_shapes() + enumerate_search_shapes():
+        explain_output = mongo.explain_query(MOVIES_DATA_COLLECTION, filter_params=filter_params,
+                                             sort_params=sort_order_params, size=20)
+        stages = get_plan_stages(explain_output["queryPlanner"]["winningPlan"])
+        # Ranking by relevance always sorts the matched records, a search is index backed as long as it does not scan
+        unindexed_stages = {"COLLSCAN"} if "$text" in filter_params else UNINDEXED_STAGES
+        shape_report = {
+            "filter_keys": list(filter_params),
+            "sort_params": sort_order_params,
+            "stages": stages,
+            "index_backed": not unindexed_stages.intersection(stages)
+        }
+        if not shape_report["index_backed"]:
+            log_support.console_log(f"Query shape is not index backed: {shape_report}")
+        report.append(shape_report)
+    return report
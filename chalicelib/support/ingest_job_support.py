@@ -0,0 +1,234 @@
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from chalice import BadRequestError
+
+from chalicelib.common import log_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import INGEST_JOBS_COLLECTION
+
+try:
+    import boto3
+except ImportError:  # boto3 is provided by the Lambda runtime, it is only needed with INGEST_JOB_QUEUE
+    boto3 = None
+
+# Prefix of the S3 keys of the CSV files waiting for their job
+INGEST_JOB_BODY_PREFIX = "ingest-jobs/"
+
+
+def is_async_upload_enabled():
+    """
+    :return: True if ?async=true uploads are accepted on this stage
+    """
+    return os.getenv("ASYNC_UPLOAD_ENABLED", "False").lower() == "true"
+
+
+def get_job_queue():
+    """
+    Deployed stages send their jobs to the INGEST_JOB_QUEUE SQS queue, with the CSV file in the INGEST_JOB_BUCKET
+    S3 bucket, and run them on the worker Lambda of chalicelib/apis/ingest_job_worker.py. Without a queue the jobs
+    run on a thread pool of the current process, which only keeps running after the response on a long lived
+    server such as `chalice local`, not on a Lambda whose execution is frozen.
+
+    :return: Name of the SQS queue of the upload jobs, None to run them on the thread pool
+    """
+    return os.getenv("INGEST_JOB_QUEUE") or None
+
+
+def is_running_on_lambda():
+    """
+    :return: True when running on a Lambda rather than `chalice local`
+    """
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+@lru_cache(maxsize=None)
+def get_aws_client(service_name):
+    """
+    :return: boto3 client of the service, created on first use and reused by the next invocations
+    """
+    return boto3.client(service_name)
+
+
+@lru_cache(maxsize=None)
+def get_job_queue_url(queue_name):
+    """
+    :return: URL of the SQS queue, which send_message needs rather than its name
+    """
+    return get_aws_client("sqs").get_queue_url(QueueName=queue_name)["QueueUrl"]
+
+
+def get_executor():
+    """
+    :return: Thread pool running the upload jobs, created on first use.
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=int(os.getenv("INGEST_JOB_WORKERS", 2)),
+                                          thread_name_prefix="ingest-job")
+    return executor
+
+
+def submit_upload_job(raw_body, mode):
+    """
+    Record a new upload job and process the CSV in the background.
+
+    Parameters:
+        raw_body (bytes): The raw body of the CSV request.
+        mode (str): Upload mode, see csv_upload_support.upload_csv_data
+
+    Returns:
+        str: Id of the job, used to poll its status.
+    """
+    from chalicelib.support import csv_upload_support
+
+    if not is_async_upload_enabled():
+        raise BadRequestError("Async uploads are not enabled on this stage")
+    queue_name = get_job_queue()
+    if queue_name is None and is_running_on_lambda():
+        raise BadRequestError("Async uploads need INGEST_JOB_QUEUE on a deployed stage")
+    if mode not in csv_upload_support.CHUNK_WRITERS:
+        raise BadRequestError(f"Invalid upload mode {mode}. "
+                              f"Expected one of: {', '.join(csv_upload_support.CHUNK_WRITERS)}")
+
+    job_id = uuid.uuid4().hex
+    created_at = datetime.utcnow()
+    job = {
+        "_id": job_id,
+        "status": "queued",
+        "mode": mode,
+        "file_size_in_bytes": len(raw_body),
+        "counts": {},
+        "created_at": created_at,
+        "updated_at": created_at
+    }
+    if queue_name is None:
+        mongo.insert_document(INGEST_JOBS_COLLECTION, job)
+        get_executor().submit(run_upload_job, job_id, raw_body, mode)
+        return job_id
+
+    # The file is stored before the job is recorded and queued, so that the worker always finds it
+    job["body_key"] = f"{INGEST_JOB_BODY_PREFIX}{job_id}.csv"
+    get_aws_client("s3").put_object(Bucket=os.environ["INGEST_JOB_BUCKET"], Key=job["body_key"], Body=raw_body)
+    mongo.insert_document(INGEST_JOBS_COLLECTION, job)
+    get_aws_client("sqs").send_message(QueueUrl=get_job_queue_url(queue_name),
+                                       MessageBody=json.dumps({"job_id": job_id}))
+    return job_id
+
+
+def process_upload_job_message(message_body):
+    """
+    Run the job of an SQS message on the worker Lambda, reading its CSV file from S3.
+    A message delivered again once the job was started is ignored.
+
+    Parameters:
+        message_body (str): Body sent by submit_upload_job.
+    """
+    job_id = json.loads(message_body)["job_id"]
+    job = mongo.fetch_document(INGEST_JOBS_COLLECTION, {"_id": job_id})
+    if job is None or job["status"] != "queued":
+        log_support.console_log(f"Upload job {job_id} is not queued, the message is ignored")
+        return
+
+    bucket = os.environ["INGEST_JOB_BUCKET"]
+    raw_body = get_aws_client("s3").get_object(Bucket=bucket, Key=job["body_key"])["Body"].read()
+    run_upload_job(job_id, raw_body, job["mode"])
+    get_aws_client("s3").delete_object(Bucket=bucket, Key=job["body_key"])
+
+
+def run_upload_job(job_id, raw_body, mode):
+    """
+    Process the CSV of a job and keep its status document up to date.
+    """
+    from chalicelib.support import csv_upload_support
+
+    def update_job(fields):
+        # updated_at tells a job that is still making progress from one whose process was stopped
+        mongo.update_document(INGEST_JOBS_COLLECTION, {"_id": job_id},
+                              {"$set": {**fields, "updated_at": datetime.utcnow()}})
+
+    # Only a queued job is started, so that a job is never run twice
+    started_at = datetime.utcnow()
+    result = mongo.update_document(INGEST_JOBS_COLLECTION, {"_id": job_id, "status": "queued"},
+                                   {"$set": {"status": "running", "started_at": started_at, "updated_at": started_at}})
+    if not result.modified_count:
+        log_support.console_log(f"Upload job {job_id} was already started")
+        return
+
+    try:
+        upload_summary = csv_upload_support.upload_csv_data(
+            raw_body, mode, progress_callback=lambda counts: update_job({"counts": counts}))
+        upload_summary.pop("message")
+        update_job({"status": "completed", "counts": upload_summary, "finished_at": datetime.utcnow()})
+    except Exception as err:
+        log_support.console_log(f"Exception in upload job {job_id}: {str(err)}")
+        update_job({"status": "failed", "error": str(err), "finished_at": datetime.utcnow()})
+
+
+def fail_stale_job(job):
+    """
+    Mark a queued or running job as failed when it was not updated for INGEST_JOB_TIMEOUT_IN_SECONDS,
+    e.g. after its process was stopped. A job that is updated meanwhile is left as is.
+
+    Parameters:
+        job (dict): Job document, updated in place when the job is marked as failed.
+    """
+    if job["status"] not in ("queued", "running"):
+        return
+    updated_at = job.get("updated_at") or job.get("started_at") or job["created_at"]
+    timeout = timedelta(seconds=float(os.getenv("INGEST_JOB_TIMEOUT_IN_SECONDS", 300)))
+    now = datetime.utcnow()
+    if now - updated_at <= timeout:
+        return
+
+    failed_fields = {"status": "failed", "error": f"Upload job stopped making progress at "
+                                                  f"{updated_at.strftime('%Y-%m-%d %H:%M:%S')}",
+                     "finished_at": updated_at, "updated_at": now}
+    result = mongo.update_document(INGEST_JOBS_COLLECTION, {"_id": job["_id"], "status": job["status"],
+                                                            "updated_at": job.get("updated_at")},
+                                   {"$set": failed_fields})
+    if result.modified_count:
+        job.update(failed_fields)
+
+
+def get_job_status(job_id):
+    """
+    Parameters:
+        job_id (str): Id returned when the job was submitted.
+
+    Returns:
+        dict: Status of the job with its counts, rows processed and throughput, None if there is no such job.
+    """
+    job = mongo.fetch_document(INGEST_JOBS_COLLECTION, {"_id": job_id})
+    if job is None:
+        return None
+    fail_stale_job(job)
+
+    rows_processed = sum(job["counts"].values())
+    job_status = {
+        "job_id": job.pop("_id"),
+        "status": job["status"],
+        "mode": job["mode"],
+        "file_size_in_bytes": job["file_size_in_bytes"],
+        "rows_processed": rows_processed,
+        "counts": job["counts"],
+        "error": job.get("error"),
+        "completed": job["status"] in ("completed", "failed")
+    }
+    if job.get("started_at"):
+        elapsed_time = ((job.get("finished_at") or datetime.utcnow()) - job["started_at"]).total_seconds()
+        job_status["rows_per_second"] = round(rows_processed / elapsed_time, 1) if elapsed_time > 0 else None
+    for timestamp_field in ("created_at", "started_at", "finished_at"):
+        if job.get(timestamp_field):
+            job_status[timestamp_field] = job[timestamp_field].strftime("%Y-%m-%d %H:%M:%S")
+    return job_status
+
+
+executor = None
+executor_lock = threading.Lock()
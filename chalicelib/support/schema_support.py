@@ -0,0 +1,170 @@
+import math
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+
+from chalicelib.common import log_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+
+# BSON type each field of movies_data is stored with. Missing values are left out of the documents rather than
+# stored as NaN or null, release dates are dates so that they sort chronologically, and whole numbers are stored
+# as integers, which the driver writes as 32-bit integers or as 64-bit ones for amounts above 2^31.
+MOVIE_STORAGE_SCHEMA = {
+    "budget": "int",
+    "homepage": "string",
+    "original_language": "string",
+    "original_title": "string",
+    "overview": "string",
+    "release_date": "date",
+    "release_year": "int",
+    "revenue": "int",
+    "runtime": "int",
+    "status": "string",
+    "title": "string",
+    "vote_average": "double",
+    "vote_count": "int",
+    "production_company_id": "int",
+    "genre_id": "int",
+    "languages": "array"
+}
+
+# Placeholder of a value left out of the stored document
+MISSING = object()
+
+
+def is_missing(value):
+    """
+    :return: True for the placeholders of an empty CSV cell, which are not stored
+    """
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def to_storage_value(field, value):
+    """
+    Convert a value to the declared type of its field, e.g. a release date stored as text by older uploads.
+
+    :param field: Field of the movie
+    :param value: Value of the field, fields outside the schema such as _id are returned as is
+    :return: Converted value, MISSING if the field is to be left out of the document
+    :raises ValueError: If the value cannot be stored with the declared type
+    """
+    storage_type = MOVIE_STORAGE_SCHEMA.get(field)
+    if storage_type is None:
+        return value
+    if is_missing(value):
+        return MISSING
+
+    if storage_type == "date":
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if not isinstance(value, datetime):
+            raise ValueError(f"{field} should be a date, got {value!r}")
+        # Dates are stored in UTC, naive dates are already in UTC
+        return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+    if storage_type == "int":
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not float(value).is_integer():
+            raise ValueError(f"{field} should be a whole number, got {value!r}")
+        return int(value)
+    if storage_type == "double":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{field} should be a number, got {value!r}")
+        return float(value)
+    if storage_type == "string" and not isinstance(value, str):
+        raise ValueError(f"{field} should be a string, got {value!r}")
+    if storage_type == "array" and not isinstance(value, list):
+        raise ValueError(f"{field} should be a list, got {value!r}")
+    return value
+
+
+def to_storage_document(document):
+    """
+    :param document: Movie document, as stored by any version of the upload API
+    :return: Copy of the document with the declared types and without its missing values
+    """
+    storage_document = dict()
+    for field, value in document.items():
+        storage_value = to_storage_value(field, value)
+        if storage_value is not MISSING:
+            storage_document[field] = storage_value
+    return storage_document
+
+
+def get_json_schema_validator():
+    """
+    :return: Validator rejecting the writes of documents that do not follow MOVIE_STORAGE_SCHEMA
+    """
+    # Integers are written as int or long depending on their size
+    properties = {field: {"bsonType": ["int", "long"] if storage_type == "int" else storage_type}
+                  for field, storage_type in MOVIE_STORAGE_SCHEMA.items()}
+    properties["languages"]["items"] = {"bsonType": "string"}
+    return {"$jsonSchema": {"bsonType": "object", "properties": properties}}
+
+
+def get_schema_updates(document, storage_document):
+    """
+    :return: $set of the fields whose value or BSON type changed and $unset of the fields left out, empty if the
+    document already follows the schema
+    """
+    update_query = dict()
+    # Values are compared along with their type, 81.0 == 81 but a double and an int32 are stored differently
+    changed_fields = {field: value for field, value in storage_document.items()
+                      if type(document.get(field)) is not type(value) or document.get(field) != value}
+    removed_fields = {field: "" for field in document if field not in storage_document}
+    if changed_fields:
+        update_query["$set"] = changed_fields
+    if removed_fields:
+        update_query["$unset"] = removed_fields
+    return update_query
+
+
+def migrate_movies_schema(batch_size=1000):
+    """
+    Rewrite the movies stored by older uploads with MOVIE_STORAGE_SCHEMA, one batch of documents at a time,
+    through `python manage.py migrate-schema`. Documents already migrated are left untouched, so the migration
+    can be stopped and run again.
+
+    Parameters:
+        :param batch_size: Number of documents read and rewritten at a time
+
+    Returns:
+        dict: Number of migrated, unchanged and failed documents.
+    """
+    # Imported here as it loads the fetch API support
+    from chalicelib.support import snapshot_support
+
+    migration_counts = {"migrated_count": 0, "unchanged_count": 0, "failed_count": 0}
+    last_id = None
+    while True:
+        # A query per batch rather than a single cursor, which could time out during a long migration
+        documents = mongo.fetch_records_with_query(MOVIES_DATA_COLLECTION,
+                                                   filter_params={"_id": {"$gt": last_id}} if last_id else {},
+                                                   sort_params=[("_id", 1)], size=batch_size)
+        if not documents:
+            if migration_counts["migrated_count"]:
+                snapshot_support.bump_stored_version()
+            return migration_counts
+        last_id = documents[-1]["_id"]
+
+        operations = []
+        for document in documents:
+            try:
+                storage_document = to_storage_document(document)
+            except ValueError as err:
+                log_support.console_log(f"Movie {document['_id']} cannot be migrated: {str(err)}")
+                migration_counts["failed_count"] += 1
+                continue
+            # Hex digests of older merges are dropped, the next merge compares these movies field by field
+            if not isinstance(storage_document.get("content_hash", 0), int):
+                del storage_document["content_hash"]
+
+            update_query = get_schema_updates(document, storage_document)
+            if update_query:
+                operations.append(UpdateOne({"_id": document["_id"]}, update_query))
+            else:
+                migration_counts["unchanged_count"] += 1
+
+        if operations:
+            mongo.bulk_write(MOVIES_DATA_COLLECTION, operations, ordered=False,
+                             write_concern=mongo.ingest_write_concern)
+            migration_counts["migrated_count"] += len(operations)
+        log_support.console_log(f"Migrated movies up to {last_id}, counts so far: {migration_counts}")
@@ -0,0 +1,353 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from bson import ObjectId
+
+from chalicelib.common import cache_support, log_support, trace_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import DATASET_VERSIONS_COLLECTION, MOVIES_DATA_COLLECTION
+from chalicelib.support.cms_api_support import FIELDS_TO_KEEP, FILTER_KEYS_TO_KEEP, SORT_KEYS_TO_KEEP
+
+# Placeholder of a field missing from a document, left out of the returned records as Mongo does
+MISSING = object()
+
+
+def get_sort_key(value):
+    """
+    Key ordering values the way Mongo sorts them: null or missing, then numbers with NaN first, then strings,
+    then ObjectIds, then booleans, then dates.
+
+    :param value: Value of a sort key
+    :return: Comparable key, None for a type the snapshot does not sort, e.g. a list
+    """
+    if value is None or value is MISSING:
+        return (0,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (1, 0) if math.isnan(value) else (1, 1, value)
+    if isinstance(value, str):
+        return (2, value)  # Python compares code points, which is the byte order Mongo compares UTF-8 with
+    if isinstance(value, ObjectId):
+        return (7, value)
+    if isinstance(value, datetime):
+        return (9, value)
+    return None
+
+
+def is_snapshot_filter_value(value):
+    """
+    :return: True if the snapshot matches value like Mongo does, e.g. NaN or null filters are left to Mongo
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return False
+    return not (isinstance(value, float) and math.isnan(value))
+
+
+def get_dense_ranks(values):
+    """
+    :param values: Values of a sort key, one per row
+    :return: Rank of each row in the sort order, equal values sharing a rank, None if a value cannot be sorted
+    """
+    sort_keys = [get_sort_key(value) for value in values]
+    if any(sort_key is None for sort_key in sort_keys):
+        return None
+    ranks = np.empty(len(sort_keys), dtype=np.int64)
+    rank, previous_sort_key = -1, None
+    for row in sorted(range(len(sort_keys)), key=sort_keys.__getitem__):
+        if sort_keys[row] != previous_sort_key:
+            rank, previous_sort_key = rank + 1, sort_keys[row]
+        ranks[row] = rank
+    return ranks
+
+
+def build_column(values):
+    """
+    :return: Values stored as an int64 or float64 array when they all share the type, an object array otherwise
+    """
+    if values and all(type(value) is float for value in values):
+        return np.array(values, dtype=np.float64)
+    if values and all(type(value) is int for value in values):
+        return np.array(values, dtype=np.int64)
+    column = np.empty(len(values), dtype=object)
+    for row, value in enumerate(values):
+        column[row] = value  # assigned one by one so that the languages lists are not turned into a 2d array
+    return column
+
+
+class MovieSnapshot:
+    def __init__(self, documents, generation, stored_version=None):
+        """
+        Read-only columnar copy of the movies collection answering the filter, sort and page queries of the fetch
+        API in process. The sort orders are computed once: each sort key holds a permutation of the rows sorted by
+        it with _id breaking ties, and each filter key holds the rows of every value it takes.
+
+        :param documents: Every movie, with the fields the fetch API returns and _id
+        :param generation: Dataset generation the documents were read at
+        :param stored_version: Version of the movies collection the documents were read at, see get_stored_version
+        """
+        self.generation = generation
+        self.stored_version = stored_version
+        self.loaded_at = self.checked_at = time.monotonic()
+        self.size = len(documents)
+
+        values_by_field = {field: [document.get(field, MISSING) for document in documents]
+                           for field in ("_id",) + FIELDS_TO_KEEP}
+        self.columns = {field: build_column(values) for field, values in values_by_field.items()}
+        self.row_by_id = {document_id: row for row, document_id in enumerate(values_by_field["_id"])}
+
+        self.id_ranks = get_dense_ranks(values_by_field["_id"])
+        self.sort_ranks = {key: get_dense_ranks(values_by_field[key]) for key in SORT_KEYS_TO_KEEP}
+        # Ascending permutation of each sort key, a descending sort on a single key reads it backwards
+        self.sort_permutations = {key: np.lexsort((self.id_ranks, ranks))
+                                  for key, ranks in self.sort_ranks.items() if ranks is not None}
+        self.sort_permutations["_id"] = np.argsort(self.id_ranks)
+
+        self.posting_lists = dict()
+        for key in FILTER_KEYS_TO_KEEP:
+            rows_by_value = dict()
+            for row, value in enumerate(values_by_field[key]):
+                # Like Mongo, a filter on an array field matches the documents holding the value
+                for item in (value if isinstance(value, list) else [value]):
+                    if is_snapshot_filter_value(item):
+                        rows_by_value.setdefault(item, []).append(row)
+            self.posting_lists[key] = {value: np.array(rows, dtype=np.int64) for value, rows in rows_by_value.items()}
+
+    def get_filter_mask(self, filter_params):
+        """
+        :param filter_params: Validated filter params of the fetch API
+        :return: Boolean mask of the matching rows, None if the snapshot cannot evaluate the filter
+        """
+        mask = None
+        for key, value in filter_params.items():
+            if key not in self.posting_lists:
+                return None  # e.g. a $text search
+            if isinstance(value, dict) and list(value) == ["$in"] and isinstance(value["$in"], list):
+                values = value["$in"]
+            elif is_snapshot_filter_value(value):
+                values = [value]
+            else:
+                return None
+            if not all(is_snapshot_filter_value(item) for item in values):
+                return None
+
+            key_mask = np.zeros(self.size, dtype=bool)
+            for item in values:
+                rows = self.posting_lists[key].get(item)
+                if rows is not None:
+                    key_mask[rows] = True
+            mask = key_mask if mask is None else mask & key_mask
+        return mask
+
+    def get_composite_sort_keys(self, sort_params, rows):
+        """
+        Pack the ranks of every sort key of the rows into a single integer comparing like the whole sort order,
+        so that a page is found by a partial sort rather than sorting every matching row on each key.
+
+        :return: Composite key of each row, None if the ranks do not fit in 63 bits
+        """
+        sort_keys = np.zeros(len(rows), dtype=np.int64)
+        capacity = 1
+        for key, direction in sort_params:
+            ranks = self.id_ranks if key == "_id" else self.sort_ranks[key]
+            rank_count = int(ranks.max()) + 1 if self.size else 1
+            capacity *= rank_count
+            if capacity >= 2 ** 62:
+                return None
+            sort_keys = sort_keys * rank_count + (ranks[rows] if direction == 1 else rank_count - 1 - ranks[rows])
+        return sort_keys
+
+    def get_cursor_row(self, sort_params, cursor_values):
+        """
+        :return: Row of the record the cursor points at, None if it changed since the cursor was issued,
+        in which case Mongo resolves the cursor instead
+        """
+        row = self.row_by_id.get(cursor_values[-1])
+        if row is None:
+            return None
+        for (key, _), value in zip(sort_params[:-1], cursor_values):
+            if get_sort_key(self.columns[key][row:row + 1].tolist()[0]) != get_sort_key(value):
+                return None
+        return row
+
+    def get_page_rows(self, sort_params, mask, cursor_row, start_index, size):
+        """
+        Parameters:
+            :param sort_params: Validated list of (key, direction) tuples, ending with _id
+            :param mask: Rows matching the filter, None for every row
+            :param cursor_row: Row of the last record of the previous page, None without a cursor
+            :param start_index: Number of records to skip, when there is no cursor
+            :param size: Size of the page
+
+        Returns:
+            tuple: Rows of the page and the number of matching rows, None if the snapshot cannot sort on a key.
+        """
+        if cursor_row is not None and mask is not None and not mask[cursor_row]:
+            return None
+
+        if len(sort_params) <= 2:
+            # A single sort key, or only _id, is served by its presorted permutation
+            permutation = self.sort_permutations.get(sort_params[0][0])
+            if permutation is None:
+                return None
+            sorted_rows = permutation if mask is None else permutation[mask[permutation]]
+            if sort_params[0][1] == -1:
+                sorted_rows = sorted_rows[::-1]
+            if cursor_row is not None:
+                start_index = int(np.flatnonzero(sorted_rows == cursor_row)[0]) + 1
+            return sorted_rows[start_index:start_index + size], len(sorted_rows)
+
+        if any(self.sort_ranks.get(key) is None for key, _ in sort_params[:-1]):
+            return None
+        rows = np.arange(self.size) if mask is None else np.flatnonzero(mask)
+        sort_keys = self.get_composite_sort_keys(sort_params, rows)
+        if sort_keys is None:
+            # np.lexsort sorts by the last key first, and ranks are negated for descending keys
+            sorted_rows = rows[np.lexsort([direction * (self.id_ranks if key == "_id" else self.sort_ranks[key])[rows]
+                                           for key, direction in reversed(sort_params)])]
+            if cursor_row is not None:
+                start_index = int(np.flatnonzero(sorted_rows == cursor_row)[0]) + 1
+            return sorted_rows[start_index:start_index + size], len(rows)
+
+        if cursor_row is not None:
+            # Keys are unique thanks to _id, the page starts right after the rows sorted before the cursor
+            cursor_key = self.get_composite_sort_keys(sort_params, np.array([cursor_row]))[0]
+            start_index = int(np.count_nonzero(sort_keys < cursor_key)) + 1
+        end_index = min(start_index + size, len(rows))
+        if start_index >= end_index:
+            return rows[:0], len(rows)
+        # Only the rows up to the end of the page are sorted
+        candidates = (np.argpartition(sort_keys, end_index - 1)[:end_index] if end_index < len(rows)
+                      else np.arange(len(rows)))
+        candidates = candidates[np.argsort(sort_keys[candidates])]
+        return rows[candidates[start_index:end_index]], len(rows)
+
+    def get_records(self, rows, fields):
+        """
+        :return: Records of the rows with the requested fields, in the format returned by Mongo
+        """
+        column_values = [(field, self.columns[field][rows].tolist()) for field in fields]
+        return [{field: values[position] for field, values in column_values if values[position] is not MISSING}
+                for position in range(len(rows))]
+
+    def fetch_records(self, filter_params, sort_params, cursor_values, start_index, size, fields):
+        """
+        Parameters:
+            :param filter_params: Validated filter params of the fetch API
+            :param sort_params: Validated list of (key, direction) tuples, ending with _id
+            :param cursor_values: Sort key values of the last record of the previous page, None without a cursor
+            :param start_index: Number of records to skip
+            :param size: Size of the page
+            :param fields: Fields of each record to return
+
+        Returns:
+            tuple: Records of the page and the number of records matching the filter, None if the snapshot
+            cannot answer the query.
+        """
+        mask = self.get_filter_mask(filter_params)
+        if mask is None and filter_params:
+            return None
+        cursor_row = None
+        if cursor_values is not None:
+            cursor_row = self.get_cursor_row(sort_params, cursor_values)
+            if cursor_row is None:
+                return None
+        page = self.get_page_rows(sort_params, mask, cursor_row, start_index, size)
+        if page is None:
+            return None
+        page_rows, total_count = page
+        return self.get_records(page_rows, fields), total_count
+
+
+def get_stored_version():
+    """
+    :return: Version of the movies collection, bumped by every upload whichever process handled it
+    """
+    version_document = mongo.fetch_document(DATASET_VERSIONS_COLLECTION, {"_id": MOVIES_DATA_COLLECTION})
+    return version_document["version"] if version_document else 0
+
+
+def bump_stored_version():
+    """
+    Mark the movies collection as changed for the snapshots of every process.
+    """
+    mongo.update_document(DATASET_VERSIONS_COLLECTION, {"_id": MOVIES_DATA_COLLECTION}, {"$inc": {"version": 1}},
+                          upsert=True)
+
+
+def load_snapshot(generation, stored_version=None):
+    """
+    :param generation: Dataset generation the collection is read at
+    :param stored_version: Version of the movies collection read before loading it
+    :return: Snapshot of the movies collection
+    """
+    start_time = time.perf_counter()
+    read_preference = mongo.get_fetch_read_preference()
+    documents = list(mongo.iterate_records_with_query(MOVIES_DATA_COLLECTION,
+                                                      projection_query={field: True for field in FIELDS_TO_KEEP},
+                                                      batch_size=int(os.getenv("FETCH_SNAPSHOT_BATCH_SIZE", 5000)),
+                                                      read_preference=read_preference))
+    loaded_snapshot = MovieSnapshot(documents, generation, stored_version)
+    log_support.console_log("Loaded the fetch snapshot", generation=generation, rows=loaded_snapshot.size,
+                            duration_in_ms=round((time.perf_counter() - start_time) * 1e3, 3))
+    return loaded_snapshot
+
+
+def get_snapshot():
+    """
+    Reload the snapshot when an upload changed the dataset generation of this process. Every
+    FETCH_SNAPSHOT_TTL_IN_SECONDS, the stored version of the collection is read to pick up the uploads handled by
+    other processes, and the snapshot is only reloaded if it changed.
+    The new snapshot replaces the previous one at once, requests never see a partially loaded snapshot.
+
+    :return: Snapshot of the current generation, None while another request is loading it
+    """
+    global snapshot
+    current_snapshot = snapshot
+    generation = cache_support.get_dataset_generation()
+    ttl_in_seconds = float(os.getenv("FETCH_SNAPSHOT_TTL_IN_SECONDS", 60))
+    if current_snapshot is not None and current_snapshot.generation == generation:
+        if time.monotonic() - current_snapshot.checked_at < ttl_in_seconds:
+            return current_snapshot
+        # A single document read rather than a reload of the whole collection
+        with trace_support.span("snapshot_version_check"):
+            stored_version = get_stored_version()
+        if stored_version == current_snapshot.stored_version:
+            current_snapshot.checked_at = time.monotonic()
+            return current_snapshot
+
+    # A single request loads the snapshot, the others are served by Mongo meanwhile
+    if not snapshot_lock.acquire(blocking=False):
+        return None
+    try:
+        with trace_support.span("snapshot_load"):
+            # Read before the collection, an upload running meanwhile triggers another reload
+            snapshot = load_snapshot(generation, get_stored_version())
+        return snapshot
+    finally:
+        snapshot_lock.release()
+
+
+def fetch_records(filter_params, sort_params, cursor_values, start_index, size, fields):
+    """
+    Answer a fetch query from the snapshot, see MovieSnapshot.fetch_records.
+
+    Returns:
+        tuple: Records of the page and the number of matching records, None if Mongo has to answer the query.
+    """
+    try:
+        current_snapshot = get_snapshot()
+    except Exception as err:
+        log_support.console_log(f"Exception while loading the fetch snapshot, fetching from Mongo: {str(err)}")
+        return None
+    if current_snapshot is None:
+        return None
+    with trace_support.span("snapshot_query"):
+        return current_snapshot.fetch_records(filter_params, sort_params, cursor_values, start_index, size, fields)
+
+
+snapshot = None
+snapshot_lock = threading.Lock()
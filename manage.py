@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import sys
+
+from chalicelib.common import init_support, log_support
+from chalicelib.common.init_support import mongo
+from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+from chalicelib.support import facet_support, index_planner_support, schema_support
+
+
+def init_indexes(args):
+    """
+    Create the planned indexes of the movies collection that are missing.
+    """
+    indexes_to_create, _ = index_planner_support.plan_indexes(args.max_indexes)
+    init_support.init_mongo_collection(indexes_to_create, drop_unplanned=args.drop_unplanned,
+                                       index_options=index_planner_support.INDEX_OPTIONS)
+
+
+def plan_indexes(args):
+    """
+    Print the planned indexes, the query shapes they leave without an index and the number of indexes written on
+    each insert, without touching the database.
+    """
+    indexes_to_create, unplanned_shapes = index_planner_support.plan_indexes(args.max_indexes)
+    for index_fields, index_name in indexes_to_create:
+        print(json.dumps({"index": index_name, "fields": index_fields}))
+    for filter_params, sort_order_params in unplanned_shapes:
+        print(json.dumps({"unplanned_shape": {"filter_keys": list(filter_params), "sort_params": sort_order_params}}))
+    print(json.dumps({"write_cost": index_planner_support.get_write_cost(indexes_to_create)}))
+
+
+def verify_indexes(args):
+    """
+    Explain every query shape and report the ones that are not index backed.
+    """
+    report = index_planner_support.verify_query_shapes()
+    not_index_backed = [shape_report for shape_report in report if not shape_report["index_backed"]]
+    log_support.console_log(f"{len(report) - len(not_index_backed)} of {len(report)} query shapes are index backed")
+    if args.strict and not_index_backed:
+        raise SystemExit(1)
+
+
+def import_csv(args):
+    """
+    Import a large CSV file, parsing it on several processes.
+    """
+    from chalicelib.support import csv_upload_support
+
+    with open(args.file_path, "rb") as csv_file:
+        raw_body = csv_file.read()
+    upload_summary = csv_upload_support.upload_csv_data(raw_body, args.mode, workers=args.workers)
+    log_support.console_log(f"Imported {args.file_path}: {upload_summary}")
+
+
+def rebuild_facets(args):
+    """
+    Recompute the movie facets from the whole movies collection.
+    """
+    rebuild_summary = facet_support.rebuild_facets()
+    log_support.console_log(f"Rebuilt the movie facets: {rebuild_summary}")
+
+
+def migrate_schema(args):
+    """
+    Rewrite the stored movies with the declared storage schema, then declare it to MongoDB and recompute the facets,
+    whose top rated lists hold release dates.
+    """
+    migration_summary = schema_support.migrate_movies_schema(args.batch_size)
+    log_support.console_log(f"Migrated the movies: {migration_summary}")
+    if not args.skip_validator:
+        mongo.set_validator(MOVIES_DATA_COLLECTION, schema_support.get_json_schema_validator())
+    rebuild_summary = facet_support.rebuild_facets()
+    log_support.console_log(f"Rebuilt the movie facets: {rebuild_summary}")
+
+
+def export_movies(args):
+    """
+    Export every movie matching the filter to a file or stdout, one batch of records at a time.
+    """
+    from chalicelib.support import export_support
+
+    output_file = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    export_summary = dict()
+    try:
+        for chunk in export_support.iter_export_chunks(json.loads(args.filter), json.loads(args.sort), args.format,
+                                                       args.fields, export_summary=export_summary):
+            output_file.write(chunk)
+    finally:
+        if args.output:
+            output_file.close()
+    # Logged to stderr so that an export to stdout can be piped
+    print(f"Exported {export_summary.get('exported_count', 0)} movies", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Setup and maintenance commands of the imdb-app.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init-indexes", help="Create the planned MongoDB indexes, safe to run on "
+                                                             "every deploy.")
+    init_parser.add_argument("--max-indexes", type=int, help="Maximum number of planned indexes.")
+    init_parser.add_argument("--drop-unplanned", action="store_true", help="Drop the indexes that are not planned.")
+    init_parser.set_defaults(handler=init_indexes)
+
+    plan_parser = subparsers.add_parser("plan-indexes", help="Print the index plan without applying it.")
+    plan_parser.add_argument("--max-indexes", type=int, help="Maximum number of planned indexes.")
+    plan_parser.set_defaults(handler=plan_indexes)
+
+    verify_parser = subparsers.add_parser("verify-indexes", help="Explain every fetch query shape and report the "
+                                                                 "ones that are not index backed.")
+    verify_parser.add_argument("--strict", action="store_true", help="Exit with an error if any shape is not "
+                                                                     "index backed.")
+    verify_parser.set_defaults(handler=verify_indexes)
+
+    import_parser = subparsers.add_parser("import-csv", help="Import a movies CSV file with parallel parsing, for "
+                                                             "files too large for the upload API.")
+    import_parser.add_argument("file_path", help="Path of the CSV file.")
+    import_parser.add_argument("--mode", choices=["insert", "merge"], default="insert", help="Upload mode.")
+    import_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of parsing processes.")
+    import_parser.set_defaults(handler=import_csv)
+
+    facets_parser = subparsers.add_parser("rebuild-facets", help="Recompute the language and release year facets "
+                                                                 "from scratch.")
+    facets_parser.set_defaults(handler=rebuild_facets)
+
+    migrate_parser = subparsers.add_parser("migrate-schema", help="Rewrite the stored movies with the declared types, "
+                                                                  "safe to run again.")
+    migrate_parser.add_argument("--batch-size", type=int, default=1000, help="Number of movies rewritten at a time.")
+    migrate_parser.add_argument("--skip-validator", action="store_true", help="Do not declare the schema to MongoDB.")
+    migrate_parser.set_defaults(handler=migrate_schema)
+
+    export_parser = subparsers.add_parser("export-movies", help="Stream the movies matching a filter as NDJSON or "
+                                                                "CSV, without the row limit of the export API.")
+    export_parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson", help="Export format.")
+    export_parser.add_argument("--output", help="Path of the exported file, stdout by default.")
+    export_parser.add_argument("--filter", default="{}", help="Filter params as JSON, as in the fetch API.")
+    export_parser.add_argument("--sort", default="{}", help="Sort params as JSON, as in the fetch API.")
+    export_parser.add_argument("--fields", nargs="+", help="Fields to export, every field by default.")
+    export_parser.set_defaults(handler=export_movies)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,4 +6,34 @@ def add_os_variables():
     os.environ["SERVICE_NAME"] = "imdb-app"
     os.environ["MONGO_CONNECTION_STRING"] = "mongodb:{password}//localhost:27017/"
     os.environ["MONGODB_PASSWORD"] = ""
+    os.environ["MONGO_MAX_POOL_SIZE"] = "100"
+    os.environ["MONGO_MIN_POOL_SIZE"] = "0"
+    os.environ["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = "5000"
+    os.environ["MONGO_CONNECT_TIMEOUT_MS"] = "5000"
+    os.environ["MONGO_SOCKET_TIMEOUT_MS"] = "30000"
+    os.environ["MONGO_COMPRESSORS"] = "zlib"
+    os.environ["MONGO_ZLIB_COMPRESSION_LEVEL"] = "-1"
+    os.environ["MONGO_FETCH_READ_PREFERENCE"] = "secondaryPreferred"
+    os.environ["MONGO_INGEST_WRITE_CONCERN"] = "1"
     os.environ["MAX_CSV_FILE_SIZE_IN_MB"] = "100"
+    os.environ["CSV_CHUNK_SIZE_IN_ROWS"] = "5000"
+    os.environ["FETCH_CACHE_MAX_ENTRIES"] = "256"
+    os.environ["FETCH_CACHE_TTL_IN_SECONDS"] = "60"
+    os.environ["ASYNC_UPLOAD_ENABLED"] = "True"
+    os.environ["INGEST_JOB_WORKERS"] = "2"
+    os.environ["INGEST_JOB_TIMEOUT_IN_SECONDS"] = "300"
+    os.environ["INGEST_JOB_QUEUE"] = ""
+    os.environ["INGEST_JOB_BUCKET"] = ""
+    os.environ["LOG_SAMPLE_RATE"] = "1"
+    os.environ["SLOW_QUERY_THRESHOLD_IN_MS"] = "100"
+    os.environ["SLOW_QUERY_EXPLAIN_ENABLED"] = "False"
+    os.environ["FETCH_BATCH_WORKERS"] = "8"
+    os.environ["MAX_FETCH_BATCH_QUERIES"] = "10"
+    os.environ["MAX_PAGE_SIZE_WITH_TOTAL"] = "1000"
+    os.environ["FACETS_TOP_RATED_SIZE"] = "10"
+    os.environ["EXPORT_BATCH_SIZE"] = "1000"
+    os.environ["EXPORT_MAX_ROWS_PER_REQUEST"] = "10000"
+    os.environ["EXPORT_MAX_RESPONSE_SIZE_IN_MB"] = "5"
+    os.environ["FETCH_SNAPSHOT_ENABLED"] = "False"
+    os.environ["FETCH_SNAPSHOT_TTL_IN_SECONDS"] = "60"
+    os.environ["FETCH_SNAPSHOT_BATCH_SIZE"] = "5000"
@@ -1,10 +1,14 @@
 import json
+import pytest
 from tests import env_variables
 
 env_variables.add_os_variables()
 
 import app
+from bson import ObjectId
 from chalice.test import Client
+from chalicelib.common import cache_support
+from chalicelib.support import cms_api_support
 
 sample_file = (
     b'budget,homepage,original_language,original_title,overview,release_date,revenue,runtime,status,title,vote_average,vote_count,production_company_id,genre_id,languages\n'
@@ -12,14 +16,50 @@ sample_file = (
     b'65000000.0,,en,Jumanji,"When siblings Judy and Peter discover an enchanted board game that opens the door to a magical world, they unwittingly invite Alan -- an adult who\'s been trapped inside the game for 26 years -- into their living room. Alan\'s only hope for freedom is to finish the game, which proves risky as all three find themselves running from giant rhinoceroses, evil monkeys and other terrifying creatures.",1995-12-15,262797249.0,104,Released,Jumanji,6.9,2413.0,559,12,"[\'English\', \'Fran\xc3\xa7ais\']"\n'
 )
 
+sample_file_malformed_languages = (
+    b'budget,homepage,original_language,original_title,overview,release_date,revenue,runtime,status,title,vote_average,vote_count,production_company_id,genre_id,languages\n'
+    b'30000000.0,,en,Heat,"A group of professional bank robbers start to feel the heat from police.",1995-12-15,187436818.0,170,Released,Heat,7.7,1886.0,508,28,English\n'
+)
+
 sample_file_headers = (
     b'budget,homepage,original_language,original_title,overview,release_date,revenue,runtime,status,title,vote_average,vote_count,production_company_id,genre_id,languages\n'
 )
 
+@pytest.fixture
+def mock_mongo(monkeypatch):
+    """
+    Point the shared Mongo client to an in-memory mongomock client, for the tests that need stored movies.
+    """
+    mongomock = pytest.importorskip("mongomock")
+    from chalicelib.common.init_support import mongo
+    from chalicelib.common.mongo_collections import Mongo
+
+    monkeypatch.setattr(Mongo, "get_client", lambda self: mongomock.MongoClient())
+    monkeypatch.setattr(mongo, "_client", None)
+    # Results cached by the previous tests were read from another database
+    cache_support.fetch_movies_cache.clear()
+    return mongo
+
+
+@pytest.fixture(params=["c", "pyarrow"])
+def csv_engine(request, monkeypatch):
+    """
+    Run the upload tests with each CSV parser, the C parser being the one used when pyarrow is not installed.
+    """
+    from chalicelib.support import csv_upload_support
+
+    if request.param == "c":
+        monkeypatch.setattr(csv_upload_support, "pyarrow", None)
+    elif csv_upload_support.pyarrow is None:
+        pytest.skip("pyarrow is not installed")
+    return request.param
+
+
 # Test cases for upload API with the payload and expected response code
 test_cases_upload_csv = [
     ["", 502],  # No file uploaded
     [sample_file, 200],  # Valid test case
+    [sample_file_malformed_languages, 200],  # Row with malformed languages is reported as failed, not fatal
     [sample_file_headers, 502],  # Test case with headers only, should fail due to not data
     ["title,year,director\n" + "Movie1,2020,Director1\n" * int(1e7), 502],  # Test case with file size more than 100 mb
     ["title,year,director\nMovie1,2020,Director1\nMovie2,2021,Director2", 502],  # Test case with incorrect header
@@ -68,6 +108,79 @@ test_case_fetch_api = [
         }
         , 200
     ],  # Test case where no data matches the filter param
+    [
+        {
+            "sort_params": {
+                "vote_average": -1
+            },
+            "cursor": "not-a-valid-cursor",
+            "size": 10
+        }
+        , 502
+    ],  # Invalid cursor token
+    [
+        {
+            "filter_params": {
+                "languages": "English"
+            },
+            "page": 1,
+            "size": 10,
+            "include_total": True
+        }
+        , 200
+    ],  # Valid test case requesting the total count along with the page
+    [
+        {
+            "page": 1,
+            "size": 0
+        }
+        , 502
+    ],  # Invalid page size
+    [
+        {
+            "sort_params": {
+                "vote_average": -1
+            },
+            "fields": ["title", "overview", "homepage"],
+            "page": 1,
+            "size": 10
+        }
+        , 200
+    ],  # Valid test case requesting fields other than the list view ones
+    [
+        {
+            "fields": ["title", "_id"],
+            "page": 1,
+            "size": 10
+        }
+        , 502
+    ],  # Field which is not allowed,
+    [
+        {
+            "search": "toy story",
+            "filter_params": {
+                "languages": "English"
+            },
+            "page": 1,
+            "size": 10
+        }
+        , 200
+    ],  # Valid test case searching within a language
+    [
+        {
+            "search": "toy story",
+            "sort_params": {
+                "vote_average": -1
+            }
+        }
+        , 502
+    ],  # Invalid test case sorting search results, they are ranked by relevance
+    [
+        {
+            "search": ""
+        }
+        , 502
+    ],  # Invalid test case with empty search terms
 ]
 
 
@@ -111,3 +224,626 @@ def test_fetch_movies_api():
                 print(
                     f"Test case {idx + 1} failed: Expected status code {test_case[1]}, but got {response.status_code}")
             print("\n")
+
+
+def test_fetch_movies_total(mock_mongo):
+    from chalice import BadRequestError
+    from chalicelib.support import csv_upload_support
+
+    header, toy_story, jumanji = sample_file.rstrip(b'\n').split(b'\n')
+    heat = toy_story.replace(b',Toy Story,', b',Heat,').replace(b',7.7,', b',7.9,')
+    csv_upload_support.upload_csv_data(b'\n'.join([header, toy_story, jumanji, heat]) + b'\n')
+
+    # The second page and the total of the filter come from a single $facet aggregation
+    result = cms_api_support.fetch_movies({"languages": "English"}, {"vote_average": -1}, 2, 1, include_total=True)
+    assert result["total_count"] == 3
+    assert result["data"] == [{"title": "Toy Story", "release_year": 1995, "vote_average": 7.7,
+                               "languages": ["English"]}]
+    assert cms_api_support.fetch_movies({"languages": "Français"}, {}, 1, 10, include_total=True)["total_count"] == 1
+
+    # The $facet output is a single document, so the pages counted along with the total are capped
+    with pytest.raises(BadRequestError):
+        cms_api_support.fetch_movies({}, {}, 1, 1001, include_total=True)
+
+
+def test_fetch_cursor_token():
+    sort_order_params = [("vote_average", -1), ("release_date", 1), ("_id", 1)]
+    last_record = {"vote_average": 7.7, "release_date": "1995-10-30", "_id": ObjectId()}
+
+    cursor = cms_api_support.encode_cursor(sort_order_params, last_record)
+    cursor_values = cms_api_support.decode_cursor(cursor, sort_order_params)
+    assert cursor_values == [7.7, "1995-10-30", last_record["_id"]]
+
+    branches = cms_api_support.build_keyset_filter(sort_order_params, cursor_values)
+    assert branches == [
+        {"vote_average": {"$not": {"$gte": 7.7}}},
+        {"vote_average": 7.7, "release_date": {"$gt": "1995-10-30"}},
+        {"vote_average": 7.7, "release_date": "1995-10-30", "_id": {"$gt": last_record["_id"]}},
+    ]
+
+
+def test_fetch_movies_cache():
+    cache = cache_support.LRUCache(max_entries=2, ttl_in_seconds=60)
+    cache.set("first", 1)
+    cache.set("second", 2)
+    assert cache.get("first") == 1
+    cache.set("third", 3)  # evicts "second", the least recently used entry
+    assert cache.get("second") is None
+    assert cache.get("third") == 3
+
+    expired_cache = cache_support.LRUCache(max_entries=2, ttl_in_seconds=0)
+    expired_cache.set("first", 1)
+    assert expired_cache.get("first") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (2, 1, 1)
+    assert expired_cache.stats()["expirations"] == 1
+
+
+def test_fetch_movies_cache_fill_after_upload(monkeypatch):
+    from pymongo import ReadPreference
+    from chalicelib.common.init_support import mongo
+
+    read_preferences = []
+    monkeypatch.setattr(mongo, "fetch_read_preference", ReadPreference.SECONDARY_PREFERRED)
+    monkeypatch.setattr(mongo, "fetch_records_with_query",
+                        lambda *args, read_preference=None, **kwargs: read_preferences.append(read_preference) or [])
+    monkeypatch.setattr(cache_support, "dataset_changed_at", None)
+    cms_api_support.fetch_movies({"release_year": 1901}, {}, 1, 10)
+
+    # Right after an upload, a lagging secondary could fill the cache of the new generation with the previous data
+    cache_support.bump_dataset_generation()
+    cms_api_support.fetch_movies({"release_year": 1901}, {}, 1, 10)
+    monkeypatch.setattr(cache_support, "dataset_changed_at",
+                        cache_support.dataset_changed_at - cache_support.fetch_movies_cache.ttl_in_seconds)
+    cms_api_support.fetch_movies({"release_year": 1902}, {}, 1, 10)
+    assert read_preferences == [ReadPreference.SECONDARY_PREFERRED, ReadPreference.PRIMARY,
+                                ReadPreference.SECONDARY_PREFERRED]
+
+
+def test_get_read_preference():
+    from pymongo import ReadPreference
+    from chalicelib.common.mongo_collections import get_read_preference
+
+    assert get_read_preference("secondaryPreferred") == ReadPreference.SECONDARY_PREFERRED
+    # A typo names the env variable and the accepted modes, rather than failing with a bare KeyError
+    try:
+        get_read_preference("secondaryPrefered")
+        assert False, "Unknown read preference should be rejected"
+    except ValueError as err:
+        assert str(err).startswith("Invalid MONGO_FETCH_READ_PREFERENCE secondaryPrefered. Expected one of: primary")
+
+
+def test_parse_languages_column():
+    import pandas as pd
+    from chalicelib.support import csv_upload_support
+
+    languages = pd.Series(["['English', 'Français']", None, "[]", "[\"Côte d'Ivoire\"]", "English"], dtype="string")
+    assert csv_upload_support.parse_languages_column(languages).tolist() == [
+        ["English", "Français"], [], [], ["Côte d'Ivoire"], None
+    ]
+
+
+def test_upload_csv_merge_mode(mock_mongo):
+    with Client(app.app) as client:
+        response = client.http.post('/api/upload/movies/csv?mode=merge', headers={'Content-Type': 'application/csv'},
+                                    body=sample_file)
+        response_body = json.loads(response.body)
+        assert response.status_code == 200
+        assert (response_body["inserted_count"], response_body["unchanged_count"]) == (2, 0)
+
+        response = client.http.post('/api/upload/movies/csv?mode=replace',
+                                    headers={'Content-Type': 'application/csv'}, body=sample_file)
+        assert response.status_code == 502
+
+
+def test_upload_csv_merge_counts(mock_mongo, csv_engine):
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+    from chalicelib.support import csv_upload_support
+
+    upload_counts = [csv_upload_support.upload_csv_data(sample_file, upload_mode)
+                     for upload_mode in ("insert", "merge", "merge")]
+    # Movies uploaded in insert mode carry no content hash and are compared field by field, so merging the same
+    # file writes nothing
+    assert [{key: count for key, count in counts.items() if key != "message" and count}
+            for counts in upload_counts] == [{"inserted_count": 2}, {"unchanged_count": 2}, {"unchanged_count": 2}]
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {"content_hash": {"$exists": True}}) == 0
+
+    # The last row of a repeated key is written, the previous one is counted as a duplicate
+    header, toy_story, _ = sample_file.split(b'\n', 2)
+    rerated_toy_story = toy_story.replace(b',7.7,', b',8.1,')
+    counts = csv_upload_support.upload_csv_data(b'\n'.join([header, toy_story, rerated_toy_story]) + b'\n', "merge")
+    assert (counts["updated_count"], counts["duplicate_count"], counts["unchanged_count"]) == (1, 1, 0)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 2
+
+    # The merged movie is stored with a 64-bit hash, which the next merge compares
+    merged_movie = mock_mongo.fetch_document(MOVIES_DATA_COLLECTION, {"content_hash": {"$exists": True}})
+    assert isinstance(merged_movie["content_hash"], int) and merged_movie["vote_average"] == 8.1
+    counts = csv_upload_support.upload_csv_data(b'\n'.join([header, rerated_toy_story]) + b'\n', "merge")
+    assert (counts["updated_count"], counts["unchanged_count"]) == (0, 1)
+
+
+def test_upload_csv_partial_error(mock_mongo, csv_engine):
+    import os
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+
+    header, toy_story, _ = sample_file.split(b'\n', 2)
+    # A line with an extra field past the first chunk stops the upload after that chunk was written
+    chunk_size = int(os.environ["CSV_CHUNK_SIZE_IN_ROWS"])
+    raw_body = b'\n'.join([header] + [toy_story] * (chunk_size + 1000) + [toy_story + b',extra field']) + b'\n'
+
+    with Client(app.app) as client:
+        response = client.http.post('/api/upload/movies/csv', headers={'Content-Type': 'application/csv'},
+                                    body=raw_body)
+        response_body = json.loads(response.body)
+        assert response.status_code == 502
+        assert response_body["partial"] is True
+        assert 0 < response_body["inserted_count"] == mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {})
+
+        # Nothing is written before an invalid header, the error is not a partial upload
+        response = client.http.post('/api/upload/movies/csv', headers={'Content-Type': 'application/csv'},
+                                    body=b'title,year\nMovie1,2020\n')
+        assert response.status_code == 502
+        assert "partial" not in json.loads(response.body)
+
+
+def test_upload_csv_invalid_rows(mock_mongo, csv_engine):
+    from chalice import BadRequestError
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+    from chalicelib.support import csv_upload_support
+
+    header, toy_story, _ = sample_file.split(b'\n', 2)
+    # A value that is not a number or a fractional id rejects its row, the other rows are written
+    invalid_budget = toy_story.replace(b'30000000.0,', b'abc,', 1)
+    fractional_genre_id = toy_story.replace(b',3,16,', b',3,16.5,')
+    counts = csv_upload_support.upload_csv_data(sample_file + invalid_budget + b'\n' + fractional_genre_id + b'\n')
+    assert (counts["inserted_count"], counts["failed_count"]) == (2, 2)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 2
+
+    # A record with missing fields or an empty last cell rejects its row, whichever parser reads it
+    short_row = toy_story.rsplit(b',', 1)[0]
+    empty_last_cell = short_row + b','
+    counts = csv_upload_support.upload_csv_data(b'\n'.join([header, short_row, empty_last_cell, toy_story]) + b'\n')
+    assert (counts["inserted_count"], counts["failed_count"]) == (1, 2)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 3
+
+    # A record with extra fields is not a well-formed CSV
+    try:
+        csv_upload_support.upload_csv_data(b'\n'.join([header, toy_story + b',extra field', toy_story]) + b'\n')
+        assert False, f"A record with extra fields should be rejected by the {csv_engine} parser"
+    except BadRequestError as err:
+        assert "well-formed CSV" in str(err)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 3
+
+
+def test_import_csv_in_parallel_invalid_rows(mock_mongo, monkeypatch):
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+    from chalicelib.support import csv_upload_support
+
+    header, toy_story, jumanji = sample_file.rstrip(b'\n').split(b'\n')
+    invalid_budget = toy_story.replace(b'30000000.0,', b'abc,', 1)
+    raw_body = b'\n'.join([header, toy_story, invalid_budget, jumanji, invalid_budget]) + b'\n'
+    # One record per part, the malformed numbers are rejected by their parts without cancelling the other ones
+    monkeypatch.setenv("CSV_PART_SIZE_IN_MB", "0")
+    counts = csv_upload_support.upload_csv_data(raw_body, "merge", workers=2)
+    assert (counts["inserted_count"], counts["failed_count"]) == (2, 2)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 2
+
+    # The serial path reports the same rows
+    counts = csv_upload_support.upload_csv_data(raw_body, "merge")
+    assert (counts["unchanged_count"], counts["failed_count"]) == (2, 2)
+
+
+def test_import_csv_in_parallel_repeated_keys(mock_mongo, monkeypatch):
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+    from chalicelib.support import csv_upload_support
+
+    import threading
+    import time
+
+    # Parts repeating a natural key are not upserted concurrently, which would insert the movie more than once
+    writing_keys = []
+    concurrent_keys = []
+    writing_keys_lock = threading.Lock()
+
+    def merge_csv_chunk(documents):
+        natural_keys = [csv_upload_support.get_natural_key(document) for document in documents]
+        with writing_keys_lock:
+            concurrent_keys.extend(set(natural_keys).intersection(writing_keys))
+            writing_keys.extend(natural_keys)
+        time.sleep(0.05)
+        with writing_keys_lock:
+            for natural_key in natural_keys:
+                writing_keys.remove(natural_key)
+        return csv_upload_support.merge_csv_chunk(documents)
+
+    monkeypatch.setitem(csv_upload_support.CHUNK_WRITERS, "merge", merge_csv_chunk)
+    header, toy_story, jumanji = sample_file.rstrip(b'\n').split(b'\n')
+    raw_body = b'\n'.join([header] + [toy_story, jumanji] * 10) + b'\n'
+    monkeypatch.setenv("CSV_PART_SIZE_IN_MB", "0")
+    counts = csv_upload_support.upload_csv_data(raw_body, "merge", workers=4)
+    assert not concurrent_keys
+    assert (counts["inserted_count"], counts["unchanged_count"]) == (2, 18)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 2
+
+
+def test_upload_job_status_api(mock_mongo):
+    from datetime import datetime
+    from chalicelib.common.mongo_collections import INGEST_JOBS_COLLECTION
+    from chalicelib.support import ingest_job_support
+
+    mock_mongo.insert_document(INGEST_JOBS_COLLECTION, {
+        "_id": "job-id", "status": "completed", "mode": "merge", "file_size_in_bytes": 1024,
+        "counts": {"inserted_count": 300, "updated_count": 100, "unchanged_count": 90, "failed_count": 10},
+        "created_at": datetime(2024, 1, 1, 12, 0, 0), "started_at": datetime(2024, 1, 1, 12, 0, 1),
+        "finished_at": datetime(2024, 1, 1, 12, 0, 11)
+    })
+
+    # Rows processed add up the counts, the throughput is measured from the start to the end of the job
+    job_status = ingest_job_support.get_job_status("job-id")
+    assert (job_status["job_id"], job_status["rows_processed"], job_status["rows_per_second"]) == ("job-id", 500, 50.0)
+    assert job_status["completed"] and job_status["error"] is None
+    assert job_status["finished_at"] == "2024-01-01 12:00:11"
+
+    # A running job that stopped making progress, e.g. in a frozen process, is reported as failed
+    now = datetime.utcnow().replace(microsecond=0)
+    for job_id, updated_at in (("stale-job-id", datetime(2024, 1, 1, 12, 0, 5)), ("running-job-id", now)):
+        mock_mongo.insert_document(INGEST_JOBS_COLLECTION, {
+            "_id": job_id, "status": "running", "mode": "insert", "file_size_in_bytes": 1024,
+            "counts": {"inserted_count": 100}, "created_at": datetime(2024, 1, 1, 12, 0, 0),
+            "started_at": datetime(2024, 1, 1, 12, 0, 1), "updated_at": updated_at
+        })
+    job_status = ingest_job_support.get_job_status("stale-job-id")
+    assert (job_status["status"], job_status["completed"], job_status["rows_per_second"]) == ("failed", True, 25.0)
+    assert mock_mongo.fetch_document(INGEST_JOBS_COLLECTION, {"_id": "stale-job-id"})["status"] == "failed"
+    assert ingest_job_support.get_job_status("running-job-id")["status"] == "running"
+
+    with Client(app.app) as client:
+        response = client.http.get('/api/upload/jobs/job-id')
+        assert response.status_code == 200
+        assert json.loads(response.body)["rows_processed"] == 500
+
+        response = client.http.get('/api/upload/jobs/unknown-job-id')
+        assert response.status_code == 404
+
+
+def test_upload_job(mock_mongo, monkeypatch):
+    from chalice import BadRequestError
+    from chalicelib.common.mongo_collections import MOVIES_DATA_COLLECTION
+    from chalicelib.support import ingest_job_support
+
+    # Without INGEST_JOB_QUEUE the job runs on the thread pool, which is waited for here
+    monkeypatch.setattr(ingest_job_support, "executor", None)
+    job_id = ingest_job_support.submit_upload_job(sample_file, "insert")
+    ingest_job_support.get_executor().shutdown(wait=True)
+
+    job_status = ingest_job_support.get_job_status(job_id)
+    assert (job_status["status"], job_status["completed"], job_status["error"]) == ("completed", True, None)
+    assert (job_status["counts"]["inserted_count"], job_status["rows_processed"]) == (2, 2)
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 2
+
+    # A job is only started once, e.g. when its SQS message is delivered again
+    ingest_job_support.run_upload_job(job_id, sample_file, "insert")
+    assert mock_mongo.count_documents_by_filter(MOVIES_DATA_COLLECTION, {}) == 2
+
+    # A deployed stage needs the queue, as a Lambda freezes the thread pool once the response is returned
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "imdb-app-dev")
+    for async_upload_enabled in ("True", "False"):
+        monkeypatch.setenv("ASYNC_UPLOAD_ENABLED", async_upload_enabled)
+        try:
+            ingest_job_support.submit_upload_job(sample_file, "insert")
+            assert False, "The job should not run on the thread pool of a Lambda"
+        except BadRequestError as err:
+            assert "INGEST_JOB_QUEUE" in str(err) or "not enabled" in str(err)
+
+
+def test_split_csv_body():
+    from chalicelib.support import csv_upload_support
+
+    raw_body = (
+        b'title,overview\n'
+        b'Toy Story,"Led by Woody,\nAndy\'s toys live happily"\n'
+        b'Jumanji,"He said ""run""\n\nand they ran"\n'
+        b'Heat,A group of robbers\n'
+    )
+    header, byte_ranges = csv_upload_support.split_csv_body(raw_body, part_size=1)
+    assert header == b'title,overview\n'
+    # Newlines inside quoted overviews never split a record
+    assert [raw_body[start:end] for start, end in byte_ranges] == [
+        b'Toy Story,"Led by Woody,\nAndy\'s toys live happily"\n',
+        b'Jumanji,"He said ""run""\n\nand they ran"\n',
+        b'Heat,A group of robbers\n',
+    ]
+    assert csv_upload_support.split_csv_body(raw_body, part_size=len(raw_body))[1] == [(len(header), len(raw_body))]
+
+
+def test_request_trace():
+    from chalicelib.common import trace_support
+
+    with Client(app.app) as client:
+        response = client.http.post('/api/fetch/movies', headers={'Content-Type': 'application/json'},
+                                    body=json.dumps({"filter_params": {"release_year": 1995}, "size": 0}))
+        # Spans of the request are exposed to the client as a Server-Timing header, failed requests included
+        span_names = [timing.split(";")[0] for timing in response.headers["Server-Timing"].split(", ")]
+        assert {"body_decode", "validation", "total"}.issubset(span_names)
+
+    # Slow queries are logged with their shape, never with the filter values
+    shape = trace_support.get_query_shape("aggregate", {
+        "aggregate": "movies_data",
+        "pipeline": [{"$match": {"languages": "English", "release_year": {"$in": [1995, 1996]}}},
+                     {"$sort": {"vote_average": -1, "_id": -1}}]
+    })
+    assert shape == {"collection": "movies_data",
+                     "filter_shape": {"languages": "?", "release_year": {"$in": ["?", "?"]}},
+                     "sort": {"vote_average": -1, "_id": -1}}
+    assert trace_support.get_docs_returned({"cursor": {"firstBatch": [{}, {}], "id": 0}}) == 2
+
+
+def test_build_json_response():
+    from datetime import datetime
+    import numpy as np
+    from chalicelib.common import response_support
+
+    body = {"budget": float("nan"), "release_date": datetime(1995, 10, 30), "_id": ObjectId("0" * 24),
+            "vote_count": np.int64(5415), "vote_average": np.float32("nan"), "languages": ["English"]}
+    expected_body = {"budget": None, "release_date": "1995-10-30T00:00:00", "_id": "0" * 24,
+                     "vote_count": 5415, "vote_average": None, "languages": ["English"]}
+    assert json.loads(response_support.encode_json(body)) == expected_body
+
+    # The standard json module is used when orjson is not installed
+    orjson = response_support.orjson
+    response_support.orjson = None
+    try:
+        assert json.loads(response_support.encode_json(body)) == expected_body
+    finally:
+        response_support.orjson = orjson
+
+    response = response_support.build_json_response({"data": [body]})
+    assert response.headers["Content-Type"] == "application/json"
+    assert json.loads(response.body) == {"data": [expected_body]}
+
+
+def test_fetch_movies_batch_api():
+    with Client(app.app) as client:
+        # Failed queries get an error of their own, in the order they were requested
+        response = client.http.post('/api/fetch/movies/batch', headers={'Content-Type': 'application/json'},
+                                    body=json.dumps({"queries": [{"size": 0}, "not a query", {"fields": ["_id"]}]}))
+        assert response.status_code == 200
+        results = json.loads(response.body)["results"]
+        assert [("Page size" in results[0]["error"]), ("object" in results[1]["error"]),
+                ("_id" in results[2]["error"])] == [True, True, True]
+
+        for queries in ([], [{}] * 11, None):
+            response = client.http.post('/api/fetch/movies/batch', headers={'Content-Type': 'application/json'},
+                                        body=json.dumps({"queries": queries}))
+            assert response.status_code == 502
+
+
+def test_build_facet_operations():
+    from chalicelib.support import facet_support
+
+    toy_story = {"title": "Toy Story", "original_title": "Toy Story", "release_date": "1995-10-30",
+                 "release_year": 1995, "vote_average": 7.7, "languages": ["English"]}
+    jumanji = {"title": "Jumanji", "original_title": "Jumanji", "release_date": "1995-12-15",
+               "release_year": 1995, "vote_average": float("nan"), "languages": ["English", "Français"]}
+    pull_operations, push_operations = facet_support.build_facet_operations([toy_story, jumanji])
+    updates = {operation._filter["_id"]: operation._doc for operation in push_operations}
+
+    assert pull_operations == []
+    assert {facet_id: update["$inc"]["count"] for facet_id, update in updates.items()} == {
+        "language:English": 2, "language:Français": 1, "release_year:1995": 2}
+    # Movies without a valid rating are counted but never top rated
+    assert [entry["title"] for entry in updates["language:English"]["$push"]["top_rated"]["$each"]] == ["Toy Story"]
+    assert "$push" not in updates["language:Français"]
+
+    # Replacing a movie with a new rating moves it within its top rated list without changing the counts
+    pull_operations, push_operations = facet_support.build_facet_operations([{**toy_story, "vote_average": 8.9}],
+                                                                            [toy_story])
+    assert [operation._doc["$pull"]["top_rated"]["key"]["$in"] for operation in pull_operations] == [
+        [facet_support.get_movie_key(toy_story)]]
+    assert [(operation._filter["_id"], operation._doc["$inc"]["count"]) for operation in push_operations] == [
+        ("language:English", 0)]
+
+
+def test_validate_search_params():
+    from chalice import BadRequestError
+
+    filter_params, sort_order_params, start_index, keyset_filter_params = cms_api_support.validate_fetch_params(
+        {"release_year": 1995}, {}, 2, 10, search="toy story")
+    assert filter_params == {"release_year": 1995, "$text": {"$search": "toy story"}}
+    assert sort_order_params == cms_api_support.SEARCH_SORT_ORDER_PARAMS
+    assert (start_index, keyset_filter_params) == (10, None)
+
+    cursor = cms_api_support.encode_cursor([("_id", 1)], {"_id": ObjectId()})
+    for sort_params, cursor, search in (({}, cursor, "toy story"), ({"vote_average": -1}, None, "toy story"),
+                                        ({}, None, "x" * 201), ({}, None, ["toy"])):
+        try:
+            cms_api_support.validate_fetch_params({}, sort_params, 1, 10, cursor, search)
+            assert False, f"Search {search} with {sort_params} and cursor {cursor} should be rejected"
+        except BadRequestError:
+            pass
+
+
+def test_export_movies_api(mock_mongo):
+    from chalice import BadRequestError
+    from chalicelib.support import export_support
+
+    assert export_support.validate_export_params("ndjson", None) == list(cms_api_support.FIELDS_TO_KEEP)
+    assert export_support.validate_export_params("csv", None) == list(export_support.CSV_EXPORT_FIELDS)
+    assert export_support.validate_export_params("ndjson", ["title"]) == ["title"]
+    for export_format, fields in (("xml", None), ("csv", []), ("csv", ["_id"])):
+        try:
+            export_support.validate_export_params(export_format, fields)
+            assert False, f"Export format {export_format} with fields {fields} should be rejected"
+        except BadRequestError:
+            pass
+
+    # Exported values are written as in an uploaded CSV file, so that an export can be uploaded again
+    assert [export_support.to_csv_value(value) for value in (float("nan"), None, ["English", "Français"], 7.7)] == [
+        "", "", "['English', 'Français']", 7.7]
+
+    # A default CSV export of uploaded movies is read back by the upload API into the same movies
+    import csv
+    import io
+    from chalicelib.support import csv_upload_support
+    documents, _ = csv_upload_support.transform_csv_chunk(next(csv_upload_support.read_csv_chunks(sample_file, 10)))
+    buffer = io.StringIO()
+    csv_writer = csv.writer(buffer, lineterminator="\n")
+    csv_writer.writerow(export_support.validate_export_params("csv", None))
+    for document in documents:
+        csv_writer.writerow([export_support.to_csv_value(document.get(field))
+                             for field in export_support.CSV_EXPORT_FIELDS])
+    exported_df = next(csv_upload_support.read_csv_chunks(buffer.getvalue().encode(), 10))
+    csv_upload_support.validate_csv_headers(exported_df.columns)
+    assert csv_upload_support.transform_csv_chunk(exported_df) == (documents, 0)
+
+    with Client(app.app) as client:
+        response = client.http.post('/api/export/movies', headers={'Content-Type': 'application/json'},
+                                    body=json.dumps({"format": "xml"}))
+        assert response.status_code == 502
+
+        csv_upload_support.upload_csv_data(sample_file)
+        response = client.http.post('/api/export/movies', headers={'Content-Type': 'application/json'},
+                                    body=json.dumps({"format": "csv", "fields": ["title", "release_year"],
+                                                     "filter_params": {"release_year": 1995}}))
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "text/csv"
+        assert response.body.decode().splitlines() == ["title,release_year", "Toy Story,1995", "Jumanji,1995"]
+
+
+def test_export_movies_response_size(mock_mongo):
+    from chalicelib.support import csv_upload_support, export_support
+
+    # Movies with realistic overviews, whose NDJSON export exceeds the 6 MB Lambda payload at the default row limit
+    header, rows = sample_file.split(b'\n', 1)
+    csv_upload_support.upload_csv_data(header + b'\n' + rows * 5000)
+
+    for export_format in ("ndjson", "csv"):
+        exported_counts = []
+        cursor = None
+        while True:
+            body, _, cursor = export_support.export_movies({}, {}, export_format, cursor=cursor)
+            assert len(body.encode()) <= 5 * 2 ** 20
+            exported_counts.append(len(body.splitlines()) - (export_format == "csv"))
+            if cursor is None:
+                break
+        # Each response resumes right after the previous one
+        assert len(exported_counts) > 1 and sum(exported_counts) == 10000
+
+
+def test_movie_snapshot():
+    from chalicelib.support import snapshot_support
+
+    toy_story = {"_id": ObjectId("0" * 23 + "1"), "title": "Toy Story", "release_year": 1995, "vote_average": 7.7,
+                 "release_date": "1995-10-30", "languages": ["English"]}
+    jumanji = {"_id": ObjectId("0" * 23 + "2"), "title": "Jumanji", "release_year": 1995,
+               "vote_average": float("nan"), "release_date": "1995-12-15", "languages": ["English", "Français"]}
+    heat = {"_id": ObjectId("0" * 23 + "3"), "title": "Heat", "release_year": 1995, "vote_average": 7.7,
+            "languages": ["English"]}
+    snapshot = snapshot_support.MovieSnapshot([toy_story, jumanji, heat], generation=0)
+
+    def fetch_titles(filter_params, sort_params, cursor_values=None, start_index=0, size=10):
+        records, total_count = snapshot.fetch_records(filter_params, sort_params, cursor_values, start_index, size,
+                                                      ["title", "release_date", "_id"])
+        return [record["title"] for record in records], total_count
+
+    # Sorted like Mongo: NaN before the other numbers, ties broken by _id
+    assert fetch_titles({}, [("vote_average", -1), ("_id", -1)]) == (["Heat", "Toy Story", "Jumanji"], 3)
+    assert fetch_titles({"languages": "Français"}, [("_id", 1)]) == (["Jumanji"], 1)
+    # Missing values sort first and are left out of the records
+    assert fetch_titles({"languages": {"$in": ["English"]}}, [("release_date", 1), ("vote_average", -1),
+                                                              ("_id", -1)]) == (["Heat", "Toy Story", "Jumanji"], 3)
+    assert "release_date" not in snapshot.fetch_records({}, [("_id", -1)], None, 0, 1, ["release_date"])[0][0]
+    # Pages by number and by cursor
+    assert fetch_titles({}, [("vote_average", 1), ("release_year", 1), ("_id", 1)], start_index=1, size=1) == (
+        ["Toy Story"], 3)
+    assert fetch_titles({}, [("vote_average", 1), ("_id", 1)], cursor_values=[7.7, toy_story["_id"]]) == (
+        ["Heat"], 3)
+
+    # Mongo answers the queries the snapshot does not handle, and cursors of records that changed since
+    assert snapshot.fetch_records({"release_year": {"$gte": 1995}}, [("_id", 1)], None, 0, 10, ["title"]) is None
+    assert snapshot.fetch_records({}, [("vote_average", 1), ("_id", 1)], [8.1, toy_story["_id"]], 0, 10,
+                                  ["title"]) is None
+
+
+def test_snapshot_reload(mock_mongo, monkeypatch):
+    from chalicelib.support import csv_upload_support, snapshot_support
+
+    monkeypatch.setattr(snapshot_support, "snapshot", None)
+    monkeypatch.setenv("FETCH_SNAPSHOT_TTL_IN_SECONDS", "0")
+    csv_upload_support.upload_csv_data(sample_file)
+    loaded_snapshot = snapshot_support.get_snapshot()
+    assert (loaded_snapshot.size, loaded_snapshot.stored_version) == (2, 1)
+
+    # Past the TTL the snapshot is kept as long as the stored version of the collection is unchanged
+    assert snapshot_support.get_snapshot() is loaded_snapshot
+
+    # An upload handled by another process bumps the stored version only
+    snapshot_support.bump_stored_version()
+    reloaded_snapshot = snapshot_support.get_snapshot()
+    assert reloaded_snapshot is not loaded_snapshot and reloaded_snapshot.stored_version == 2
+
+
+def test_storage_schema():
+    from datetime import datetime
+    from chalicelib.support import csv_upload_support, schema_support
+
+    df = next(csv_upload_support.read_csv_chunks(sample_file, 10))
+    documents, rejected_count = csv_upload_support.transform_csv_chunk(df)
+    assert rejected_count == 0
+    # Dates and whole numbers get their declared types, and the empty homepage of Jumanji is left out
+    assert (documents[0]["release_date"], documents[0]["runtime"], documents[0]["budget"]) == (
+        datetime(1995, 10, 30), 81, 30000000)
+    assert [type(documents[0][field]) for field in ("runtime", "vote_count", "release_year", "vote_average")] == [
+        int, int, int, float]
+    assert "homepage" not in documents[1]
+
+    # Movies stored by older uploads are migrated to the same documents
+    legacy_document = {"_id": ObjectId(), "release_date": "1995-10-30", "runtime": 81.0, "budget": 30000000.0,
+                       "homepage": float("nan"), "vote_average": 7.7, "languages": ["English"]}
+    storage_document = schema_support.to_storage_document(legacy_document)
+    assert storage_document == {"_id": legacy_document["_id"], "release_date": datetime(1995, 10, 30),
+                                "runtime": 81, "budget": 30000000, "vote_average": 7.7, "languages": ["English"]}
+    assert schema_support.get_schema_updates(legacy_document, storage_document) == {
+        "$set": {"release_date": datetime(1995, 10, 30), "runtime": 81, "budget": 30000000},
+        "$unset": {"homepage": ""}}
+    assert schema_support.get_schema_updates(storage_document, storage_document) == {}
+
+    for field, value in (("runtime", 81.5), ("release_date", "unknown"), ("title", 3)):
+        try:
+            schema_support.to_storage_value(field, value)
+            assert False, f"{field} {value} should be rejected"
+        except ValueError:
+            pass
+
+
+def test_read_csv_multi_line_overview():
+    from chalicelib.support import csv_upload_support
+
+    header, rows = sample_file.split(b'\n', 1)
+    toy_story = rows.split(b'\n')[0].replace(b'Led by Woody, ', b'Led by Woody,\n')
+    raw_body = header + b'\n' + b'\n'.join([toy_story] * 200) + b'\n'
+    # Blocks of 5 rows of 512 bytes, the multi-line overviews cross their boundaries
+    for engine in ("c", "pyarrow") if csv_upload_support.pyarrow is not None else ("c",):
+        chunks = list(csv_upload_support.read_csv_chunks(raw_body, 5, engine))
+        assert sum(len(chunk) for chunk in chunks) == 200
+        assert all(overview.startswith("Led by Woody,\nAndy") for chunk in chunks for overview in chunk["overview"])
+
+
+def test_transform_csv_part_multi_line_overview():
+    from chalicelib.support import csv_upload_support
+
+    header, rows = sample_file.split(b'\n', 1)
+    toy_story = rows.split(b'\n')[0].replace(b'Led by Woody, ', b'Led by Woody,\n')
+    raw_body = header + b'\n' + b'\n'.join([toy_story] * 200) + b'\n'
+    header, byte_ranges = csv_upload_support.split_csv_body(raw_body, part_size=len(raw_body) // 2)
+    assert len(byte_ranges) == 2
+
+    # Each part spans many blocks of 5 rows, as the import-csv parts span many blocks of the default chunk size
+    transformed_rows = 0
+    for start, end in byte_ranges:
+        documents, rejected_count = csv_upload_support.transform_csv_part(header, raw_body[start:end], "merge", 5)
+        assert rejected_count == 0
+        assert all(document["overview"].startswith("Led by Woody,\nAndy") for document in documents)
+        transformed_rows += len(documents)
+    assert transformed_rows == 200
@@ -1,9 +1,30 @@
+import json
+import subprocess
+import sys
+
 from chalice.test import Client
 from tests import env_variables
 
 env_variables.add_os_variables()
 import app
 
+# Generous budget for importing the app in a fresh interpreter, meant to catch heavy imports sneaking back in
+COLD_START_BUDGET_IN_MS = 1500
+
+cold_start_script = """
+import json, sys, time
+from tests import env_variables
+env_variables.add_os_variables()
+start_time = time.perf_counter()
+import app
+from chalicelib.common.init_support import mongo
+print(json.dumps({
+    "import_time_in_ms": (time.perf_counter() - start_time) * 1e3,
+    "pandas_imported": "pandas" in sys.modules,
+    "mongo_client_created": mongo._client is not None
+}))
+"""
+
 
 def test_health_check():
     with Client(app.app) as client:
@@ -11,3 +32,20 @@ def test_health_check():
             '/api/health_check'
         )
         assert response.status_code == 200
+
+        # Pool settings come from the env variables, reading them does not connect to Mongo
+        mongo_pool = json.loads(response.body)["mongo_pool"]
+        assert (mongo_pool["max_pool_size"], mongo_pool["compressors"]) == (100, "zlib")
+        assert mongo_pool["fetch_read_preference"] == "secondaryPreferred"
+        assert "connections_in_use" in mongo_pool
+
+
+def test_cold_start():
+    output = subprocess.run([sys.executable, "-c", cold_start_script], capture_output=True, text=True,
+                            check=True).stdout
+    cold_start = json.loads(output.strip().splitlines()[-1])
+    print("Cold start:", cold_start)
+
+    assert not cold_start["pandas_imported"]
+    assert not cold_start["mongo_client_created"]
+    assert cold_start["import_time_in_ms"] < COLD_START_BUDGET_IN_MS
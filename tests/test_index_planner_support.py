@@ -0,0 +1,92 @@
+from tests import env_variables
+
+env_variables.add_os_variables()
+
+from chalicelib.support import cms_api_support, index_planner_support
+from chalicelib.support.index_planner_support import ADDITIONAL_INDEXES
+
+winning_plan = {
+    "stage": "LIMIT",
+    "inputStage": {
+        "stage": "SORT",
+        "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "languages_1__id_-1"}}
+    }
+}
+
+
+def test_index_serves_shape():
+    index_fields = [("languages", 1), ("vote_average", -1), ("_id", -1)]
+    assert index_planner_support.index_serves_shape(index_fields, {"languages": "English"},
+                                                    [("vote_average", -1), ("_id", -1)])
+    # Walking the index backwards serves the reversed sort
+    assert index_planner_support.index_serves_shape(index_fields, {"languages": "English"},
+                                                    [("vote_average", 1), ("_id", 1)])
+    assert not index_planner_support.index_serves_shape(index_fields, {"languages": "English"},
+                                                        [("vote_average", -1), ("_id", 1)])
+    assert not index_planner_support.index_serves_shape(index_fields, {}, [("vote_average", -1), ("_id", -1)])
+
+
+def test_plan_indexes():
+    shapes = index_planner_support.enumerate_query_shapes()
+
+    # Without a limit, every shape is served by one of the planned indexes but the ones sorting in mixed directions
+    indexes_to_create, unplanned_shapes = index_planner_support.plan_indexes(max_indexes=1000)
+    assert unplanned_shapes
+    assert all(index_planner_support.has_mixed_sort_directions(sort_order_params)
+               for _, sort_order_params in unplanned_shapes)
+    assert len(indexes_to_create) < len(shapes)
+
+    # A sort is merged with the longer sorts it is a prefix of, they are served by the same index
+    def normalise(filter_params, sort_params):
+        return cms_api_support.validate_fetch_params(filter_params, sort_params, 1, 1)[1]
+
+    assert normalise({}, {"vote_average": -1}) == normalise({}, {"vote_average": -1, "release_date": -1})
+    assert normalise({"languages": "English"}, {}) == normalise({"languages": "English"}, {"vote_average": -1})
+
+    # The default cap covers every filter, unsorted or with a single sort key
+    indexes_to_create, unplanned_shapes = index_planner_support.plan_indexes()
+    planned_fields = [index_fields for index_fields, _ in indexes_to_create[:-len(ADDITIONAL_INDEXES)]]
+    single_sort_params = [{key: direction} for key in cms_api_support.SORT_KEYS_TO_KEEP for direction in (-1, 1)]
+    for filter_keys in ((), ("languages",), ("release_year",), ("languages", "release_year")):
+        filter_params = {key: index_planner_support.SAMPLE_FILTER_VALUES[key] for key in filter_keys}
+        for sort_params in [{}] + single_sort_params:
+            assert (filter_params, normalise(filter_params, sort_params)) not in unplanned_shapes
+    # Every planned index is needed, no other planned index serves all of its shapes
+    for index_fields in planned_fields:
+        other_fields = [fields for fields in planned_fields if fields != index_fields]
+        assert any(index_planner_support.index_serves_shape(index_fields, *shape)
+                   and not any(index_planner_support.index_serves_shape(fields, *shape) for fields in other_fields)
+                   for shape in shapes)
+    write_cost = index_planner_support.get_write_cost(indexes_to_create)
+    assert write_cost["index_count"] == len(indexes_to_create) + 1
+    assert write_cost["multikey_index_count"] == sum(1 for fields in planned_fields
+                                                     if "languages" in dict(fields))
+
+    indexes_to_create, unplanned_shapes = index_planner_support.plan_indexes(max_indexes=4)
+    assert len(indexes_to_create) == 4 + len(ADDITIONAL_INDEXES)
+    assert unplanned_shapes
+    # The most common shape, a single filter without sort keys, is always covered
+    assert ({"languages": "English"}, normalise({"languages": "English"}, {})) not in unplanned_shapes
+
+
+def test_get_plan_stages():
+    assert index_planner_support.get_plan_stages(winning_plan) == ["LIMIT", "SORT", "FETCH", "IXSCAN"]
+    assert index_planner_support.get_plan_stages({"queryPlan": winning_plan})[0] == "LIMIT"
+
+
+def test_text_index_fields():
+    from chalicelib.common import init_support
+
+    # A text index is listed with internal keys, its fields are only found in its weights
+    listed_text_index = {"name": "movies_text_index", "key": {"_fts": "text", "_ftsx": 1},
+                         "weights": {"original_title": 5, "overview": 1, "title": 10}}
+    text_index_fields, text_index_name = index_planner_support.ADDITIONAL_INDEXES[-1]
+    assert text_index_name in index_planner_support.INDEX_OPTIONS
+    assert init_support.get_index_fields(listed_text_index) == init_support.normalise_index_fields(text_index_fields)
+
+    # Every search shape is ranked by relevance, whatever the filters
+    search_shapes = index_planner_support.enumerate_search_shapes()
+    assert len(search_shapes) == 4
+    assert all(filter_params["$text"] == {"$search": index_planner_support.SAMPLE_SEARCH}
+               and sort_order_params[0] == ("score", {"$meta": "textScore"})
+               for filter_params, sort_order_params in search_shapes)